@@ -0,0 +1,271 @@
+import math
+
+import numpy as np
+
+from constants import LABEL_COLORS
+from image_pyramid import TILE_SIZE
+from tracing import traced
+
+OVERLAY_ALPHA = 160
+
+
+def label_lut(alpha=OVERLAY_ALPHA):
+    # Premultiplied RGBA color for every possible label value
+    lut = np.zeros((256, 4), np.uint8)
+    for value, (r, g, b) in enumerate(LABEL_COLORS, start=1):
+        lut[value] = (r * alpha // 255, g * alpha // 255, b * alpha // 255, alpha)
+    return lut
+
+
+def union_rect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1 = max(a[0] + a[2], b[0] + b[2])
+    y1 = max(a[1] + a[3], b[1] + b[3])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def segment_bounds(p0, p1, radius, width, height):
+    # Pixel rect covered by a round-capped segment, clipped to the layer
+    r = max(radius, 0.5)
+    x0 = max(0, int(math.floor(min(p0[0], p1[0]) - r)))
+    y0 = max(0, int(math.floor(min(p0[1], p1[1]) - r)))
+    x1 = min(width, int(math.ceil(max(p0[0], p1[0]) + r)) + 1)
+    y1 = min(height, int(math.ceil(max(p0[1], p1[1]) + r)) + 1)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def segment_mask(p0, p1, radius, bounds):
+    # Pixels of `bounds` whose centers lie within `radius` of the segment
+    x, y, width, height = bounds
+    ys, xs = np.ogrid[y:y + height, x:x + width]
+    ax, ay = p0
+    dx, dy = p1[0] - ax, p1[1] - ay
+    px, py = xs + 0.5 - ax, ys + 0.5 - ay
+    length = dx * dx + dy * dy
+    if length > 0:
+        t = np.clip((px * dx + py * dy) / length, 0.0, 1.0)
+    else:
+        t = 0.0
+    ex, ey = px - t * dx, py - t * dy
+    r = max(radius, 0.5)
+    return ex * ex + ey * ey <= r * r
+
+
+class LabelLayer:
+    # Label image in image coordinates, one uint8 class per pixel, stored as
+    # chunks that are only allocated once something is painted in them.
+    # Chunks can be read-only views of a project file; they are copied on
+    # the first write. `dirty` maps each chunk changed since the last project
+    # save to the edit count at its latest change
+    def __init__(self, width, height, chunk_size=TILE_SIZE):
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self.dirty = {}
+        self.edits = 0
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def clear(self):
+        self._mark_dirty(self.chunks)
+        self.chunks = {}
+
+    def _mark_dirty(self, keys):
+        self.edits += 1
+        for key in keys:
+            self.dirty[key] = self.edits
+
+    def _chunk_rect(self, row, col):
+        size = self.chunk_size
+        x, y = col * size, row * size
+        return x, y, min(size, self.width - x), min(size, self.height - y)
+
+    def _chunk_range(self, x, y, width, height):
+        # Keys of the chunks under a rect clipped to the layer
+        size = self.chunk_size
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(self.width, x + width), min(self.height, y + height)
+        if x1 <= x0 or y1 <= y0:
+            return []
+        return [(row, col) for row in range(y0 // size, (y1 - 1) // size + 1)
+                for col in range(x0 // size, (x1 - 1) // size + 1)]
+
+    def _writable(self, row, col):
+        chunk = self.chunks.get((row, col))
+        if chunk is None:
+            _, _, width, height = self._chunk_rect(row, col)
+            chunk = self.chunks[(row, col)] = np.zeros((height, width), np.uint8)
+        elif not chunk.flags.writeable:
+            chunk = self.chunks[(row, col)] = chunk.copy()
+        return chunk
+
+    def _drop_empty(self, keys):
+        for key in keys:
+            chunk = self.chunks.get(key)
+            if chunk is not None and not chunk.any():
+                del self.chunks[key]
+
+    def chunk(self, row, col):
+        # None where nothing is labeled
+        return self.chunks.get((row, col))
+
+    def load_chunk(self, row, col, data):
+        # Saved content, so the chunk is not dirty; `data` is kept as is
+        self.chunks[(row, col)] = data
+
+    def read_region(self, x, y, width, height):
+        region = np.zeros((height, width), np.uint8)
+        for row, col in self._chunk_range(x, y, width, height):
+            chunk = self.chunks.get((row, col))
+            if chunk is None:
+                continue
+            cx, cy, cw, ch = self._chunk_rect(row, col)
+            x0, y0 = max(x, cx), max(y, cy)
+            x1, y1 = min(x + width, cx + cw), min(y + height, cy + ch)
+            region[y0 - y:y1 - y, x0 - x:x1 - x] = chunk[y0 - cy:y1 - cy, x0 - cx:x1 - cx]
+        return region
+
+    def write_region(self, x, y, data):
+        height, width = data.shape
+        keys = self._chunk_range(x, y, width, height)
+        for row, col in keys:
+            cx, cy, cw, ch = self._chunk_rect(row, col)
+            x0, y0 = max(x, cx), max(y, cy)
+            x1, y1 = min(x + width, cx + cw), min(y + height, cy + ch)
+            part = data[y0 - y:y1 - y, x0 - x:x1 - x]
+            if (row, col) not in self.chunks and not part.any():
+                continue
+            self._writable(row, col)[y0 - cy:y1 - cy, x0 - cx:x1 - cx] = part
+        self._drop_empty(keys)
+        self._mark_dirty(keys)
+
+    def labeled_tiles(self, tile_size):
+        # (x, y, width, height, labels) of every tile that holds annotations;
+        # only allocated chunks are looked at
+        if tile_size == self.chunk_size:
+            for row, col in sorted(self.chunks):
+                chunk = self.chunks[(row, col)]
+                if chunk.any():
+                    yield self._chunk_rect(row, col) + (chunk.copy(),)
+            return
+        tiles = set()
+        for row, col in self.chunks:
+            x, y, width, height = self._chunk_rect(row, col)
+            for tile_row in range(y // tile_size, (y + height - 1) // tile_size + 1):
+                for tile_col in range(x // tile_size, (x + width - 1) // tile_size + 1):
+                    tiles.add((tile_row, tile_col))
+        for row, col in sorted(tiles):
+            x, y = col * tile_size, row * tile_size
+            width, height = min(tile_size, self.width - x), min(tile_size, self.height - y)
+            tile_labels = self.read_region(x, y, width, height)
+            if tile_labels.any():
+                yield (x, y, width, height, tile_labels)
+
+    def class_counts(self):
+        # Labeled pixels per class value
+        counts = np.zeros(256, np.int64)
+        for chunk in self.chunks.values():
+            counts += np.bincount(chunk.ravel(), minlength=256)
+        counts[0] = 0
+        return counts
+
+    def class_rects(self, value):
+        # Rects of the chunks that hold `value`
+        return [self._chunk_rect(row, col) for (row, col), chunk in sorted(self.chunks.items())
+                if (chunk == value).any()]
+
+    def clear_class(self, value):
+        # Erases one class everywhere; returns the rect that changed
+        changed = [key for key, chunk in self.chunks.items() if (chunk == value).any()]
+        bounds = None
+        for row, col in changed:
+            chunk = self._writable(row, col)
+            chunk[chunk == value] = 0
+            bounds = union_rect(bounds, self._chunk_rect(row, col))
+        self._drop_empty(changed)
+        self._mark_dirty(changed)
+        return bounds
+
+    def dirty_chunks(self, everything=False):
+        # (row, col, edit, labels) copies of the chunks to save; labels is
+        # None for a chunk that is empty again
+        keys = set(self.chunks) | set(self.dirty) if everything else set(self.dirty)
+        saved = []
+        for row, col in sorted(keys):
+            chunk = self.chunks.get((row, col))
+            saved.append((row, col, self.dirty.get((row, col), 0),
+                          chunk.copy() if chunk is not None else None))
+        return saved
+
+    def mark_saved(self, chunks):
+        # Chunks changed again since their copy was taken stay dirty
+        for row, col, edit, _ in chunks:
+            if self.dirty.get((row, col)) == edit:
+                del self.dirty[(row, col)]
+
+    def sample(self, rows, cols):
+        # Nearest-neighbor lookup of a grid of label pixels; `rows` and
+        # `cols` are ascending
+        samples = np.zeros((len(rows), len(cols)), np.uint8)
+        if not self.chunks or not len(rows) or not len(cols):
+            return samples
+        size = self.chunk_size
+        row_chunks, col_chunks = rows // size, cols // size
+        for row in range(row_chunks[0], row_chunks[-1] + 1):
+            r0, r1 = np.searchsorted(row_chunks, (row, row + 1))
+            if r0 == r1:
+                continue
+            for col in range(col_chunks[0], col_chunks[-1] + 1):
+                chunk = self.chunks.get((row, col))
+                if chunk is None:
+                    continue
+                c0, c1 = np.searchsorted(col_chunks, (col, col + 1))
+                if c0 < c1:
+                    samples[r0:r1, c0:c1] = chunk[np.ix_(rows[r0:r1] - row * size,
+                                                         cols[c0:c1] - col * size)]
+        return samples
+
+    def stroke_bounds(self, p0, p1, radius):
+        return segment_bounds(p0, p1, radius, self.width, self.height)
+
+    @traced("stamp", "annotation")
+    def stamp_segment(self, p0, p1, radius, value):
+        # Value 0 erases; chunks it empties are freed
+        bounds = self.stroke_bounds(p0, p1, radius)
+        if bounds is None:
+            return None
+        mask = segment_mask(p0, p1, radius, bounds)
+        x, y, width, height = bounds
+        keys = self._chunk_range(x, y, width, height)
+        for row, col in keys:
+            if value == 0 and (row, col) not in self.chunks:
+                continue
+            cx, cy, cw, ch = self._chunk_rect(row, col)
+            x0, y0 = max(x, cx), max(y, cy)
+            x1, y1 = min(x + width, cx + cw), min(y + height, cy + ch)
+            part = mask[y0 - y:y1 - y, x0 - x:x1 - x]
+            if part.any():
+                self._writable(row, col)[y0 - cy:y1 - cy, x0 - cx:x1 - cx][part] = value
+        if value == 0:
+            self._drop_empty(keys)
+        self._mark_dirty(keys)
+        return bounds
+
+
+def render_labels(labels, scale, x, y, width, height, lut=None):
+    # Premultiplied RGBA overlay for a rect of the view, where view pixels
+    # are image pixels multiplied by `scale`
+    if lut is None:
+        lut = label_lut()
+    cols = np.minimum(((np.arange(x, x + width) + 0.5) / scale).astype(np.intp), labels.width - 1)
+    rows = np.minimum(((np.arange(y, y + height) + 0.5) / scale).astype(np.intp), labels.height - 1)
+    return lut[labels.sample(rows, cols)]
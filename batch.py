@@ -0,0 +1,197 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from classifier import N_LABELS, PixelClassifier
+from constants import IMAGE_EXTENSIONS, THRESHOLD_MODES
+from image_pyramid import PYRAMID_CACHE_DIR, ImagePyramid
+from processing import WORKERS, pyramid_threshold_levels, threshold_pyramid
+from segmentation import MiniBatchKMeans, sample_pixels, segment_pyramid
+
+PIPELINE_STEPS = ("threshold", "segmentation", "classification")
+
+# Images are the parallel unit in a batch, so each one gets a single core
+# by default; memory per job stays at a few tiles of working buffers
+THREADS_PER_JOB = 1
+
+
+def load_pipeline(path):
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - set(PIPELINE_STEPS)
+    if unknown:
+        raise ValueError(f"Unknown pipeline steps: {', '.join(sorted(unknown))}")
+    mode = config.get("threshold", {}).get("mode", "Manual")
+    if mode not in THRESHOLD_MODES:
+        raise ValueError(f"Unknown threshold mode: {mode}")
+    if "classification" in config:
+        # The model path is relative to the pipeline file
+        model = config["classification"]["model"]
+        config["classification"]["model"] = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                                         model)
+    return config
+
+
+def save_pipeline(path, config, classifier=None):
+    # A trained classifier is stored next to the JSON file
+    config = dict(config)
+    if classifier is not None:
+        model = os.path.splitext(path)[0] + ".classifier.npz"
+        classifier.save(model)
+        config["classification"] = {"model": os.path.basename(model)}
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def find_images(inputs):
+    # Directories contribute their image files, anything else is a glob pattern
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in sorted(os.listdir(item))]
+        else:
+            candidates = sorted(glob.glob(item))
+        paths.extend(path for path in candidates
+                     if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    return list(dict.fromkeys(paths))
+
+
+def output_paths(image_path, config, output_dir):
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return {step: os.path.join(output_dir, f"{stem}.{step}.npy")
+            for step in PIPELINE_STEPS if step in config}
+
+
+def write_result(path, shape, compute):
+    # Written under a temporary name and renamed once complete, so an
+    # interrupted run never leaves an output that looks done
+    partial = path[:-len(".npy")] + ".partial.npy"
+    out = np.lib.format.open_memmap(partial, mode="w+", dtype=np.uint8, shape=shape)
+    try:
+        compute(out)
+        out.flush()
+    except BaseException:
+        del out
+        os.remove(partial)
+        raise
+    del out
+    os.replace(partial, path)
+
+
+def run_image(image_path, config, output_dir, cache_dir=PYRAMID_CACHE_DIR,
+              workers=THREADS_PER_JOB, overwrite=False, keep_pyramid=False):
+    # Run every configured step on one image; steps whose output already
+    # exists are skipped. Returns the per-step timings
+    started = time.perf_counter()
+    outputs = output_paths(image_path, config, output_dir)
+    todo = [step for step in outputs if overwrite or not os.path.exists(outputs[step])]
+    report = {"image": image_path, "skipped": [step for step in outputs if step not in todo],
+              "timings": {}}
+    if not todo:
+        report["total"] = time.perf_counter() - started
+        return report
+
+    # The cache directory is shared with the app and other runs, so a
+    # pyramid that is not kept is built in a private directory; only that
+    # one is removed afterwards
+    t = time.perf_counter()
+    private = not keep_pyramid and not ImagePyramid.cached(image_path, cache_dir)
+    if private:
+        pyramid = ImagePyramid.build(image_path)
+    else:
+        pyramid = ImagePyramid.open(image_path, cache_dir)
+    report["timings"]["load"] = time.perf_counter() - t
+    shape = (pyramid.height, pyramid.width)
+    preview_level = pyramid.level_count - 1
+    try:
+        for step in todo:
+            t = time.perf_counter()
+            settings = config[step]
+            if step == "threshold":
+                per_channel = bool(settings.get("per_channel", False))
+                levels = pyramid_threshold_levels(pyramid, settings.get("mode", "Manual"),
+                                                  settings.get("value", 50), per_channel, workers)
+                write_result(outputs[step], shape, lambda out: threshold_pyramid(
+                    pyramid, levels, per_channel, out, preview_level, workers))
+            elif step == "segmentation":
+                model = MiniBatchKMeans(settings.get("clusters", 3)).fit(sample_pixels(pyramid))
+                write_result(outputs[step], shape, lambda out: segment_pyramid(
+                    pyramid, model.centroids, out, preview_level, workers))
+            elif step == "classification":
+                classifier = PixelClassifier.load(settings["model"])
+                write_result(outputs[step], shape + (N_LABELS,), lambda out:
+                             classifier.predict_pyramid(pyramid, out, preview_level, workers))
+            report["timings"][step] = time.perf_counter() - t
+    finally:
+        pyramid.close(remove=private)
+    report["total"] = time.perf_counter() - started
+    return report
+
+
+def format_report(report):
+    name = os.path.basename(report["image"])
+    if "error" in report:
+        return f"{name}: FAILED ({report['error']})"
+    if not report["timings"]:
+        return f"{name}: skipped, outputs exist"
+    timings = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in report["timings"].items())
+    return f"{name}: {timings}, total {report['total']:.2f}s"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a pipeline saved from the UI over many images without a display.")
+    parser.add_argument("inputs", nargs="+", help="image directories or glob patterns")
+    parser.add_argument("-p", "--pipeline", required=True, help="pipeline JSON file")
+    parser.add_argument("-o", "--output", required=True, help="directory for the .npy results")
+    parser.add_argument("-j", "--jobs", type=int, default=WORKERS,
+                        help="images processed in parallel (default: all cores)")
+    parser.add_argument("--threads", type=int, default=THREADS_PER_JOB,
+                        help="cores each image may use (default: 1)")
+    parser.add_argument("--cache-dir", default=PYRAMID_CACHE_DIR,
+                        help="where decoded image pyramids are stored")
+    parser.add_argument("--keep-pyramids", action="store_true",
+                        help="keep decoded pyramids for later runs")
+    parser.add_argument("--overwrite", action="store_true", help="recompute existing outputs")
+    parser.add_argument("--report", help="write per-image timings to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_pipeline(args.pipeline)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"cannot load pipeline: {e}")
+    images = find_images(args.inputs)
+    if not images:
+        parser.error("no images found")
+    os.makedirs(args.output, exist_ok=True)
+
+    started = time.perf_counter()
+    reports = []
+    with ProcessPoolExecutor(max(1, args.jobs)) as pool:
+        futures = {pool.submit(run_image, path, config, args.output, args.cache_dir,
+                               args.threads, args.overwrite, args.keep_pyramids): path
+                   for path in images}
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except Exception as e:
+                report = {"image": futures[future], "error": str(e)}
+            reports.append(report)
+            print(format_report(report), flush=True)
+
+    failed = sum("error" in report for report in reports)
+    print(f"{len(images)} images in {time.perf_counter() - started:.2f}s, {failed} failed")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(reports, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,532 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# The suite never opens a window; this has to be set before Qt starts
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+from PyQt5.QtCore import PYQT_VERSION_STR, QEvent, QPoint, QT_VERSION_STR, Qt
+from PyQt5.QtGui import QMouseEvent
+from PyQt5.QtWidgets import QApplication
+
+from classifier import PixelClassifier
+from dataset import Dataset
+from features import tile_features
+from ilastik_ui import IlastikUI
+from image_pyramid import TILE_SIZE, ImagePyramid, array_to_qimage
+from processing import allocate_result, pyramid_threshold_levels, remove_result, threshold_pyramid
+from segmentation import MiniBatchKMeans, sample_pixels, segment_pyramid
+
+DEFAULT_SIZES = (1024, 2048, 4096, 8192, 16384, 32768)
+WINDOW_SIZE = (1000, 800)
+
+# Decoding goes through a PNG written first; Qt cannot hold larger images
+DECODE_MAX_SIZE = 8192
+
+# Full-resolution processing is skipped above this many pixels unless
+# raised on the command line; prediction always runs on a few tiles
+PROCESS_MAX_PIXELS = 16384 * 16384
+PREDICT_TILES = 4
+
+# Stroke replay: synthetic strokes in canvas coordinates (0-1), drawn at
+# one screen pixel per image pixel, a few mouse moves per frame
+STROKES = 12
+STROKE_POINTS = 60
+MOVES_PER_FRAME = 4
+BRUSH_SIZE = 20
+ZOOM_STEPS = 10
+PAN_STEPS = 40
+
+# Startup is timed in a fresh interpreter per run, from launch until the
+# window has been shown and painted. The median has to stay under the
+# target, and none of the warm-up modules may have been imported by then
+STARTUP_RUNS = 5
+STARTUP_TARGET_MS = 200
+STARTUP_SCRIPT = """
+import json, sys
+from ilastik_ui import WARM_UP_MODULES, IlastikUI, QApplication
+app = QApplication(sys.argv[:1])
+window = IlastikUI()
+window.resize({width}, {height})
+window.show()
+app.processEvents()
+print(json.dumps(sorted(set(WARM_UP_MODULES) & set(sys.modules))), flush=True)
+"""
+
+# Relative slowdown that --compare reports as a regression
+REGRESSION_THRESHOLD = 0.10
+
+RSS_INTERVAL = 0.002
+
+
+def max_rss():
+    # High-water mark of the whole process in bytes
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def current_rss():
+    # Resident set size in bytes; falls back to the high-water mark where
+    # /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return max_rss()
+
+
+class RSSMonitor:
+    # Peak resident memory while the block runs, sampled on a thread
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def summarize(operation, size, latencies, work, unit, peak_rss):
+    latencies = np.asarray(latencies) * 1000
+    total = latencies.sum() / 1000
+    return {
+        "operation": operation,
+        "size": size,
+        "count": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "max_ms": float(latencies.max()),
+        "throughput": work * len(latencies) / total if total > 0 else None,
+        "throughput_unit": unit,
+        "peak_rss_mb": peak_rss / 2 ** 20,
+    }
+
+
+def measure(operation, size, steps, work=1, unit="ops/s"):
+    # Time each step separately; `work` is what one step processes
+    latencies = []
+    with RSSMonitor() as monitor:
+        for step in steps:
+            started = time.perf_counter()
+            step()
+            latencies.append(time.perf_counter() - started)
+    return summarize(operation, size, latencies, work, unit, monitor.peak)
+
+
+def synthetic_tile(x, y, width, height, size):
+    # Gradient background with a grid of bright discs and some noise; only
+    # depends on the pixel position, so any tile can be made on its own
+    ys, xs = np.mgrid[y:y + height, x:x + width]
+    cell = 96
+    dx = xs % cell - cell / 2
+    dy = ys % cell - cell / 2
+    disc = dx * dx + dy * dy < (cell * 0.3) ** 2
+    noise = np.random.default_rng(x * 7919 + y).integers(0, 24, (height, width), np.uint8)
+    tile = np.empty((height, width, 4), np.uint8)
+    tile[..., 0] = (xs * 160 // size + 40 + noise).astype(np.uint8)
+    tile[..., 1] = (ys * 160 // size + 40 + noise).astype(np.uint8)
+    tile[..., 2] = 60 + noise
+    tile[disc, :3] = 220 + noise[disc, None] // 2
+    tile[..., 3] = 255
+    return tile
+
+
+def synthetic_strokes(count=STROKES, points=STROKE_POINTS, seed=0):
+    # Smooth random curves in canvas coordinates
+    rng = np.random.default_rng(seed)
+    strokes = []
+    for _ in range(count):
+        start = rng.uniform(0.2, 0.8, 2)
+        angle = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.15, points))
+        steps = np.stack([np.cos(angle), np.sin(angle)], axis=1) * 0.005
+        strokes.append(np.clip(start + np.cumsum(steps, axis=0), 0.02, 0.98).tolist())
+    return strokes
+
+
+def mouse_event(kind, pos, button=Qt.LeftButton):
+    return QMouseEvent(kind, pos, button, button, Qt.NoModifier)
+
+
+def open_window(pyramid):
+    # Same path as a finished load job, for an image that only exists as a pyramid
+    window = IlastikUI()
+    window.resize(*WINDOW_SIZE)
+    window.show()
+    QApplication.processEvents()
+    frame = window.image_frame
+    level = pyramid.level_for_size(frame.width(), frame.height())
+    image = array_to_qimage(pyramid.read_level(level)).scaled(
+        frame.width(), frame.height(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    window.process_loaded_image((Dataset([("synthetic", 0)]), 0, pyramid, image))
+    window.scheduler.cancel_all()
+    QApplication.processEvents()
+    return window
+
+
+def bench_build(size, directory):
+    pyramid = None
+
+    def build():
+        nonlocal pyramid
+        pyramid = ImagePyramid.from_tiles(lambda x, y, w, h: synthetic_tile(x, y, w, h, size),
+                                          size, size, os.path.join(directory, "synthetic"))
+
+    result = measure("build", size, [build], size * size / 1e6, "MP/s")
+    return result, pyramid
+
+
+def bench_decode(size, pyramid, directory):
+    path = os.path.join(directory, "synthetic.png")
+    array_to_qimage(pyramid.read_level(0)).save(path)
+    target = os.path.join(directory, "decoded")
+
+    def decode():
+        ImagePyramid.build(path, target).close(remove=True)
+
+    return measure("decode", size, [decode], size * size / 1e6, "MP/s")
+
+
+def bench_strokes(size, window, strokes):
+    # Replays strokes through the window's mouse handlers; each frame is
+    # the queued moves plus the flush and a synchronous repaint
+    frame = window.image_frame
+    window.processing_combo.setCurrentText("Drawing Mode")
+    window.brush_size_slider.setValue(BRUSH_SIZE)
+    window.scale_factor = frame.zoom / frame.view_scale
+    window.update_zoom()
+    frame.repaint()
+
+    def position(point):
+        return QPoint(int(point[0] * frame.width()), int(point[1] * frame.height()))
+
+    def timed(latencies, function):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+
+    def draw(points):
+        for point in points:
+            window.mouse_move(mouse_event(QEvent.MouseMove, position(point)))
+        window.stroke_timer.stop()
+        window.flush_stroke()
+        frame.repaint()
+
+    def release(point):
+        window.mouse_release(mouse_event(QEvent.MouseButtonRelease, position(point)))
+        frame.repaint()
+
+    frames, releases = [], []
+    with RSSMonitor() as monitor:
+        for index, stroke in enumerate(strokes):
+            window.annotation_color.setCurrentIndex(index % 2)
+            timed(frames, lambda: window.mouse_press(
+                mouse_event(QEvent.MouseButtonPress, position(stroke[0]))))
+            for start in range(1, len(stroke), MOVES_PER_FRAME):
+                timed(frames, lambda: draw(stroke[start:start + MOVES_PER_FRAME]))
+            timed(releases, lambda: release(stroke[-1]))
+    return [summarize("stroke_frame", size, frames, 1, "frames/s", monitor.peak),
+            summarize("stroke_release", size, releases, 1, "strokes/s", monitor.peak)]
+
+
+def bench_history(size, window, count):
+    frame = window.image_frame
+
+    def undo():
+        window.undo_action()
+        frame.repaint()
+
+    def redo():
+        window.redo_action()
+        frame.repaint()
+
+    return [measure("undo", size, [undo] * count), measure("redo", size, [redo] * count)]
+
+
+def bench_view(size, window):
+    frame = window.image_frame
+    window.scale_factor = 1.0
+    window.update_zoom()
+
+    def zoom(step):
+        def run():
+            step()
+            frame.repaint()
+        return run
+
+    steps = [zoom(window.zoom_in)] * ZOOM_STEPS + [zoom(window.zoom_out)] * ZOOM_STEPS
+    results = [measure("zoom", size, steps, 1, "frames/s")]
+
+    def refine():
+        frame.refine()
+        frame.repaint()
+
+    window.scale_factor = 3.0
+    window.update_zoom()
+    results.append(measure("zoom_refine", size, [refine], 1, "frames/s"))
+
+    center = QPoint(frame.width() // 2, frame.height() // 2)
+    frame.begin_pan(center)
+
+    def pan(offset):
+        def run():
+            frame.drag_pan(center + QPoint(offset, offset // 2))
+            frame.repaint()
+        return run
+
+    results.append(measure("pan", size, [pan(4 * (i % 20) - 40) for i in range(PAN_STEPS)], 1,
+                           "frames/s"))
+    frame.end_pan()
+    return results
+
+
+def bench_apply(size, window):
+    # The interactive threshold path: display-level preview committed to history
+    window.processing_combo.setCurrentText("Threshold")
+    window.scheduler.cancel_all()
+
+    def apply():
+        window.threshold_preview = None
+        window.apply_processing()
+        window.scheduler.cancel_all()
+        window.image_frame.repaint()
+
+    return measure("apply_threshold", size, [apply] * 5, 1, "ops/s")
+
+
+def bench_processing(size, pyramid, directory, max_pixels):
+    megapixels = size * size / 1e6
+    if size * size > max_pixels:
+        return [{"operation": name, "size": size, "skipped": "above --max-process-pixels"}
+                for name in ("threshold", "segmentation_fit", "segmentation")]
+    results = []
+    mask = allocate_result((size, size), directory)
+
+    def threshold():
+        levels = pyramid_threshold_levels(pyramid, "Otsu", 50, False)
+        threshold_pyramid(pyramid, levels, False, mask, pyramid.level_count - 1)
+
+    results.append(measure("threshold", size, [threshold], megapixels, "MP/s"))
+    remove_result(mask)
+
+    model = MiniBatchKMeans(3)
+    results.append(measure("segmentation_fit", size,
+                           [lambda: model.fit(sample_pixels(pyramid))], 1, "fits/s"))
+    labels = allocate_result((size, size), directory)
+    results.append(measure("segmentation", size, [lambda: segment_pyramid(
+        pyramid, model.centroids, labels, pyramid.level_count - 1)], megapixels, "MP/s"))
+    remove_result(labels)
+    return results
+
+
+def bench_classifier(size, pyramid, labels):
+    # Training on the replayed strokes, then prediction of a few tiles
+    classifier = PixelClassifier()
+    results = [measure("train", size, [lambda: classifier.train(pyramid, labels)], 1,
+                       "fits/s")]
+    tiles = list(pyramid.iter_tiles(0))[:PREDICT_TILES]
+
+    def predict(tile):
+        def run():
+            _, _, x, y, w, h = tile
+            features = tile_features(pyramid, 0, x, y, w, h, classifier.specs)
+            classifier.forest.predict_proba(features.reshape(h * w, -1))
+        return run
+
+    megapixels = TILE_SIZE * TILE_SIZE / 1e6
+    results.append(measure("predict_tile", size, [predict(tile) for tile in tiles], megapixels,
+                           "MP/s"))
+    return results
+
+
+def bench_startup(runs, target_ms):
+    script = STARTUP_SCRIPT.format(width=WINDOW_SIZE[0], height=WINDOW_SIZE[1])
+    directory = os.path.dirname(os.path.abspath(__file__))
+    latencies, eager = [], set()
+    for _ in range(runs):
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", script], cwd=directory,
+                                   stdout=subprocess.PIPE, text=True)
+        line = process.stdout.readline()
+        latencies.append(time.perf_counter() - started)
+        process.communicate()
+        if process.returncode or not line:
+            raise RuntimeError(f"Startup run failed with exit code {process.returncode}")
+        eager.update(json.loads(line))
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result = summarize("startup", 0, latencies, 1, "runs/s",
+                       peak_rss if sys.platform == "darwin" else peak_rss * 1024)
+    result["target_ms"] = target_ms
+    result["eager_modules"] = sorted(eager)
+    return result
+
+
+def run_size(size, strokes, max_pixels, log):
+    directory = tempfile.mkdtemp(prefix="ilastik_bench_")
+    results = []
+    try:
+        log(f"{size} px: building synthetic image")
+        result, pyramid = bench_build(size, directory)
+        results.append(result)
+        if size <= DECODE_MAX_SIZE:
+            log(f"{size} px: decode")
+            results.append(bench_decode(size, pyramid, directory))
+
+        log(f"{size} px: window")
+        window = None
+
+        def open_image():
+            nonlocal window
+            window = open_window(pyramid)
+
+        results.append(measure("open", size, [open_image]))
+        try:
+            log(f"{size} px: strokes, undo, zoom")
+            results += bench_strokes(size, window, strokes)
+            results += bench_history(size, window, len(strokes))
+            results += bench_view(size, window)
+            results.append(bench_apply(size, window))
+            labels = window.labels
+        finally:
+            window.close()
+        log(f"{size} px: processing")
+        results += bench_processing(size, pyramid, directory, max_pixels)
+        results += bench_classifier(size, pyramid, labels)
+        pyramid.close(remove=True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "revision": revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "qt": QT_VERSION_STR,
+        "pyqt": PYQT_VERSION_STR,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def format_result(result):
+    name = f"{result['operation']:<17} {result['size']:>6}"
+    if "skipped" in result:
+        return f"{name}  skipped ({result['skipped']})"
+    throughput = result["throughput"]
+    rate = f"{throughput:10.2f} {result['throughput_unit']}" if throughput else ""
+    return (f"{name}  p50 {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  "
+            f"p99 {result['p99_ms']:9.2f} ms  {rate}  rss {result['peak_rss_mb']:8.1f} MB")
+
+
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    # Median latency change per operation and size; returns the regressions
+    before = {(r["operation"], r["size"]): r for r in previous["results"] if "p50_ms" in r}
+    lines, regressions = [], []
+    for result in current["results"]:
+        key = (result["operation"], result["size"])
+        if "p50_ms" not in result or key not in before or not before[key]["p50_ms"]:
+            continue
+        change = result["p50_ms"] / before[key]["p50_ms"] - 1
+        marker = ""
+        if change > threshold:
+            marker = "  REGRESSION"
+            regressions.append(key)
+        lines.append(f"{key[0]:<17} {key[1]:>6}  {before[key]['p50_ms']:9.2f} -> "
+                     f"{result['p50_ms']:9.2f} ms  {change:+7.1%}{marker}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading, drawing, undo, zoom and processing without a display.")
+    parser.add_argument("--sizes", type=int, nargs="*", default=list(DEFAULT_SIZES),
+                        help="square image sizes in pixels (default: 1024 to 32768)")
+    parser.add_argument("--startup-runs", type=int, default=STARTUP_RUNS,
+                        help=f"fresh launches to time startup over, 0 to skip "
+                             f"(default: {STARTUP_RUNS})")
+    parser.add_argument("--startup-target", type=float, default=STARTUP_TARGET_MS,
+                        help=f"median startup time in ms that fails the run when exceeded "
+                             f"(default: {STARTUP_TARGET_MS})")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                        help="JSON results file (default: benchmark.json)")
+    parser.add_argument("--strokes", help="JSON list of strokes to replay, each a list of "
+                                          "[x, y] canvas positions between 0 and 1")
+    parser.add_argument("--max-process-pixels", type=int, default=PROCESS_MAX_PIXELS,
+                        help="largest image that full-resolution processing runs on")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the results")
+    args = parser.parse_args(argv)
+
+    strokes = synthetic_strokes()
+    if args.strokes:
+        with open(args.strokes) as f:
+            strokes = json.load(f)
+
+    def log(message):
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    report = {"environment": environment(), "results": []}
+    failed = False
+    if args.startup_runs > 0:
+        log("startup")
+        result = bench_startup(args.startup_runs, args.startup_target)
+        report["results"].append(result)
+        print(format_result(result), flush=True)
+        if result["p50_ms"] > args.startup_target or result["eager_modules"]:
+            print(f"Startup over target: {result['p50_ms']:.0f} ms against "
+                  f"{args.startup_target:.0f} ms, imported before the window showed: "
+                  f"{', '.join(result['eager_modules']) or 'none'}")
+            failed = True
+    for size in args.sizes:
+        for result in run_size(size, strokes, args.max_process_pixels, log):
+            report["results"].append(result)
+            print(format_result(result), flush=True)
+    report["peak_rss_mb"] = max_rss() / 2 ** 20
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            lines, regressions = compare(json.load(f), report)
+        print("\n".join(lines))
+        print(f"{len(regressions)} regressions over {REGRESSION_THRESHOLD:.0%}")
+        failed = failed or bool(regressions)
+    app.quit()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
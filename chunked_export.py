@@ -0,0 +1,206 @@
+import json
+import lzma
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+from image_pyramid import TILE_SIZE
+from tracing import count_tiles, traced
+
+EXPORT_FORMATS = ("tiff", "zarr")
+CODECS = ("zlib", "lzma", "none")
+ZLIB_LEVEL = 6
+
+# TIFF compression tags: Adobe deflate and the LZMA2 tag libtiff uses
+TIFF_COMPRESSION = {"none": 1, "zlib": 8, "lzma": 34925}
+TIFF_SHORT, TIFF_ASCII, TIFF_LONG, TIFF_LONG8 = 3, 2, 4, 16
+TIFF_FORMATS = {TIFF_SHORT: "H", TIFF_LONG: "I", TIFF_LONG8: "Q"}
+
+ZARR_COMPRESSORS = {
+    "none": None,
+    "zlib": {"id": "zlib", "level": ZLIB_LEVEL},
+    "lzma": {"id": "lzma", "format": 1, "check": -1, "preset": None, "filters": None},
+}
+
+
+def compress(data, codec):
+    if codec == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == "lzma":
+        return lzma.compress(data)
+    return data
+
+
+def iter_chunks(height, width, chunk_size):
+    for row, y in enumerate(range(0, height, chunk_size)):
+        for col, x in enumerate(range(0, width, chunk_size)):
+            yield row, col, x, y, min(chunk_size, width - x), min(chunk_size, height - y)
+
+
+def padded_chunk(read_chunk, x, y, w, h, chunk_size, shape, dtype):
+    # Edge chunks are stored full size in both formats, padded with zeros
+    data = np.asarray(read_chunk(x, y, w, h), dtype)
+    if data.shape[:2] == (chunk_size, chunk_size):
+        return np.ascontiguousarray(data)
+    chunk = np.zeros((chunk_size, chunk_size) + tuple(shape[2:]), dtype)
+    chunk[:h, :w] = data
+    return chunk
+
+
+def tiff_entry(tag, kind, values):
+    # 20-byte BigTIFF IFD entry; values that do not fit in 8 bytes are
+    # returned separately and stored after the IFD
+    if kind == TIFF_ASCII:
+        data = values.encode("ascii", "replace") + b"\0"
+        count = len(data)
+    else:
+        values = list(values)
+        count = len(values)
+        data = struct.pack(f"<{count}{TIFF_FORMATS[kind]}", *values)
+    if len(data) <= 8:
+        return struct.pack("<HHQ", tag, kind, count) + data.ljust(8, b"\0"), None
+    return struct.pack("<HHQ", tag, kind, count), data
+
+
+def write_tiff(path, shape, dtype, read_chunk, chunk_size=TILE_SIZE, codec="zlib", rgb=False,
+               description=None, progress=None, cancelled=None):
+    # Tiled BigTIFF written tile by tile; the IFD with the tile offsets goes
+    # at the end and the header is patched to point at it
+    height, width = shape[:2]
+    samples = shape[2] if len(shape) > 2 else 1
+    dtype = np.dtype(dtype)
+    offsets, counts = [], []
+    chunks = list(iter_chunks(height, width, chunk_size))
+    count_tiles(len(chunks))
+    with open(path, "wb") as f:
+        f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        for done, (_, _, x, y, w, h) in enumerate(chunks, start=1):
+            if cancelled and cancelled():
+                raise InterruptedError("Export cancelled")
+            chunk = padded_chunk(read_chunk, x, y, w, h, chunk_size, shape, dtype)
+            data = compress(chunk.astype(dtype.newbyteorder("<"), copy=False).tobytes(), codec)
+            offsets.append(f.tell())
+            counts.append(len(data))
+            f.write(data)
+            if progress:
+                progress(done, len(chunks))
+
+        if f.tell() % 2:
+            f.write(b"\0")
+        extra = samples - (3 if rgb else 1)
+        sample_format = 3 if dtype.kind == "f" else 2 if dtype.kind == "i" else 1
+        tags = [
+            (256, TIFF_LONG, [width]),
+            (257, TIFF_LONG, [height]),
+            (258, TIFF_SHORT, [dtype.itemsize * 8] * samples),
+            (259, TIFF_SHORT, [TIFF_COMPRESSION[codec]]),
+            (262, TIFF_SHORT, [2 if rgb else 1]),
+            (277, TIFF_SHORT, [samples]),
+            (284, TIFF_SHORT, [1]),
+            (322, TIFF_LONG, [chunk_size]),
+            (323, TIFF_LONG, [chunk_size]),
+            (324, TIFF_LONG8, offsets),
+            (325, TIFF_LONG8, counts),
+            (339, TIFF_SHORT, [sample_format] * samples),
+        ]
+        if description:
+            tags.append((270, TIFF_ASCII, description))
+        if extra > 0:
+            # An RGB image's fourth sample is unassociated alpha
+            tags.append((338, TIFF_SHORT, [2 if rgb else 0] + [0] * (extra - 1)))
+        tags.sort()
+
+        ifd_offset = f.tell()
+        data_offset = ifd_offset + 8 + 20 * len(tags) + 8
+        entries, blobs = [], []
+        for tag, kind, values in tags:
+            entry, blob = tiff_entry(tag, kind, values)
+            if blob is not None:
+                entry += struct.pack("<Q", data_offset)
+                blobs.append(blob)
+                data_offset += len(blob) + len(blob) % 2
+            entries.append(entry)
+        f.write(struct.pack("<Q", len(entries)) + b"".join(entries) + struct.pack("<Q", 0))
+        for blob in blobs:
+            f.write(blob + b"\0" * (len(blob) % 2))
+        f.seek(8)
+        f.write(struct.pack("<Q", ifd_offset))
+
+
+def write_zarr(path, shape, dtype, read_chunk, chunk_size=TILE_SIZE, codec="zlib",
+               attributes=None, progress=None, cancelled=None):
+    # Zarr v2 directory store, one file per chunk; chunks that are all
+    # zero are left out and read back as the fill value
+    dtype = np.dtype(dtype)
+    os.makedirs(path)
+    meta = {
+        "zarr_format": 2,
+        "shape": list(shape),
+        "chunks": [chunk_size, chunk_size] + list(shape[2:]),
+        "dtype": dtype.newbyteorder("<").str if dtype.itemsize > 1 else dtype.str,
+        "compressor": ZARR_COMPRESSORS[codec],
+        "fill_value": 0,
+        "order": "C",
+        "filters": None,
+        "dimension_separator": ".",
+    }
+    with open(os.path.join(path, ".zarray"), "w") as f:
+        json.dump(meta, f, indent=2)
+    if attributes:
+        with open(os.path.join(path, ".zattrs"), "w") as f:
+            json.dump(attributes, f, indent=2)
+
+    chunks = list(iter_chunks(shape[0], shape[1], chunk_size))
+    count_tiles(len(chunks))
+    suffix = ".0" if len(shape) > 2 else ""
+    for done, (row, col, x, y, w, h) in enumerate(chunks, start=1):
+        if cancelled and cancelled():
+            raise InterruptedError("Export cancelled")
+        chunk = padded_chunk(read_chunk, x, y, w, h, chunk_size, shape, dtype)
+        if chunk.any():
+            data = compress(chunk.astype(dtype.newbyteorder("<"), copy=False).tobytes(), codec)
+            with open(os.path.join(path, f"{row}.{col}{suffix}"), "wb") as f:
+                f.write(data)
+        if progress:
+            progress(done, len(chunks))
+
+
+@traced("export", "export")
+def export_array(path, export_format, shape, dtype, read_chunk, chunk_size=TILE_SIZE,
+                 codec="zlib", rgb=False, attributes=None, progress=None, cancelled=None):
+    # Streams one array to `path`, reading it through read_chunk(x, y, w, h).
+    # Only one chunk is held at a time. The output appears under its final
+    # name only once complete
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec: {codec}")
+    partial = path + ".partial"
+    try:
+        if export_format == "tiff":
+            description = json.dumps(attributes) if attributes else None
+            write_tiff(partial, shape, dtype, read_chunk, chunk_size, codec, rgb, description,
+                       progress, cancelled)
+        elif export_format == "zarr":
+            write_zarr(partial, shape, dtype, read_chunk, chunk_size, codec, attributes,
+                       progress, cancelled)
+        else:
+            raise ValueError(f"Unknown export format: {export_format}")
+    except BaseException:
+        remove_output(partial)
+        raise
+    remove_output(path)
+    os.replace(partial, path)
+
+
+def remove_output(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def output_path(directory, stem, name, export_format):
+    extension = ".tif" if export_format == "tiff" else ".zarr"
+    return os.path.join(directory, f"{stem}.{name}{extension}")
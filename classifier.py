@@ -0,0 +1,323 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from annotation_layer import LABEL_COLORS
+from features import feature_specs, tile_features
+from image_pyramid import downsample
+from processing import allocate_result, process_pool, remove_result
+from tracing import count_tiles, traced
+
+N_TREES = 32
+MAX_DEPTH = 12
+MIN_SAMPLES_LEAF = 2
+N_BINS = 64
+MAX_SAMPLES_PER_CLASS = 20000
+
+# Samples walked down a tree together; small enough for their feature rows
+# to stay in cache
+APPLY_BLOCK = 8192
+WORKERS = os.cpu_count() or 1
+
+# One probability channel per annotation label, stored as uint8 (0-255)
+N_LABELS = len(LABEL_COLORS)
+
+
+class DecisionTree:
+    # Flat node arrays; leaves have feature == -1
+    def __init__(self, feature, threshold, left, right, value):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self._walk = None
+
+    @property
+    def depth(self):
+        depth = np.zeros(len(self.feature), np.int32)
+        for node in range(len(self.feature)):
+            if self.feature[node] >= 0:
+                depth[self.left[node]] = depth[self.right[node]] = depth[node] + 1
+        return int(depth.max())
+
+    def _walk_arrays(self):
+        # Node arrays where leaves loop onto themselves with an infinite
+        # threshold, so samples that reached a leaf can keep stepping
+        if self._walk is None:
+            leaf = self.feature < 0
+            nodes = np.arange(len(self.feature), dtype=np.int32)
+            self._walk = (np.where(leaf, 0, self.feature).astype(np.intp),
+                          np.where(leaf, np.inf, self.threshold).astype(np.float32),
+                          np.where(leaf, nodes, self.left), np.where(leaf, nodes, self.right),
+                          ~leaf)
+        return self._walk
+
+    def apply(self, features, block=APPLY_BLOCK):
+        # Walk a block of samples down the tree at once, one level per step,
+        # until all of them are at leaves. Features are read column-wise, the
+        # layout tile_features produces
+        feature, threshold, left, right, inner = self._walk_arrays()
+        n_samples = len(features)
+        columns = np.ascontiguousarray(features.T, np.float32).ravel()
+        node = np.zeros(n_samples, np.int32)
+        for start in range(0, n_samples, block):
+            stop = min(n_samples, start + block)
+            samples = np.arange(start, stop)
+            current = node[start:stop]
+            while inner.take(current).any():
+                go_left = columns.take(feature.take(current) * n_samples + samples) \
+                    <= threshold.take(current)
+                current = np.where(go_left, left.take(current), right.take(current))
+            node[start:stop] = current
+        return node
+
+    def predict_proba(self, features):
+        return self.value[self.apply(features)]
+
+
+def fit_tree(binned, labels, edges, n_classes, seed, max_depth=MAX_DEPTH,
+             min_samples_leaf=MIN_SAMPLES_LEAF):
+    # CART on pre-binned features: every split candidate of a node is scored
+    # from one joint histogram of (feature, bin, class)
+    rng = np.random.default_rng(seed)
+    n_samples, n_features = binned.shape
+    n_bins = edges.shape[1] + 1
+    n_candidates = max(1, int(np.sqrt(n_features)))
+    feature, threshold, left, right, value = [], [], [], [], []
+
+    def new_node():
+        feature.append(-1)
+        threshold.append(0.0)
+        left.append(-1)
+        right.append(-1)
+        value.append(None)
+        return len(feature) - 1
+
+    stack = [(new_node(), rng.integers(0, n_samples, n_samples), 0)]
+    while stack:
+        node, index, depth = stack.pop()
+        y = labels[index]
+        counts = np.bincount(y, minlength=n_classes)
+        value[node] = counts / len(index)
+        if depth >= max_depth or len(index) < 2 * min_samples_leaf or counts.max() == len(index):
+            continue
+
+        candidates = rng.choice(n_features, n_candidates, replace=False)
+        keys = (np.arange(n_candidates) * n_bins + binned[index][:, candidates]) * n_classes
+        hist = np.bincount((keys + y[:, None]).ravel(), minlength=n_candidates * n_bins * n_classes)
+        left_counts = np.cumsum(hist.reshape(n_candidates, n_bins, n_classes), axis=1)
+        right_counts = counts - left_counts
+        n_left = left_counts.sum(axis=2)
+        n_right = len(index) - n_left
+        with np.errstate(divide="ignore", invalid="ignore"):
+            impurity = (n_left - (left_counts ** 2).sum(axis=2) / n_left
+                        + n_right - (right_counts ** 2).sum(axis=2) / n_right)
+        impurity[(n_left < min_samples_leaf) | (n_right < min_samples_leaf)] = np.inf
+        best = np.argmin(impurity)
+        if not np.isfinite(impurity.flat[best]):
+            continue
+
+        candidate, split_bin = np.unravel_index(best, impurity.shape)
+        split_feature = candidates[candidate]
+        go_left = binned[index, split_feature] <= split_bin
+        feature[node] = split_feature
+        threshold[node] = edges[split_feature, split_bin]
+        left[node], right[node] = new_node(), new_node()
+        stack.append((left[node], index[go_left], depth + 1))
+        stack.append((right[node], index[~go_left], depth + 1))
+
+    return DecisionTree(np.array(feature, np.int32), np.array(threshold, np.float32),
+                        np.array(left, np.int32), np.array(right, np.int32),
+                        np.array(value, np.float32))
+
+
+def fit_mapped_tree(binned_path, labels_path, *args):
+    # Runs in a worker process on the training set the forest wrote once;
+    # plain array views skip the memmap subclass overhead on every index
+    return fit_tree(np.asarray(np.load(binned_path, mmap_mode="r")),
+                    np.asarray(np.load(labels_path, mmap_mode="r")), *args)
+
+
+class RandomForest:
+    def __init__(self, n_trees=N_TREES, max_depth=MAX_DEPTH, min_samples_leaf=MIN_SAMPLES_LEAF,
+                 n_bins=N_BINS, seed=0):
+        self.n_trees = n_trees
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.n_bins = n_bins
+        self.seed = seed
+        self.classes = None
+        self.trees = []
+
+    @traced("forest fit", "classifier")
+    def fit(self, features, labels, workers=WORKERS):
+        self.classes = np.unique(labels)
+        if len(self.classes) < 2:
+            raise ValueError("Training needs annotations of at least two classes")
+        y = np.searchsorted(self.classes, labels)
+
+        # Quantile bins per feature; bin b holds values <= edges[:, b]
+        quantiles = np.linspace(0, 1, self.n_bins + 1)[1:-1]
+        edges = np.quantile(features, quantiles, axis=0).T.astype(np.float32)
+        binned = allocate_result(features.shape)
+        targets = allocate_result(y.shape, dtype=y.dtype)
+        try:
+            for f in range(features.shape[1]):
+                binned[:, f] = np.searchsorted(edges[f], features[:, f], side="left")
+            targets[:] = y
+            binned.flush()
+            targets.flush()
+            pool = process_pool(workers)
+            futures = [pool.submit(fit_mapped_tree, binned.filename, targets.filename, edges,
+                                   len(self.classes), self.seed + i, self.max_depth,
+                                   self.min_samples_leaf) for i in range(self.n_trees)]
+            self.trees = [future.result() for future in futures]
+        finally:
+            remove_result(binned)
+            remove_result(targets)
+        return self
+
+    @traced("forest predict", "classifier")
+    def predict_proba(self, features):
+        probabilities = np.zeros((len(features), len(self.classes)), np.float32)
+        for tree in self.trees:
+            probabilities += tree.predict_proba(features)
+        return probabilities / len(self.trees)
+
+
+def probability_colors(probabilities):
+    # Mix the label colors by class probability, like ilastik's prediction overlay
+    colors = np.array(LABEL_COLORS, np.float32)
+    rgb = probabilities.astype(np.float32) @ colors / 255.0
+    rgba = np.empty(probabilities.shape[:-1] + (4,), np.uint8)
+    rgba[..., :3] = np.clip(rgb, 0, 255)
+    rgba[..., 3] = 255
+    return rgba
+
+
+class PixelClassifier:
+    # Filter bank features plus a random forest trained on the brush labels.
+    # Tile work runs on threads so every tile shares one FeatureCache; the
+    # filters are numpy-bound and release the GIL
+    def __init__(self, specs=None, forest=None, cache=None):
+        self.specs = specs or feature_specs()
+        self.forest = forest or RandomForest()
+        self.cache = cache
+
+    @property
+    def trained(self):
+        return bool(self.forest.trees)
+
+    @traced("training data", "classifier")
+    def training_data(self, slices, workers=WORKERS, seed=0):
+        # `slices` pairs each pyramid with its labeled tiles, as
+        # LabelLayer.labeled_tiles yields them
+        def tile_samples(tile):
+            # Features of the annotated pixels of one tile
+            pyramid, (x, y, w, h, tile_labels) = tile
+            features = tile_features(pyramid, 0, x, y, w, h, self.specs, self.cache)
+            ys, xs = np.nonzero(tile_labels)
+            return features[ys, xs], tile_labels[ys, xs]
+
+        tiles = [(pyramid, tile) for pyramid, labeled in slices for tile in labeled]
+        count_tiles(len(tiles))
+        with ThreadPoolExecutor(workers) as pool:
+            samples = list(pool.map(tile_samples, tiles))
+        if not samples:
+            raise ValueError("Draw some annotations before training")
+        features = np.concatenate([s[0] for s in samples])
+        values = np.concatenate([s[1] for s in samples])
+
+        # Cap the samples per class so one heavily painted class cannot dominate
+        rng = np.random.default_rng(seed)
+        keep = []
+        for value in np.unique(values):
+            index = np.flatnonzero(values == value)
+            if len(index) > MAX_SAMPLES_PER_CLASS:
+                index = rng.choice(index, MAX_SAMPLES_PER_CLASS, replace=False)
+            keep.append(index)
+        keep = np.concatenate(keep)
+        return features[keep], values[keep]
+
+    def train(self, pyramid, labels, workers=WORKERS):
+        return self.train_slices([(pyramid, labels)], workers)
+
+    def train_slices(self, slices, workers=WORKERS):
+        # `slices` pairs each pyramid with its label layer
+        return self.train_tiles([(pyramid, labels.labeled_tiles(pyramid.tile_size))
+                                 for pyramid, labels in slices], workers)
+
+    def train_tiles(self, slices, workers=WORKERS):
+        features, values = self.training_data(slices, workers)
+        self.forest.fit(features, values, workers)
+        return self
+
+    def save(self, path):
+        # Plain arrays, so loading a model never unpickles anything
+        trees = self.forest.trees
+        arrays = {name: np.concatenate([getattr(tree, name) for tree in trees])
+                  for name in ("feature", "threshold", "left", "right", "value")}
+        arrays["offsets"] = np.cumsum([0] + [len(tree.feature) for tree in trees])
+        arrays["classes"] = self.forest.classes
+        arrays["specs"] = np.array(json.dumps(self.specs))
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path, cache=None):
+        with np.load(path) as data:
+            specs = [(name, sigma) for name, sigma in json.loads(str(data["specs"]))]
+            forest = RandomForest()
+            forest.classes = data["classes"]
+            offsets = data["offsets"]
+            forest.trees = [
+                DecisionTree(*(data[name][start:end] for name in
+                               ("feature", "threshold", "left", "right", "value")))
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+        return cls(specs, forest, cache)
+
+    def predict_tile(self, pyramid, x, y, width, height):
+        # uint8 probabilities of one full-resolution rect, (h, w, N_LABELS).
+        # Only reads the cache: the labeled tiles are in it from training,
+        # and filling it with every predicted tile would evict them
+        features = tile_features(pyramid, 0, x, y, width, height, self.specs, self.cache,
+                                 store=False)
+        probabilities = np.zeros((height * width, N_LABELS), np.float32)
+        probabilities[:, self.forest.classes - 1] = \
+            self.forest.predict_proba(features.reshape(height * width, -1))
+        return np.round(probabilities * 255).astype(np.uint8).reshape(height, width, N_LABELS)
+
+    @traced("predict", "classifier")
+    def predict_pyramid(self, pyramid, out, preview_level=0, workers=WORKERS,
+                        progress=None, cancelled=None):
+        # Probabilities for every full-resolution pixel, tile by tile on all
+        # cores; returns the colored prediction at `preview_level`
+        tiles = list(pyramid.iter_tiles(0))
+        count_tiles(len(tiles))
+        preview_height, preview_width = pyramid.level_shape(preview_level)
+        preview = np.zeros((preview_height, preview_width, 4), np.uint8)
+        factor = 2 ** preview_level
+
+        def predict_tile(tile):
+            if cancelled and cancelled():
+                return
+            row, col, x, y, w, h = tile
+            probabilities = self.predict_tile(pyramid, x, y, w, h)
+            out[y:y + h, x:x + w] = probabilities
+            rendered = probability_colors(probabilities)
+            for _ in range(preview_level):
+                rendered = downsample(rendered)
+            px, py = x // factor, y // factor
+            preview[py:py + rendered.shape[0], px:px + rendered.shape[1]] = rendered
+
+        with ThreadPoolExecutor(workers) as pool:
+            for done, _ in enumerate(pool.map(predict_tile, tiles), start=1):
+                if progress:
+                    progress(int(100 * done / len(tiles)))
+        if cancelled and cancelled():
+            raise InterruptedError("Prediction cancelled")
+        return preview
@@ -0,0 +1,10 @@
+# Names the window needs before any image is open. Nothing here may import
+# numpy or the processing modules, which load after the window is shown
+
+# Label values match the entries of the annotation color combo box; 0 is unlabeled
+LABEL_NAMES = ["Green (Foreground)", "Red (Background)", "Blue (Object)"]
+LABEL_COLORS = [(0, 255, 0), (255, 0, 0), (0, 0, 255)]
+
+THRESHOLD_MODES = ["Manual", "Otsu", "Iterative (auto)"]
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
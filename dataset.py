@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtGui import QImageReader
+
+from image_pyramid import PYRAMID_CACHE_DIR, ImagePyramid
+from tracing import traced
+
+# Open slice pyramids kept around; decoded slices stay in the pyramid cache
+# on disk, so an evicted slice reopens without decoding again
+SLICE_CACHE_SIZE = 8
+
+# Slices on each side of the current one decoded ahead of time
+PREFETCH_RADIUS = 2
+
+SEQUENCE_PATTERN = re.compile(r"^(.*?)(\d+)$")
+
+
+def find_sequence(image_path):
+    # Files next to `image_path` that differ from it only in a trailing
+    # number, in numeric order: img_001.png, img_002.png, ... The name must
+    # have a prefix before the number, and a zero-padded number only matches
+    # numbers of the same width, so unrelated files are not stacked
+    directory, name = os.path.split(os.path.abspath(image_path))
+    stem, extension = os.path.splitext(name)
+    match = SEQUENCE_PATTERN.match(stem)
+    if not match or not match.group(1):
+        return [image_path]
+    prefix, digits = match.groups()
+    candidates = []
+    for candidate in os.listdir(directory):
+        candidate_stem, candidate_extension = os.path.splitext(candidate)
+        if candidate_extension.lower() != extension.lower():
+            continue
+        candidate_match = SEQUENCE_PATTERN.match(candidate_stem)
+        if candidate_match and candidate_match.group(1) == prefix:
+            candidates.append((candidate_match.group(2), os.path.join(directory, candidate)))
+    # A zero-padded sequence keeps one width; unpadded numbers may grow but
+    # not into the width of a padded sequence
+    padded = {len(number) for number, _ in candidates if zero_padded(number)}
+    numbered = [(int(number), path) for number, path in candidates
+                if (len(number) == len(digits) if len(digits) in padded
+                    else len(number) not in padded)]
+    return [path for _, path in sorted(numbered)]
+
+
+def zero_padded(digits):
+    return len(digits) > 1 and digits[0] == "0"
+
+
+class Dataset:
+    # An image, a multi-page TIFF or a numbered image sequence as a stack of
+    # 2D slices. Slices are decoded on first use and shared between threads
+    def __init__(self, slices, cache_dir=PYRAMID_CACHE_DIR, cache_size=SLICE_CACHE_SIZE):
+        self.slices = slices
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, image_path, cache_dir=PYRAMID_CACHE_DIR):
+        reader = QImageReader(image_path)
+        pages = reader.imageCount()
+        if pages > 1:
+            return cls([(image_path, page) for page in range(pages)], cache_dir)
+        return cls([(path, 0) for path in find_sequence(image_path)], cache_dir)
+
+    def __len__(self):
+        return len(self.slices)
+
+    @property
+    def path(self):
+        return self.slices[0][0]
+
+    @property
+    def multipage(self):
+        return len(self.slices) > 1 and self.slices[0][0] == self.slices[-1][0]
+
+    def slice_name(self, index):
+        path, page = self.slices[index]
+        name = os.path.basename(path)
+        return f"{name} page {page + 1}" if self.multipage else name
+
+    def slice_stem(self, index):
+        path, page = self.slices[index]
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return f"{stem}_page{page + 1}" if self.multipage else stem
+
+    def cached(self, index):
+        with self._lock:
+            return index in self._cache
+
+    @traced("load slice", "load")
+    def load_slice(self, index, progress=None, cancelled=None):
+        # One thread decodes a slice while any others asking for it wait
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                pyramid = self._cache[index]
+                if progress:
+                    progress(100)
+                return pyramid
+            lock = self._loading.setdefault(index, threading.Lock())
+        with lock:
+            with self._lock:
+                pyramid = self._cache.get(index)
+            if pyramid is None:
+                path, page = self.slices[index]
+                pyramid = ImagePyramid.open(path, self.cache_dir, progress=progress,
+                                            cancelled=cancelled, page=page)
+                with self._lock:
+                    self._cache[index] = pyramid
+                    self._loading.pop(index, None)
+                    # Evicted pyramids are only dropped, not closed: whoever
+                    # still holds one keeps using its memory maps
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+            elif progress:
+                progress(100)
+        return pyramid
+
+    def neighbors(self, index, radius=PREFETCH_RADIUS):
+        # Nearest first, alternating ahead and behind
+        order = []
+        for distance in range(1, radius + 1):
+            for candidate in (index + distance, index - distance):
+                if 0 <= candidate < len(self.slices):
+                    order.append(candidate)
+        return order
@@ -0,0 +1,84 @@
+import os
+
+from PyQt5.QtWidgets import (QCheckBox, QComboBox, QDialog, QDialogButtonBox, QFileDialog,
+                             QGridLayout, QGroupBox, QHBoxLayout, QLabel, QLineEdit, QPushButton,
+                             QVBoxLayout)
+
+from chunked_export import CODECS, EXPORT_FORMATS
+
+FORMAT_NAMES = {"tiff": "Tiled BigTIFF (.tif)", "zarr": "Chunked zarr directory (.zarr)"}
+
+
+class ExportDialog(QDialog):
+    # Picks the outputs, format, codec and destination for a result export;
+    # `outputs` maps each output name to whether it is available yet
+    def __init__(self, outputs, directory, stem, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Export Results")
+        layout = QVBoxLayout(self)
+
+        outputs_group = QGroupBox("Outputs")
+        outputs_layout = QVBoxLayout(outputs_group)
+        layout.addWidget(outputs_group)
+        self.output_checks = {}
+        for name, available in outputs.items():
+            check = QCheckBox(name.capitalize())
+            check.setEnabled(available)
+            check.setChecked(available)
+            check.toggled.connect(self.update_buttons)
+            outputs_layout.addWidget(check)
+            self.output_checks[name] = check
+
+        options = QGridLayout()
+        layout.addLayout(options)
+        options.addWidget(QLabel("Format:"), 0, 0)
+        self.format_combo = QComboBox()
+        for export_format in EXPORT_FORMATS:
+            self.format_combo.addItem(FORMAT_NAMES[export_format], export_format)
+        options.addWidget(self.format_combo, 0, 1, 1, 2)
+
+        options.addWidget(QLabel("Codec:"), 1, 0)
+        self.codec_combo = QComboBox()
+        self.codec_combo.addItems(CODECS)
+        options.addWidget(self.codec_combo, 1, 1, 1, 2)
+
+        options.addWidget(QLabel("Folder:"), 2, 0)
+        self.directory_edit = QLineEdit(directory)
+        options.addWidget(self.directory_edit, 2, 1)
+        browse_button = QPushButton("Browse...")
+        browse_button.clicked.connect(self.browse)
+        options.addWidget(browse_button, 2, 2)
+
+        options.addWidget(QLabel("Name:"), 3, 0)
+        self.stem_edit = QLineEdit(stem)
+        options.addWidget(self.stem_edit, 3, 1, 1, 2)
+
+        button_row = QHBoxLayout()
+        layout.addLayout(button_row)
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.buttons.button(QDialogButtonBox.Ok).setText("Export")
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+        button_row.addWidget(self.buttons)
+        self.update_buttons()
+
+    def browse(self):
+        directory = QFileDialog.getExistingDirectory(self, "Export Folder",
+                                                     self.directory_edit.text())
+        if directory:
+            self.directory_edit.setText(directory)
+
+    def update_buttons(self):
+        self.buttons.button(QDialogButtonBox.Ok).setEnabled(bool(self.selected_outputs()))
+
+    def selected_outputs(self):
+        return [name for name, check in self.output_checks.items() if check.isChecked()]
+
+    def settings(self):
+        return {
+            "outputs": self.selected_outputs(),
+            "format": self.format_combo.currentData(),
+            "codec": self.codec_combo.currentText(),
+            "directory": os.path.expanduser(self.directory_edit.text()),
+            "stem": self.stem_edit.text() or "result",
+        }
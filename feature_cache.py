@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MEMORY_BUDGET = 512 * 1024 * 1024
+DISK_BUDGET = 4 * 1024 * 1024 * 1024
+
+
+class FeatureCache:
+    # Per-tile filter responses keyed by source image, pyramid level, tile
+    # rect, filter and scale. The least recently used entries beyond the
+    # memory budget are dropped, or spilled to memory-mapped .npy files in
+    # `directory` when one is given. Safe to share between worker threads
+    def __init__(self, memory_budget=MEMORY_BUDGET, directory=None, disk_budget=DISK_BUDGET):
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self.disk_budget = disk_budget
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(pyramid, level, x, y, width, height, name, sigma):
+        return (pyramid.source_key, level, x, y, width, height, name, float(sigma))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory.keys() | self._disk.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    def get(self, key):
+        # Cached response (read-only) or None; spilled entries come back memory-mapped
+        with self._lock:
+            array = self._memory.get(key)
+            if array is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return array
+            entry = self._disk.get(key)
+            if entry is not None:
+                self._disk.move_to_end(key)
+                self.disk_hits += 1
+                return np.load(entry[0], mmap_mode="r")
+            self.misses += 1
+            return None
+
+    def put(self, key, array):
+        array = np.ascontiguousarray(array)
+        array.setflags(write=False)
+        spilled = []
+        with self._lock:
+            if key in self._memory:
+                self.memory_bytes -= self._memory.pop(key).nbytes
+            self._memory[key] = array
+            self.memory_bytes += array.nbytes
+            while self.memory_bytes > self.memory_budget and self._memory:
+                old_key, old = self._memory.popitem(last=False)
+                self.memory_bytes -= old.nbytes
+                self.evictions += 1
+                if self.directory is not None:
+                    spilled.append((old_key, old))
+        # Files are written without the lock so other threads keep hitting
+        # memory meanwhile; a lookup of an entry being spilled is a miss
+        for old_key, old in spilled:
+            self._spill(old_key, old)
+
+    def _spill(self, key, array):
+        if array.nbytes > self.disk_budget:
+            return
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                return
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, f"{name}.npy")
+        partial = f"{path}.{threading.get_ident()}.partial"
+        with open(partial, "wb") as f:
+            np.save(f, array)
+        os.replace(partial, path)
+        removed = []
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                return
+            self._disk[key] = (path, array.nbytes)
+            self.disk_bytes += array.nbytes
+            while self.disk_bytes > self.disk_budget:
+                _, (old_path, nbytes) = self._disk.popitem(last=False)
+                self.disk_bytes -= nbytes
+                removed.append(old_path)
+        # Readers that still map a file keep their pages on POSIX
+        for old_path in removed:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.memory_bytes = 0
+            for path, _ in self._disk.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._disk.clear()
+            self.disk_bytes = 0
+
+    def close(self):
+        self.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
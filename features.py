@@ -0,0 +1,193 @@
+import math
+
+import numpy as np
+
+from tracing import traced
+
+SCALES = (0.7, 1.6, 3.5, 5.0)
+FILTERS = ("gaussian_smoothing", "laplacian_of_gaussian", "gradient_magnitude",
+           "structure_tensor_eigenvalues", "hessian_of_gaussian_eigenvalues")
+
+# Output channels per input channel for every filter
+FILTER_OUTPUTS = {
+    "gaussian_smoothing": 1,
+    "laplacian_of_gaussian": 1,
+    "gradient_magnitude": 1,
+    "structure_tensor_eigenvalues": 2,
+    "hessian_of_gaussian_eigenvalues": 2,
+}
+
+# Kernel radius in standard deviations
+WINDOW = 3.5
+
+# The structure tensor smooths its gradient products at this fraction of the scale
+OUTER_SCALE = 0.5
+
+
+def feature_specs(filters=FILTERS, scales=SCALES):
+    return [(name, sigma) for name in filters for sigma in scales]
+
+
+def feature_count(specs, channels=3):
+    return sum(FILTER_OUTPUTS[name] for name, _ in specs) * channels
+
+
+def feature_halo(specs):
+    # Border needed around a tile so that every response inside it is exact
+    halo = 0
+    for name, sigma in specs:
+        radius = math.ceil(WINDOW * sigma)
+        if name == "structure_tensor_eigenvalues":
+            radius += math.ceil(WINDOW * OUTER_SCALE * sigma)
+        halo = max(halo, radius)
+    return halo
+
+
+def gaussian_kernel(sigma, order=0):
+    # Sampled Gaussian (derivative) kernel, normalized so it reproduces the
+    # exact response on constant, linear and quadratic signals
+    radius = max(1, math.ceil(WINDOW * sigma))
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    g = np.exp(-x * x / (2.0 * sigma * sigma))
+    if order == 0:
+        kernel = g / g.sum()
+    elif order == 1:
+        kernel = x * g
+        kernel /= (kernel * x).sum()
+    else:
+        kernel = (x * x - sigma * sigma) * g
+        kernel -= kernel.mean()
+        kernel /= (kernel * x * x / 2.0).sum()
+    return kernel.astype(np.float32)
+
+
+def convolve1d(data, kernel, axis):
+    # Correlation along one axis with reflected borders; output has the input
+    # shape. Gaussian kernels are (anti)symmetric, so mirrored taps share a multiply
+    radius = len(kernel) // 2
+    pad = [(0, 0)] * data.ndim
+    pad[axis] = (radius, radius)
+    padded = np.pad(data, pad, mode="reflect")
+    size = data.shape[axis]
+    sign = 1.0 if kernel[0] == kernel[-1] else -1.0
+
+    def taps(k):
+        index = [slice(None)] * data.ndim
+        index[axis] = slice(k, k + size)
+        return padded[tuple(index)]
+
+    out = kernel[radius] * taps(radius)
+    pair = np.empty(data.shape, np.float32)
+    for k in range(radius):
+        if sign > 0:
+            np.add(taps(k), taps(2 * radius - k), out=pair)
+        else:
+            np.subtract(taps(k), taps(2 * radius - k), out=pair)
+        pair *= kernel[k]
+        out += pair
+    return out
+
+
+def gaussian_derivative(image, sigma, order_y, order_x):
+    smoothed = convolve1d(image, gaussian_kernel(sigma, order_y), -2)
+    return convolve1d(smoothed, gaussian_kernel(sigma, order_x), -1)
+
+
+class GaussianDerivatives:
+    # Memoized separable derivatives of one image; every filter at a scale
+    # reuses the same row and column passes
+    def __init__(self, image):
+        self.image = image
+        self._rows = {}
+        self._derivatives = {}
+
+    def __call__(self, sigma, order_y, order_x):
+        key = (sigma, order_y, order_x)
+        if key not in self._derivatives:
+            if (sigma, order_y) not in self._rows:
+                self._rows[(sigma, order_y)] = convolve1d(
+                    self.image, gaussian_kernel(sigma, order_y), -2)
+            self._derivatives[key] = convolve1d(
+                self._rows[(sigma, order_y)], gaussian_kernel(sigma, order_x), -1)
+        return self._derivatives[key]
+
+
+def symmetric_eigenvalues(a, b, c):
+    # Eigenvalues of [[a, b], [b, c]], largest first
+    mean = (a + c) / 2.0
+    delta = np.sqrt(((a - c) / 2.0) ** 2 + b * b)
+    return np.stack([mean + delta, mean - delta])
+
+
+def filter_response(derivatives, name, sigma):
+    # Response of one filter on channel-first float32 images of shape (c, h, w);
+    # the result has shape (outputs, c, h, w)
+    d = derivatives
+    if name == "gaussian_smoothing":
+        return d(sigma, 0, 0)[None]
+    if name == "laplacian_of_gaussian":
+        return (d(sigma, 2, 0) + d(sigma, 0, 2))[None]
+    if name == "gradient_magnitude":
+        dy, dx = d(sigma, 1, 0), d(sigma, 0, 1)
+        return np.sqrt(dx * dx + dy * dy)[None]
+    if name == "structure_tensor_eigenvalues":
+        dy, dx = d(sigma, 1, 0), d(sigma, 0, 1)
+        outer = OUTER_SCALE * sigma
+        return symmetric_eigenvalues(gaussian_derivative(dx * dx, outer, 0, 0),
+                                     gaussian_derivative(dx * dy, outer, 0, 0),
+                                     gaussian_derivative(dy * dy, outer, 0, 0))
+    if name == "hessian_of_gaussian_eigenvalues":
+        return symmetric_eigenvalues(d(sigma, 0, 2), d(sigma, 1, 1), d(sigma, 2, 0))
+    raise ValueError(f"Unknown filter: {name}")
+
+
+def read_padded(pyramid, level, x, y, width, height, halo):
+    # Tile plus a halo; parts outside the image are mirrored
+    x0, y0 = x - halo, y - halo
+    level_height, level_width = pyramid.level_shape(level)
+    region = pyramid.read_region(level, x0, y0, width + 2 * halo, height + 2 * halo)
+    left, top = max(0, -x0), max(0, -y0)
+    right = max(0, x + width + halo - level_width)
+    bottom = max(0, y + height + halo - level_height)
+    return np.pad(region, ((top, bottom), (left, right), (0, 0)), mode="symmetric")
+
+
+def filter_responses(rgba, specs):
+    # {spec: (outputs * channels, h, w)} for every spec on the RGB channels.
+    # Specs are evaluated scale by scale so derivatives are shared and freed early
+    channels = np.ascontiguousarray(np.moveaxis(rgba[..., :3], -1, 0), np.float32)
+    responses = {}
+    for sigma in sorted({sigma for _, sigma in specs}):
+        derivatives = GaussianDerivatives(channels)
+        for name, spec_sigma in specs:
+            if spec_sigma == sigma:
+                response = filter_response(derivatives, name, sigma)
+                responses[(name, sigma)] = response.reshape(-1, *channels.shape[1:])
+    return responses
+
+
+def compute_features(rgba, specs):
+    # Stack of all filter responses on every RGB channel, shape (h, w, features)
+    responses = filter_responses(rgba, specs)
+    return np.moveaxis(np.concatenate([responses[spec] for spec in specs]), 0, -1)
+
+
+@traced("tile features", "features")
+def tile_features(pyramid, level, x, y, width, height, specs, cache=None, store=True):
+    # Feature stack of one tile, shape (h, w, features). Responses found in
+    # `cache` are reused; only the missing ones are computed, with the halo
+    # those filters need, and added to the cache unless `store` is False
+    responses = {}
+    if cache is not None:
+        for spec in specs:
+            responses[spec] = cache.get(cache.key(pyramid, level, x, y, width, height, *spec))
+    missing = [spec for spec in specs if responses.get(spec) is None]
+    if missing:
+        halo = feature_halo(missing)
+        padded = read_padded(pyramid, level, x, y, width, height, halo)
+        for spec, response in filter_responses(padded, missing).items():
+            response = np.ascontiguousarray(response[:, halo:halo + height, halo:halo + width])
+            responses[spec] = response
+            if cache is not None and store:
+                cache.put(cache.key(pyramid, level, x, y, width, height, *spec), response)
+    return np.moveaxis(np.concatenate([responses[spec] for spec in specs]), 0, -1)
@@ -0,0 +1,182 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QSize, Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QPixmap
+from PyQt5.QtWidgets import (QFileDialog, QHBoxLayout, QLabel, QListView, QPushButton,
+                             QVBoxLayout, QWidget)
+
+from constants import IMAGE_EXTENSIONS
+from job_scheduler import INTERACTIVE, JobScheduler
+from thumbnails import THUMBNAIL_SIZE, ThumbnailCache
+
+# Thumbnails decode on their own pool so browsing never waits behind
+# analysis jobs
+THUMBNAIL_THREADS = 2
+
+# Thumbnails kept in memory; the rest are reread from the disk cache
+THUMBNAIL_MEMORY = 1000
+
+# Quiet period after scrolling before requests for rows that scrolled out
+# of view are dropped
+SCROLL_SETTLE_MS = 100
+
+
+def thumbnail_job(job, cache, path, mtime_ns, file_size):
+    return path, cache.get(path, mtime_ns, file_size)
+
+
+def list_images(directory):
+    # (name, path, mtime_ns, size) of the images in `directory`, by name
+    entries = []
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                stat = entry.stat()
+                entries.append((entry.name, entry.path, stat.st_mtime_ns, stat.st_size))
+    entries.sort(key=lambda entry: entry[0].lower())
+    return entries
+
+
+class FolderModel(QAbstractListModel):
+    # The images of one folder. Thumbnails are only requested for the rows
+    # the view paints, and arrive asynchronously
+    def __init__(self, scheduler, cache, parent=None):
+        super().__init__(parent)
+        self.scheduler = scheduler
+        self.cache = cache
+        self.entries = []
+        self.rows = {}
+        self.thumbnails = OrderedDict()
+        self.placeholder = QPixmap(cache.size, cache.size)
+        self.placeholder.fill(QColor(0, 0, 0, 0))
+
+    def set_folder(self, directory):
+        self.scheduler.cancel_all()
+        self.beginResetModel()
+        self.entries = list_images(os.path.abspath(directory))
+        self.rows = {entry[1]: row for row, entry in enumerate(self.entries)}
+        self.endResetModel()
+
+    def path(self, row):
+        return self.entries[row][1]
+
+    def row(self, path):
+        return self.rows.get(path)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name, path, mtime_ns, file_size = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return name
+        if role == Qt.ToolTipRole:
+            return path
+        if role != Qt.DecorationRole:
+            return None
+        pixmap = self.thumbnails.get(path)
+        if pixmap is not None:
+            self.thumbnails.move_to_end(path)
+            return pixmap
+        key = f"thumbnail {path}"
+        if not self.scheduler.is_pending(key):
+            self.scheduler.submit(key, thumbnail_job, self.cache, path, mtime_ns, file_size,
+                                  priority=INTERACTIVE, on_result=self.thumbnail_ready)
+        return self.placeholder
+
+    def thumbnail_ready(self, result):
+        path, image = result
+        row = self.rows.get(path)
+        if row is None or image.isNull():
+            return
+        self.thumbnails[path] = QPixmap.fromImage(image)
+        while len(self.thumbnails) > THUMBNAIL_MEMORY:
+            self.thumbnails.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class FolderPanel(QWidget):
+    # Thumbnail grid of a folder's images; choosing one emits its path
+    image_selected = pyqtSignal(str)
+    message = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout(self)
+        header = QHBoxLayout()
+        self.folder_label = QLabel("No folder")
+        header.addWidget(self.folder_label, 1)
+        open_button = QPushButton("Open Folder...")
+        open_button.clicked.connect(self.choose_folder)
+        header.addWidget(open_button)
+        layout.addLayout(header)
+
+        self.scheduler = JobScheduler(THUMBNAIL_THREADS, parent=self)
+        self.model = FolderModel(self.scheduler, ThumbnailCache(), self)
+        self.view = QListView()
+        self.view.setViewMode(QListView.IconMode)
+        self.view.setMovement(QListView.Static)
+        self.view.setResizeMode(QListView.Adjust)
+        self.view.setUniformItemSizes(True)
+        self.view.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.view.setGridSize(QSize(THUMBNAIL_SIZE + 16, THUMBNAIL_SIZE + 32))
+        self.view.setTextElideMode(Qt.ElideMiddle)
+        self.view.setModel(self.model)
+        self.view.selectionModel().currentChanged.connect(self.current_changed)
+        self.selecting = False
+        layout.addWidget(self.view)
+
+        # Queued thumbnails are dropped once scrolling stops; the rows still
+        # in view ask for theirs again when they repaint
+        self.scroll_timer = QTimer(self)
+        self.scroll_timer.setSingleShot(True)
+        self.scroll_timer.setInterval(SCROLL_SETTLE_MS)
+        self.scroll_timer.timeout.connect(self.drop_hidden_requests)
+        self.view.verticalScrollBar().valueChanged.connect(self.scroll_timer.start)
+
+    def choose_folder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Open Folder")
+        if directory:
+            self.set_folder(directory)
+
+    def set_folder(self, directory):
+        try:
+            self.model.set_folder(directory)
+        except OSError as e:
+            self.message.emit(f"Failed to open folder: {e}")
+            return
+        self.folder_label.setText(os.path.basename(os.path.normpath(directory)) or directory)
+        self.message.emit(f"{self.model.rowCount()} images in {directory}")
+
+    def drop_hidden_requests(self):
+        self.scheduler.cancel_all()
+        self.view.viewport().update()
+
+    def current_changed(self, current, previous):
+        if current.isValid() and not self.selecting:
+            self.image_selected.emit(self.model.path(current.row()))
+
+    def select(self, path):
+        # Marks an image opened elsewhere without opening it again
+        row = self.model.row(path)
+        if row is None:
+            return
+        self.selecting = True
+        self.view.setCurrentIndex(self.model.index(row))
+        self.selecting = False
+        self.view.scrollTo(self.model.index(row))
+
+    def neighbors(self, path):
+        # The images after and before `path` in the listing
+        row = self.model.row(path)
+        if row is None:
+            return []
+        return [self.model.path(candidate) for candidate in (row + 1, row - 1)
+                if 0 <= candidate < self.model.rowCount()]
+
+    def shutdown(self):
+        self.scheduler.shutdown()
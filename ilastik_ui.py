@@ -1,52 +1,297 @@
+import importlib
+import os
+import shutil
 import sys
+import tempfile
+import threading
+
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QLabel,
                              QFileDialog, QVBoxLayout, QHBoxLayout, QWidget, QSlider,
                              QComboBox, QGroupBox, QGridLayout, QSpinBox, QStatusBar,
-                             QProgressBar, QShortcut)
-from PyQt5.QtGui import QPixmap, QImage, QPainter, QPen, QColor, QKeySequence
-from PyQt5.QtCore import Qt, QRect, QThread, pyqtSignal
+                             QProgressBar, QShortcut, QCheckBox, QDockWidget)
+from PyQt5.QtGui import QPixmap, QImage, QPainter, QKeySequence
+from PyQt5.QtCore import Qt, QRectF, QTimer
 
-class ImageProcessor(QThread):
-    progress = pyqtSignal(int)
-    result = pyqtSignal(QPixmap)
+from constants import LABEL_NAMES, THRESHOLD_MODES
+from image_canvas import ImageCanvas
+from job_scheduler import BACKGROUND, INTERACTIVE, JobScheduler
+from tracing import traced
 
-    def __init__(self, image_path):
-        super().__init__()
-        self.image_path = image_path
-        self.target_width = 0
-        self.target_height = 0
-        self.keep_aspect_ratio = True
-
-    def set_target_size(self, width, height, keep_aspect_ratio=True):
-        self.target_width = width
-        self.target_height = height
-        self.keep_aspect_ratio = keep_aspect_ratio
-
-    def run(self):
-        for i in range(0, 50, 10):
-            self.progress.emit(i)
-            self.msleep(50)  # Simulate loading delay
-        
-        pixmap = QPixmap(self.image_path)
-        
-        # Scale the image if dimensions are provided
-        if self.target_width > 0 and self.target_height > 0:
-            if self.keep_aspect_ratio:
-                pixmap = pixmap.scaled(
-                    self.target_width, self.target_height,
-                    Qt.KeepAspectRatio, Qt.SmoothTransformation
-                )
-            else:
-                pixmap = pixmap.scaled(
-                    self.target_width, self.target_height,
-                    Qt.IgnoreAspectRatio, Qt.SmoothTransformation
-                )
-        
-        for i in range(50, 101, 10):
-            self.progress.emit(i)
-            self.msleep(50)  # Simulate processing delay
-        
-        self.result.emit(pixmap)
+# Move events are coalesced and rendered at most once per frame
+STROKE_FRAME_MS = 16
+
+# Quiet period after the last threshold change before the preview updates
+PREVIEW_DEBOUNCE_MS = 120
+
+# Opacity of the segment colors, class predictions and objects drawn over the image
+SEGMENT_OPACITY = 100 / 255
+PREDICTION_OPACITY = 0.6
+OBJECT_OPACITY = 0.7
+
+# Share of the analysis progress spent on training; the rest is prediction
+TRAINING_PROGRESS = 20
+
+# Per-slice state of a stack that is swapped in and out of the window when
+# the slice changes; the results are scratch files owned by their slice
+SLICE_RESULTS = ("threshold_mask", "segmentation_labels", "probabilities", "object_labels")
+SLICE_FIELDS = ("labels", "history", "segmentation_model", "live_tiles",
+                "live_overlay") + SLICE_RESULTS
+
+# Jobs that work on the current slice only and stop when it changes
+SLICE_JOBS = ("threshold", "segmentation", "classification", "objects")
+
+# Label chunks changed since the last save are appended to an open project
+# this often
+AUTOSAVE_MS = 30000
+
+# Live update retrains a smaller forest once the brush has paused, then
+# predicts the viewport's tiles first, then the tiles within LIVE_NEARBY
+# tiles of it, then the rest. Tiles run as background work so loads and
+# other interactive jobs keep a thread. Only LIVE_QUEUE tiles are handed to
+# the scheduler at a time so the order can follow the view
+LIVE_DEBOUNCE_MS = 500
+LIVE_TREES = 8
+LIVE_NEARBY = 1
+LIVE_QUEUE = 4
+
+# numpy and the processing modules are imported where they are first used,
+# so the window shows without them; once it is up they are imported on a
+# background thread so the first load or analysis does not wait for them
+WARM_UP_MODULES = ("numpy", "image_pyramid", "dataset", "annotation_layer", "undo_history",
+                   "processing", "features", "classifier", "segmentation", "objects",
+                   "feature_cache", "project", "chunked_export")
+
+class SliceJob:
+    # Progress and cancellation of one slice of a whole-volume job
+    def __init__(self, job, index, count, start=0, share=100):
+        self.job = job
+        self.index = index
+        self.count = count
+        self.start = start
+        self.share = share
+    
+    def set_progress(self, value):
+        self.job.set_progress(self.start + self.share * (100 * self.index + value)
+                              // (100 * self.count))
+    
+    def cancelled(self):
+        return self.job.cancelled()
+
+def load_job(job, dataset, index, target_width, target_height):
+    # Decode once into the on-disk pyramid; progress follows the decode.
+    # Only the pyramid level that covers the display size is read; the
+    # canvas reads finer levels itself when zoomed in
+    from image_pyramid import array_to_qimage
+    pyramid = dataset.load_slice(index, progress=job.set_progress, cancelled=job.cancelled)
+    image = array_to_qimage(pyramid.read_level(pyramid.level_for_size(target_width, target_height)))
+    image = image.scaled(target_width, target_height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return dataset, index, pyramid, image
+
+def prefetch_job(job, dataset, index):
+    dataset.load_slice(index, cancelled=job.cancelled)
+
+def store_preview(preview, result_dir):
+    # Whole-volume previews wait on disk until their slice is shown
+    from processing import allocate_result
+    stored = allocate_result(preview.shape, result_dir)
+    stored[:] = preview
+    return stored
+
+def remove_slice_result(result):
+    # Result tuples carry the full-resolution array and the preview last
+    from processing import remove_result
+    remove_result(result[-2])
+    remove_result(result[-1])
+
+def volume_job(job, dataset, preview_size, result_dir, run_slice, start=0):
+    # Run run_slice(slice_job, pyramid, preview_level) on every slice and
+    # return {index: result}; stops and cleans up on cancel or error
+    results = {}
+    try:
+        for index in range(len(dataset)):
+            pyramid = dataset.load_slice(index, cancelled=job.cancelled)
+            slice_job = SliceJob(job, index, len(dataset), start, 100 - start)
+            result = run_slice(slice_job, pyramid, pyramid.level_for_size(*preview_size))
+            results[index] = result[:-1] + (store_preview(result[-1], result_dir),)
+    except BaseException:
+        for result in results.values():
+            remove_slice_result(result)
+        raise
+    return results
+
+def volume_threshold_job(job, dataset, mode, manual_value, per_channel, preview_size,
+                         result_dir):
+    # Auto modes choose the level of each slice from its own histogram
+    return volume_job(job, dataset, preview_size, result_dir,
+                      lambda slice_job, pyramid, preview_level: threshold_job(
+                          slice_job, pyramid, mode, manual_value, per_channel, preview_level,
+                          result_dir))
+
+def volume_segmentation_job(job, dataset, n_clusters, previous_model, preview_size,
+                            result_dir):
+    # One model for the whole volume, fitted on pixels from every slice
+    import numpy as np
+    from processing import allocate_result, remove_result
+    from segmentation import SAMPLE_SIZE, MiniBatchKMeans, sample_pixels, segment_pyramid
+    count = SAMPLE_SIZE // len(dataset) + 1
+    samples = np.concatenate([sample_pixels(dataset.load_slice(index, cancelled=job.cancelled),
+                                            count, seed=index)
+                              for index in range(len(dataset))])
+    model = MiniBatchKMeans(n_clusters)
+    if previous_model is not None:
+        model.fit(samples, previous_model.centroids, previous_model.counts)
+    else:
+        model.fit(samples)
+    
+    def run_slice(slice_job, pyramid, preview_level):
+        labels = allocate_result((pyramid.height, pyramid.width), result_dir)
+        try:
+            preview = segment_pyramid(pyramid, model.centroids, labels, preview_level,
+                                      progress=slice_job.set_progress,
+                                      cancelled=slice_job.cancelled)
+        except BaseException:
+            remove_result(labels)
+            raise
+        return model, labels, preview
+    
+    return volume_job(job, dataset, preview_size, result_dir, run_slice)
+
+def volume_classification_job(job, dataset, slice_labels, project, preview_size, result_dir,
+                              feature_cache):
+    # Train on the annotations of every slice, then predict every slice.
+    # Slices mapped to None have not been shown yet; their labels are read
+    # from the project
+    from classifier import N_LABELS, PixelClassifier
+    from processing import allocate_result, remove_result
+    training = []
+    for index, labels in sorted(slice_labels.items()):
+        pyramid = dataset.load_slice(index, cancelled=job.cancelled)
+        if labels is None:
+            labels = project.read_labels(index, pyramid.width, pyramid.height)
+        training.append((pyramid, labels))
+    classifier = PixelClassifier(cache=feature_cache)
+    classifier.train_slices(training)
+    if job.cancelled():
+        raise InterruptedError("Training cancelled")
+    job.set_progress(TRAINING_PROGRESS)
+    
+    def run_slice(slice_job, pyramid, preview_level):
+        probabilities = allocate_result((pyramid.height, pyramid.width, N_LABELS), result_dir)
+        try:
+            preview = classifier.predict_pyramid(pyramid, probabilities, preview_level,
+                                                 progress=slice_job.set_progress,
+                                                 cancelled=slice_job.cancelled)
+        except BaseException:
+            remove_result(probabilities)
+            raise
+        return classifier, probabilities, preview
+    
+    return volume_job(job, dataset, preview_size, result_dir, run_slice, TRAINING_PROGRESS)
+
+def threshold_job(job, pyramid, mode, manual_value, per_channel, preview_level, result_dir):
+    from processing import (allocate_result, pyramid_threshold_levels, remove_result,
+                            threshold_pyramid)
+    levels = pyramid_threshold_levels(pyramid, mode, manual_value, per_channel,
+                                      cancelled=job.cancelled)
+    mask = allocate_result((pyramid.height, pyramid.width), result_dir)
+    try:
+        preview = threshold_pyramid(pyramid, levels, per_channel, mask, preview_level,
+                                    progress=job.set_progress, cancelled=job.cancelled)
+    except BaseException:
+        remove_result(mask)
+        raise
+    return levels, mask, preview
+
+def segmentation_job(job, pyramid, n_clusters, previous_model, preview_level, result_dir):
+    # Fit on a fixed pixel sample, warm-starting from the previous centroids
+    from processing import allocate_result, remove_result
+    from segmentation import MiniBatchKMeans, sample_pixels, segment_pyramid
+    samples = sample_pixels(pyramid)
+    model = MiniBatchKMeans(n_clusters)
+    if previous_model is not None:
+        model.fit(samples, previous_model.centroids, previous_model.counts)
+    else:
+        model.fit(samples)
+    
+    labels = allocate_result((pyramid.height, pyramid.width), result_dir)
+    try:
+        preview = segment_pyramid(pyramid, model.centroids, labels, preview_level,
+                                  progress=job.set_progress, cancelled=job.cancelled)
+    except BaseException:
+        remove_result(labels)
+        raise
+    return model, labels, preview
+
+def classification_job(job, pyramid, labels, preview_level, result_dir, feature_cache):
+    # Train on the annotated pixels only, then predict every tile; filter
+    # responses from earlier runs come from the feature cache
+    from classifier import N_LABELS, PixelClassifier
+    from processing import allocate_result, remove_result
+    classifier = PixelClassifier(cache=feature_cache)
+    classifier.train(pyramid, labels)
+    if job.cancelled():
+        raise InterruptedError("Training cancelled")
+    job.set_progress(TRAINING_PROGRESS)
+    
+    probabilities = allocate_result((pyramid.height, pyramid.width, N_LABELS), result_dir)
+    try:
+        preview = classifier.predict_pyramid(
+            pyramid, probabilities, preview_level,
+            progress=lambda value: job.set_progress(
+                TRAINING_PROGRESS + value * (100 - TRAINING_PROGRESS) // 100),
+            cancelled=job.cancelled
+        )
+    except BaseException:
+        remove_result(probabilities)
+        raise
+    return classifier, probabilities, preview
+
+def objects_job(job, pyramid, mask_tile, preview_level, result_dir):
+    import numpy as np
+    from objects import detect_objects
+    from processing import allocate_result, remove_result
+    objects = allocate_result((pyramid.height, pyramid.width), result_dir, dtype=np.uint32)
+    try:
+        table, preview = detect_objects(pyramid, mask_tile, objects, preview_level,
+                                        progress=job.set_progress, cancelled=job.cancelled)
+    except BaseException:
+        remove_result(objects)
+        raise
+    return table, objects, preview
+
+def live_training_job(job, pyramid, tiles, feature_cache):
+    # `tiles` is a copy of the labeled tiles, so the brush can keep painting
+    # into the label layer while this trains
+    from classifier import PixelClassifier, RandomForest
+    classifier = PixelClassifier(forest=RandomForest(n_trees=LIVE_TREES), cache=feature_cache)
+    return classifier.train_tiles([(pyramid, tiles)])
+
+def live_tile_job(job, classifier, pyramid, tile):
+    from classifier import probability_colors
+    _, _, x, y, w, h = tile
+    probabilities = classifier.predict_tile(pyramid, x, y, w, h)
+    return tile, probabilities, probability_colors(probabilities)
+
+def autosave_job(job, project, chunks, fields, classifier):
+    project.save(chunks, fields, classifier)
+
+def close_project_key(path):
+    return f"close project {os.path.abspath(path)}"
+
+def export_job(job, outputs, settings):
+    # Streams each output chunk by chunk; progress covers all of them
+    from chunked_export import export_array, output_path
+    os.makedirs(settings["directory"], exist_ok=True)
+    paths = []
+    for index, (name, shape, dtype, read_chunk, rgb, attributes) in enumerate(outputs):
+        path = output_path(settings["directory"], settings["stem"], name, settings["format"])
+        export_array(path, settings["format"], shape, dtype, read_chunk, codec=settings["codec"],
+                     rgb=rgb, attributes=attributes,
+                     progress=lambda done, total, index=index: job.set_progress(
+                         int(100 * (index + done / total) / len(outputs))),
+                     cancelled=job.cancelled)
+        paths.append(path)
+    return paths
 
 class IlastikUI(QMainWindow):
     def __init__(self):
@@ -54,12 +299,62 @@ class IlastikUI(QMainWindow):
         self.setWindowTitle("Ilastik-inspired Prototype")
         self.setGeometry(100, 100, 1000, 800)
         self.image_path = None
+        self.dataset = None
+        self.slice_index = 0
+        self.slice_states = {}
+        self.folder_datasets = {}
+        self.pixmap_modified = False
+        self.pyramid = None
+        self.labels = None
+        self.threshold_preview = None
+        self.threshold_mask = None
+        self.segmentation_model = None
+        self.segmentation_labels = None
+        self.classifier = None
+        self.model_version = 0
+        self.live_tiles = {}
+        self.live_overlay = None
+        self.live_queue = []
+        self.probabilities = None
+        self.object_labels = None
+        self.project = None
+        self.opening_project = None
+        self.saved_classifier = None
+        self.saved_fields = None
+        self.result_dir = tempfile.mkdtemp(prefix="ilastik_results_")
+        self._feature_cache = None
         self.drawing = False
         self.last_point = None
+        self.pending_points = []
         self.brush_size = 5
         self.scale_factor = 1.0
-        self.image_history = []
-        self.image_index = -1
+        self.history = None
+        
+        # Results of background jobs are only accepted for the image and
+        # annotations they were computed from
+        self.scheduler = JobScheduler(parent=self)
+        self.dataset_generation = 0
+        self.image_generation = 0
+        self.labels_version = 0
+        
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.setInterval(STROKE_FRAME_MS)
+        self.stroke_timer.timeout.connect(self.flush_stroke)
+        
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DEBOUNCE_MS)
+        self.preview_timer.timeout.connect(self.preview_threshold)
+        
+        self.live_timer = QTimer(self)
+        self.live_timer.setSingleShot(True)
+        self.live_timer.setInterval(LIVE_DEBOUNCE_MS)
+        self.live_timer.timeout.connect(self.run_live_training)
+        
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setInterval(AUTOSAVE_MS)
+        self.autosave_timer.timeout.connect(self.autosave)
        
         # Create status bar
         self.statusBar = QStatusBar()
@@ -80,12 +375,37 @@ class IlastikUI(QMainWindow):
         self.upload_button.clicked.connect(self.load_image)
         top_layout.addWidget(self.upload_button)
        
+        # Shows the thumbnails of a folder to pick images from
+        self.folder_button = QPushButton("Open Folder", self)
+        self.folder_button.clicked.connect(self.open_folder)
+        top_layout.addWidget(self.folder_button)
+       
         # Button to save processed image
-        self.save_button = QPushButton("Save Result", self)
+        self.save_button = QPushButton("Export Results", self)
         self.save_button.clicked.connect(self.save_image)
         self.save_button.setEnabled(False)
         top_layout.addWidget(self.save_button)
        
+        # Button to save the current settings for batch runs
+        self.pipeline_button = QPushButton("Save Pipeline", self)
+        self.pipeline_button.clicked.connect(self.export_pipeline)
+        top_layout.addWidget(self.pipeline_button)
+       
+        # Projects keep the annotations, settings and classifier of a session
+        self.open_project_button = QPushButton("Open Project", self)
+        self.open_project_button.clicked.connect(self.open_project)
+        top_layout.addWidget(self.open_project_button)
+        
+        self.save_project_button = QPushButton("Save Project", self)
+        self.save_project_button.clicked.connect(self.save_project)
+        self.save_project_button.setEnabled(False)
+        top_layout.addWidget(self.save_project_button)
+       
+        # Toggles the profiling panel
+        self.perf_button = QPushButton("Performance", self)
+        self.perf_button.setCheckable(True)
+        top_layout.addWidget(self.perf_button)
+       
         # Create horizontal layout for controls and image
         main_horizontal = QHBoxLayout()
         main_layout.addLayout(main_horizontal)
@@ -101,9 +421,15 @@ class IlastikUI(QMainWindow):
         control_layout.addWidget(processing_group)
        
         self.processing_combo = QComboBox()
-        self.processing_combo.addItems(["Original", "Simulated Threshold",
-                                        "Simulated Segmentation", "Drawing Mode"])
+        self.processing_combo.addItems(["Original", "Threshold",
+                                        "K-means Segmentation", "Drawing Mode"])
+        self.processing_combo.currentTextChanged.connect(self.processing_method_changed)
         processing_layout.addWidget(self.processing_combo)
+        
+        # Stacks can be processed slice by slice or all at once
+        self.volume_checkbox = QCheckBox("Whole volume")
+        self.volume_checkbox.setVisible(False)
+        processing_layout.addWidget(self.volume_checkbox)
        
         # Add threshold controls
         threshold_group = QGroupBox("Threshold Controls")
@@ -120,6 +446,16 @@ class IlastikUI(QMainWindow):
         self.threshold_value_label = QLabel("50")
         threshold_layout.addWidget(self.threshold_value_label, 0, 2)
         self.threshold_slider.valueChanged.connect(self.update_threshold_value)
+        
+        threshold_layout.addWidget(QLabel("Mode:"), 1, 0)
+        self.threshold_mode_combo = QComboBox()
+        self.threshold_mode_combo.addItems(THRESHOLD_MODES)
+        self.threshold_mode_combo.currentTextChanged.connect(self.update_threshold_mode)
+        threshold_layout.addWidget(self.threshold_mode_combo, 1, 1, 1, 2)
+        
+        self.per_channel_checkbox = QCheckBox("Per channel")
+        self.per_channel_checkbox.toggled.connect(self.schedule_threshold_preview)
+        threshold_layout.addWidget(self.per_channel_checkbox, 2, 0, 1, 3)
        
         # Add segmentation controls
         segment_group = QGroupBox("Segmentation Controls")
@@ -139,7 +475,7 @@ class IlastikUI(QMainWindow):
         control_layout.addWidget(annotation_group)
        
         self.annotation_color = QComboBox()
-        self.annotation_color.addItems(["Green (Foreground)", "Red (Background)", "Blue (Object)"])
+        self.annotation_color.addItems(LABEL_NAMES)
         annotation_layout.addWidget(QLabel("Color:"), 0, 0)
         annotation_layout.addWidget(self.annotation_color, 0, 1)
        
@@ -150,6 +486,13 @@ class IlastikUI(QMainWindow):
         self.brush_size_slider.setValue(5)
         self.brush_size_slider.valueChanged.connect(self.update_brush_size)
         annotation_layout.addWidget(self.brush_size_slider, 1, 1)
+        
+        # The eraser paints "unlabeled"; clearing removes the selected class
+        self.eraser_checkbox = QCheckBox("Eraser")
+        annotation_layout.addWidget(self.eraser_checkbox, 2, 0)
+        self.clear_class_button = QPushButton("Clear Class")
+        self.clear_class_button.clicked.connect(self.clear_class)
+        annotation_layout.addWidget(self.clear_class_button, 2, 1)
        
         # Add apply and reset buttons
         button_layout = QHBoxLayout()
@@ -165,10 +508,30 @@ class IlastikUI(QMainWindow):
         self.reset_button.setEnabled(False)
         button_layout.addWidget(self.reset_button)
        
-        self.run_button = QPushButton("Simulate Analysis", self)
-        self.run_button.clicked.connect(self.run_simulated_analysis)
+        self.run_button = QPushButton("Train && Predict", self)
+        self.run_button.clicked.connect(self.run_analysis)
         self.run_button.setEnabled(False)
         control_layout.addWidget(self.run_button)
+        
+        # Retrain and re-predict around the viewport after every stroke
+        self.live_checkbox = QCheckBox("Live Update")
+        self.live_checkbox.toggled.connect(self.set_live_update)
+        control_layout.addWidget(self.live_checkbox)
+        
+        # Object detection on the threshold mask or a predicted class
+        objects_group = QGroupBox("Objects")
+        objects_layout = QVBoxLayout(objects_group)
+        control_layout.addWidget(objects_group)
+        
+        self.object_source_combo = QComboBox()
+        self.object_source_combo.addItem("Threshold mask")
+        self.object_source_combo.addItems([f"Prediction: {name}" for name in LABEL_NAMES])
+        objects_layout.addWidget(self.object_source_combo)
+        
+        self.objects_button = QPushButton("Detect Objects", self)
+        self.objects_button.clicked.connect(self.run_object_detection)
+        self.objects_button.setEnabled(False)
+        objects_layout.addWidget(self.objects_button)
        
         # Add a spacer to push controls to the top
         control_layout.addStretch()
@@ -177,31 +540,71 @@ class IlastikUI(QMainWindow):
         image_container = QWidget()
         image_layout = QVBoxLayout(image_container)
         
-        self.image_frame = QLabel()
-        self.image_frame.setAlignment(Qt.AlignCenter)
+        self.image_frame = ImageCanvas()
         self.image_frame.setMinimumSize(600, 500)
-        self.image_frame.setStyleSheet("border: 1px solid black; background-color: #f0f0f0;")
         self.image_frame.setMouseTracking(True)
         self.image_frame.mousePressEvent = self.mouse_press
         self.image_frame.mouseReleaseEvent = self.mouse_release
         self.image_frame.mouseMoveEvent = self.mouse_move
+        self.image_frame.zoom_changed.connect(self.canvas_zoomed)
+        self.image_frame.view_settled.connect(self.order_live_tiles)
         image_layout.addWidget(self.image_frame)
         
+        # Slice navigation, shown for stacks and sequences
+        self.slice_bar = QWidget()
+        slice_layout = QHBoxLayout(self.slice_bar)
+        slice_layout.setContentsMargins(0, 0, 0, 0)
+        self.slice_slider = QSlider(Qt.Horizontal)
+        self.slice_slider.setMinimum(0)
+        self.slice_slider.valueChanged.connect(self.show_slice)
+        slice_layout.addWidget(self.slice_slider, 1)
+        self.slice_label = QLabel()
+        slice_layout.addWidget(self.slice_label)
+        self.slice_bar.setVisible(False)
+        image_layout.addWidget(self.slice_bar)
+        
         # Add progress bar for image loading/processing
         self.progress_bar = QProgressBar()
         self.progress_bar.setValue(0)
         self.progress_bar.setVisible(False)
         image_layout.addWidget(self.progress_bar)
+        self.scheduler.progress.connect(self.progress_bar.setValue)
+        self.scheduler.active_changed.connect(self.progress_bar.setVisible)
+        self.scheduler.stale.connect(self.job_outdated)
         
         main_horizontal.addWidget(image_container, 1)  # Give more weight to the image
         
+        # Measurement table, shown once objects have been detected. The
+        # docked panels are built the first time they are shown
+        self.object_panel = None
+        self.object_dock = QDockWidget("Objects", self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.object_dock)
+        self.object_dock.hide()
+        
+        # Thumbnails of a folder, shown once one is opened
+        self.folder_panel = None
+        self.folder_dock = QDockWidget("Folder", self)
+        self.addDockWidget(Qt.LeftDockWidgetArea, self.folder_dock)
+        self.folder_dock.hide()
+        
+        # Span timings from the tracing module, hidden until asked for
+        self.perf_panel = None
+        self.perf_dock = QDockWidget("Performance", self)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.perf_dock)
+        self.perf_dock.hide()
+        self.perf_button.toggled.connect(self.show_perf_panel)
+        self.perf_dock.visibilityChanged.connect(self.perf_button.setChecked)
+        
         # Initialize keyboard shortcuts
         self.init_shortcuts()
        
     def init_shortcuts(self):
         # File operations
         QShortcut(QKeySequence("Ctrl+O"), self, self.load_image)
+        QShortcut(QKeySequence("Ctrl+Shift+F"), self, self.open_folder)
         QShortcut(QKeySequence("Ctrl+S"), self, self.save_image)
+        QShortcut(QKeySequence("Ctrl+Shift+O"), self, self.open_project)
+        QShortcut(QKeySequence("Ctrl+Shift+S"), self, self.save_project)
         
         # Undo/Redo
         QShortcut(QKeySequence("Ctrl+Z"), self, self.undo_action)
@@ -211,116 +614,494 @@ class IlastikUI(QMainWindow):
         QShortcut(QKeySequence("Ctrl++"), self, self.zoom_in)
         QShortcut(QKeySequence("Ctrl+-"), self, self.zoom_out)
         
+        # Slices
+        QShortcut(QKeySequence("PgDown"), self, lambda: self.step_slice(1))
+        QShortcut(QKeySequence("PgUp"), self, lambda: self.step_slice(-1))
+        
         # Processing
         QShortcut(QKeySequence("Ctrl+P"), self, self.apply_processing)
         QShortcut(QKeySequence("Ctrl+R"), self, self.reset_image)
+        
+        # Profiling
+        QShortcut(QKeySequence("Ctrl+Shift+P"), self, self.perf_button.toggle)
    
+    @property
+    def feature_cache(self):
+        # Created on first use, as it needs numpy
+        if self._feature_cache is None:
+            from feature_cache import FeatureCache
+            self._feature_cache = FeatureCache(
+                directory=os.path.join(self.result_dir, "features"))
+        return self._feature_cache
+    
+    def build_object_panel(self):
+        if self.object_panel is None:
+            from object_table import ObjectPanel
+            self.object_panel = ObjectPanel()
+            self.object_panel.message.connect(self.statusBar.showMessage)
+            self.object_dock.setWidget(self.object_panel)
+        return self.object_panel
+    
+    def build_folder_panel(self):
+        if self.folder_panel is None:
+            from folder_panel import FolderPanel
+            self.folder_panel = FolderPanel()
+            self.folder_panel.message.connect(self.statusBar.showMessage)
+            self.folder_panel.image_selected.connect(self.open_folder_image)
+            self.folder_dock.setWidget(self.folder_panel)
+        return self.folder_panel
+    
+    def show_perf_panel(self, visible):
+        if visible and self.perf_panel is None:
+            from perf_panel import PerfPanel
+            self.perf_panel = PerfPanel()
+            self.perf_panel.message.connect(self.statusBar.showMessage)
+            self.perf_dock.setWidget(self.perf_panel)
+        self.perf_dock.setVisible(visible)
+    
     def update_threshold_value(self):
         value = self.threshold_slider.value()
         self.threshold_value_label.setText(str(value))
+        self.schedule_threshold_preview()
+   
+    def update_threshold_mode(self, mode):
+        # Auto modes choose the level themselves
+        self.threshold_slider.setEnabled(mode == "Manual")
+        self.schedule_threshold_preview()
+   
+    def processing_method_changed(self, method):
+        if method == "Threshold":
+            self.schedule_threshold_preview()
+        else:
+            self.preview_timer.stop()
+            self.cancel_threshold_refinement()
+            if self.image_path:
+                self.image_frame.set_pixmap(self.pixmap, self.display_source())
+   
+    def schedule_threshold_preview(self):
+        # Restarting the timer on every change debounces slider drags
+        self.threshold_preview = None
+        if self.image_path and self.processing_combo.currentText() == "Threshold":
+            self.preview_timer.start()
+   
+    @traced("threshold preview", "ui")
+    def preview_threshold(self):
+        # Fast pass on the display level straight from the image buffer
+        from image_pyramid import qimage_to_array
+        from processing import (histogram, remove_result, render_mask, threshold_levels,
+                                threshold_mask)
+        mode = self.threshold_mode_combo.currentText()
+        per_channel = self.per_channel_checkbox.isChecked()
+        pixels = qimage_to_array(self.original_image)
+        levels = threshold_levels(histogram(pixels, per_channel), mode,
+                                  self.threshold_slider.value())
+        output = qimage_to_array(self.threshold_image, writable=True)
+        render_mask(threshold_mask(pixels, levels, per_channel), per_channel, out=output)
+        self.threshold_preview = QPixmap.fromImage(self.threshold_image)
+        self.image_frame.set_pixmap(self.threshold_preview)
+        self.statusBar.showMessage(f"Threshold preview ({mode}): "
+                                   f"{', '.join(str(level) for level in levels)}")
+        
+        # Then refine at full resolution in the background; this supersedes
+        # any refinement still running for older settings
+        self.scheduler.submit(
+            "threshold", threshold_job, self.pyramid, mode, self.threshold_slider.value(),
+            per_channel, self.display_level, self.result_dir,
+            version=self.threshold_version, on_result=self.threshold_refined,
+            on_discard=lambda result: remove_result(result[1]), reports_progress=True
+        )
+   
+    def threshold_version(self):
+        return (self.image_generation, self.threshold_mode_combo.currentText(),
+                self.threshold_slider.value(), self.per_channel_checkbox.isChecked())
+   
+    def cancel_threshold_refinement(self):
+        self.scheduler.cancel("threshold")
+   
+    def threshold_refined(self, result):
+        from image_pyramid import array_to_qimage
+        from processing import remove_result
+        levels, mask, preview = result
+        if self.threshold_mask is not None:
+            remove_result(self.threshold_mask)
+        self.threshold_mask = mask
+        
+        self.threshold_preview = QPixmap.fromImage(array_to_qimage(preview)).scaled(
+            self.pixmap.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+        )
+        self.image_frame.set_pixmap(self.threshold_preview)
+        self.statusBar.showMessage(f"Threshold refined at full resolution: "
+                                   f"{', '.join(str(level) for level in levels)}")
    
     def update_brush_size(self):
         self.brush_size = self.brush_size_slider.value()
    
     def mouse_press(self, event):
-        if self.image_path is not None and self.processing_combo.currentText() == "Drawing Mode":
+        if self.image_path is None:
+            return
+        # Middle drag always pans; left drag pans outside drawing mode
+        if (event.button() == Qt.MiddleButton
+                or self.processing_combo.currentText() != "Drawing Mode"):
+            self.image_frame.begin_pan(event.pos())
+        elif event.button() == Qt.LeftButton:
             self.drawing = True
-            self.last_point = event.pos()
+            self.last_point = self.image_frame.widget_to_image(event.pos())
+            self.pending_points = []
+            
+            # All moves until release form one undoable stroke
+            self.history.begin_action("Brush stroke", self.labels)
    
     def mouse_release(self, event):
+        if self.image_frame.panning:
+            self.image_frame.end_pan()
+        if self.drawing:
+            self.stroke_timer.stop()
+            self.flush_stroke()
+            self.history.end_action()
+            self.labels_edited()
         self.drawing = False
    
     def mouse_move(self, event):
-        if self.drawing and self.processing_combo.currentText() == "Drawing Mode":
-            painter = QPainter(self.pixmap)
-           
-            # Set color based on annotation mode
-            if self.annotation_color.currentText().startswith("Green"):
-                pen = QPen(Qt.green, self.brush_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-            elif self.annotation_color.currentText().startswith("Red"):
-                pen = QPen(Qt.red, self.brush_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-            else:  # Blue
-                pen = QPen(Qt.blue, self.brush_size, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-               
-            painter.setPen(pen)
-           
-            # Draw on displayed image
-            painter.drawLine(self.last_point, event.pos())
-            painter.end()
-           
-            self.last_point = event.pos()
-            self.image_frame.setPixmap(self.pixmap)
-            
-            # Add to history
-            self.add_to_history(self.pixmap)
+        if self.image_frame.panning:
+            self.image_frame.drag_pan(event.pos())
+        elif self.drawing and self.processing_combo.currentText() == "Drawing Mode":
+            # Queue the point in image coordinates; segments are drawn once per frame
+            self.pending_points.append(self.image_frame.widget_to_image(event.pos()))
+            if not self.stroke_timer.isActive():
+                self.stroke_timer.start()
+   
+    @traced("stroke frame", "ui")
+    def flush_stroke(self):
+        from annotation_layer import union_rect
+        points, self.pending_points = self.pending_points, []
+        if not points:
+            return
+        
+        # The brush keeps its on-screen size at every zoom level
+        radius = self.brush_size / 2 / self.image_frame.view_scale
+        value = 0 if self.eraser_checkbox.isChecked() else self.annotation_color.currentIndex() + 1
+        
+        dirty = None
+        for point in points:
+            bounds = self.labels.stroke_bounds(self.last_point, point, radius)
+            if bounds is not None:
+                self.labels_version += 1
+                # Snapshot the tiles under the segment before painting over them
+                self.history.touch(*bounds)
+                self.labels.stamp_segment(self.last_point, point, radius, value)
+                dirty = union_rect(dirty, bounds)
+            self.last_point = point
+        
+        # Repaint only the bounding rect of the new segments
+        if dirty is not None:
+            self.image_frame.refresh_labels(*dirty)
+   
+    def clear_class(self):
+        # One undoable action; only the chunks holding the class are touched
+        if self.labels is None or self.drawing:
+            return
+        value = self.annotation_color.currentIndex() + 1
+        name = LABEL_NAMES[value - 1]
+        count = self.labels.class_counts()[value]
+        if not count:
+            self.statusBar.showMessage(f"No {name} labels to clear")
+            return
+        self.history.begin_action(f"Clear {name}", self.labels)
+        for rect in self.labels.class_rects(value):
+            self.history.touch(*rect)
+        bounds = self.labels.clear_class(value)
+        self.history.end_action()
+        self.labels_version += 1
+        self.image_frame.refresh_labels(*bounds)
+        self.labels_edited()
+        self.statusBar.showMessage(f"Cleared {count} {name} pixels")
    
     def load_image(self):
         # Open file dialog
+        from dataset import Dataset
         file_path, _ = QFileDialog.getOpenFileName(
-            self, "Select an Image", "", "Images (*.png *.jpg *.bmp)"
+            self, "Select an Image", "", "Images (*.png *.jpg *.bmp *.tif *.tiff)"
         )
         if file_path:
-            self.image_path = file_path
             self.statusBar.showMessage(f"Loading image: {file_path.split('/')[-1]}...")
-            self.progress_bar.setVisible(True)
             
-            # Create and configure thread for image loading
-            self.thread = ImageProcessor(file_path)
-            self.thread.set_target_size(self.image_frame.width(), self.image_frame.height(), True)
-            self.thread.progress.connect(self.progress_bar.setValue)
-            self.thread.result.connect(self.process_loaded_image)
-            self.thread.start()
+            # Multi-page TIFFs and numbered sequences open as stacks
+            try:
+                dataset = Dataset.open(file_path)
+            except OSError as e:
+                self.load_failed(str(e))
+                return
+            self.load_slice(dataset, 0)
+    
+    def open_folder(self):
+        directory = QFileDialog.getExistingDirectory(self, "Open Folder")
+        if directory:
+            self.build_folder_panel().set_folder(directory)
+            self.folder_dock.show()
+            if self.image_path:
+                self.folder_panel.select(self.image_path)
+    
+    def open_folder_image(self, path):
+        # An image of the current stack is a slice change; the neighbours of
+        # the shown image are usually decoded already
+        from dataset import Dataset
+        if path == self.image_path:
+            return
+        if self.dataset is not None:
+            index = self.dataset_index(self.dataset, path)
+            if index is not None:
+                self.slice_slider.setValue(index)
+                return
+        dataset = self.folder_datasets.get(path)
+        if dataset is None:
+            try:
+                dataset = Dataset.open(path)
+            except OSError as e:
+                self.load_failed(str(e))
+                return
+        self.statusBar.showMessage(f"Loading image: {os.path.basename(path)}...")
+        self.load_slice(dataset, self.dataset_index(dataset, path) or 0)
+    
+    def dataset_index(self, dataset, path):
+        for index, (slice_path, _) in enumerate(dataset.slices):
+            if slice_path == path:
+                return index
+        return None
+    
+    def preload_folder_neighbors(self):
+        # The next and previous images of the folder are opened and decoded
+        # ahead, like the slices around the current one. Their datasets are
+        # kept so switching to one finds its pyramid in memory
+        from dataset import Dataset
+        datasets = {self.image_path: self.dataset}
+        for path in self.folder_panel.neighbors(self.image_path):
+            if self.dataset_index(self.dataset, path) is not None:
+                continue
+            dataset = self.folder_datasets.get(path)
+            if dataset is None:
+                try:
+                    dataset = Dataset.open(path)
+                except OSError:
+                    continue
+            datasets[path] = dataset
+        self.folder_datasets = datasets
+        wanted = {f"preload {path}": dataset for path, dataset in datasets.items()
+                  if dataset is not self.dataset}
+        for key in list(self.scheduler.jobs):
+            if key.startswith("preload ") and key not in wanted:
+                self.scheduler.cancel(key)
+        for key, dataset in wanted.items():
+            index = self.dataset_index(dataset, key[len("preload "):]) or 0
+            if not dataset.cached(index) and not self.scheduler.is_pending(key):
+                self.scheduler.submit(key, prefetch_job, dataset, index)
+    
+    def load_slice(self, dataset, index):
+        # A newer load supersedes one that is still decoding
+        self.scheduler.submit(
+            "load", load_job, dataset, index, self.image_frame.width(), self.image_frame.height(),
+            priority=INTERACTIVE, on_result=self.process_loaded_image,
+            on_error=self.load_failed, reports_progress=True
+        )
+    
+    def show_slice(self, index):
+        if self.dataset is not None and index != self.slice_index:
+            self.slice_label.setText(f"{index + 1}/{len(self.dataset)}")
+            self.load_slice(self.dataset, index)
+    
+    def step_slice(self, step):
+        if self.dataset is not None:
+            self.slice_slider.setValue(self.slice_slider.value() + step)
+    
+    def prefetch_neighbors(self):
+        # Decode the slices around the current one while the user looks at
+        # it; prefetches for slices that are no longer near are dropped
+        wanted = {f"prefetch {index}": index for index in self.dataset.neighbors(self.slice_index)
+                  if not self.dataset.cached(index)}
+        for key in list(self.scheduler.jobs):
+            if key.startswith("prefetch ") and key not in wanted:
+                self.scheduler.cancel(key)
+        for key, index in wanted.items():
+            if not self.scheduler.is_pending(key):
+                self.scheduler.submit(key, prefetch_job, self.dataset, index)
+   
+    def load_failed(self, message):
+        self.statusBar.showMessage(f"Failed to load image: {message}")
+   
+    def job_outdated(self, key):
+        self.statusBar.showMessage(f"Discarded {key} result: the image or its settings changed")
    
-    def process_loaded_image(self, pixmap):
-        self.pixmap = pixmap
+    @traced("show image", "ui")
+    def process_loaded_image(self, result):
+        from processing import remove_result
+        dataset, index, pyramid, image = result
+        
+        if dataset is not self.dataset:
+            # Everything computed for the previous image is now stale; an
+            # open project gets its last changes first
+            if self.project is not None:
+                self.close_project()
+            self.scheduler.cancel_all()
+            self.discard_slices()
+            self.dataset = dataset
+            self.dataset_generation += 1
+            self.classifier = None
+            self.scale_factor = 1.0
+            self.slice_slider.blockSignals(True)
+            self.slice_slider.setMaximum(len(dataset) - 1)
+            self.slice_slider.setValue(index)
+            self.slice_slider.blockSignals(False)
+            self.slice_bar.setVisible(len(dataset) > 1)
+            self.volume_checkbox.setVisible(len(dataset) > 1)
+            self.volume_checkbox.setChecked(False)
+            if self.opening_project is not None and self.opening_project[1] is dataset:
+                self.restore_project(self.opening_project[0])
+            self.opening_project = None
+        else:
+            # Work on the previous slice stops; its annotations and results
+            # are kept for when it is shown again
+            for key in SLICE_JOBS:
+                self.scheduler.cancel(key)
+            self.cancel_live_jobs()
+            if self.drawing:
+                self.history.end_action()
+                self.drawing = False
+            self.store_slice()
+        self.image_generation += 1
+        self.slice_index = index
+        self.slice_label.setText(f"{index + 1}/{len(dataset)}")
+        self.image_path = dataset.slices[index][0]
+        self.pyramid = pyramid
         
         # Keep the original for reset
-        self.original_pixmap = self.pixmap.copy()
+        self.original_pixmap = QPixmap.fromImage(image)
+        self.original_image = self.original_pixmap.toImage().convertToFormat(QImage.Format_RGBA8888)
+        self.threshold_image = QImage(self.original_image.size(), QImage.Format_RGBA8888)
+        self.display_level = pyramid.level_for_size(self.original_pixmap.width(),
+                                                    self.original_pixmap.height())
+        self.threshold_preview = None
+        pending = self.restore_slice(index)
         
         # Display the image
-        self.image_frame.setPixmap(self.pixmap)
+        self.image_frame.set_image(self.pixmap, self.labels, keep_view=True,
+                                   source=self.display_source())
+        self.image_frame.set_overlay(self.live_overlay)
+        
+        # Whole-volume results computed while the slice was not shown
+        for handler, result in pending.items():
+            getattr(self, handler)(result)
+            remove_result(result[-1])
         
         # Enable processing buttons
         self.apply_button.setEnabled(True)
         self.reset_button.setEnabled(True)
         self.save_button.setEnabled(True)
         self.run_button.setEnabled(True)
+        self.objects_button.setEnabled(True)
+        self.save_project_button.setEnabled(True)
         
-        # Hide progress bar
-        self.progress_bar.setVisible(False)
-        
-        # Add to history
-        self.clear_history()
-        self.add_to_history(self.pixmap)
-        
-        self.statusBar.showMessage(f"Loaded image: {self.image_path.split('/')[-1]}")
+        self.prefetch_neighbors()
+        if self.folder_panel is not None:
+            self.folder_panel.select(self.image_path)
+            self.preload_folder_neighbors()
+        self.schedule_live_tiles()
+        self.statusBar.showMessage(f"Loaded image: {dataset.slice_name(index)}")
     
-    def add_to_history(self, pixmap):
-        # Remove any redo history if we're adding a new state
-        if self.image_index < len(self.image_history) - 1:
-            self.image_history = self.image_history[:self.image_index + 1]
-        
-        # Add current state to history
-        self.image_history.append(pixmap.copy())
-        self.image_index = len(self.image_history) - 1
+    def store_slice(self):
+        # The displayed pixmap is only kept if processing changed it; its
+        # history refers to it
+        state = {name: getattr(self, name) for name in SLICE_FIELDS}
+        if self.object_panel is not None:
+            state["object_table"] = self.object_panel.model.table
+        if self.pixmap_modified:
+            state["pixmap"] = self.pixmap
+        self.slice_states[self.slice_index] = state
+    
+    def restore_slice(self, index):
+        # Returns the pending whole-volume results of the slice
+        from annotation_layer import LabelLayer
+        from undo_history import HistoryEngine
+        state = self.slice_states.pop(index, {})
+        for name in SLICE_FIELDS:
+            setattr(self, name, state.get(name))
+        if self.labels is None and self.project is not None:
+            # Saved annotations are read the first time the slice is shown
+            self.labels = self.project.read_labels(index, self.pyramid.width, self.pyramid.height)
+        if self.labels is None:
+            self.labels = LabelLayer(self.pyramid.width, self.pyramid.height)
+        if self.history is None:
+            self.history = HistoryEngine()
+        if self.live_tiles is None:
+            self.live_tiles = {}
+        self.pixmap = state.get("pixmap") or self.original_pixmap.copy()
+        self.pixmap_modified = "pixmap" in state
+        if self.object_panel is not None:
+            self.object_panel.set_table(state.get("object_table",
+                                                  self.object_panel.model.table[:0]))
+        return state.get("pending", {})
+    
+    def discard_slices(self):
+        # Scratch files of the current slice and every stored one
+        from processing import remove_result
+        for name in SLICE_RESULTS:
+            if getattr(self, name) is not None:
+                remove_result(getattr(self, name))
+                setattr(self, name, None)
+        for state in self.slice_states.values():
+            for name in SLICE_RESULTS:
+                if state.get(name) is not None:
+                    remove_result(state[name])
+            for result in state.get("pending", {}).values():
+                remove_slice_result(result)
+        self.slice_states = {}
+    
+    @traced("replace pixmap", "ui")
+    def replace_pixmap(self, name, pixmap):
+        # Paint the new content into the current pixmap in place so the
+        # change is recorded as tile deltas against it
+        from undo_history import PixmapSurface
+        self.pixmap_modified = True
+        self.history.begin_action(name, PixmapSurface(self.pixmap))
+        self.history.touch_all()
+        painter = QPainter(self.pixmap)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawPixmap(0, 0, pixmap)
+        painter.end()
+        self.history.end_action()
+        self.image_frame.set_pixmap(self.pixmap)
+    
+    def display_source(self):
+        # Until processing paints into the pixmap, the canvas can refine
+        # zoomed-in tiles from the pyramid it was read from
+        return None if self.pixmap_modified else self.pyramid
     
     def clear_history(self):
-        self.image_history = []
-        self.image_index = -1
+        self.history.clear()
+    
+    def refresh_history_action(self, action):
+        if action.surface is self.labels:
+            self.labels_version += 1
+            self.image_frame.refresh_labels(*action.bounds())
+            self.labels_edited()
+        else:
+            self.image_frame.set_pixmap(self.pixmap, self.display_source())
+            if not self.live_checkbox.isChecked():
+                self.clear_live_overlay()
     
     def undo_action(self):
-        if self.image_index > 0:
-            self.image_index -= 1
-            self.pixmap = self.image_history[self.image_index].copy()
-            self.image_frame.setPixmap(self.pixmap)
-            self.statusBar.showMessage("Undo")
+        if self.history is None:
+            return
+        action = self.history.undo()
+        if action is not None:
+            self.refresh_history_action(action)
+            self.statusBar.showMessage(f"Undo: {action.name}")
     
     def redo_action(self):
-        if self.image_index < len(self.image_history) - 1:
-            self.image_index += 1
-            self.pixmap = self.image_history[self.image_index].copy()
-            self.image_frame.setPixmap(self.pixmap)
-            self.statusBar.showMessage("Redo")
+        if self.history is None:
+            return
+        action = self.history.redo()
+        if action is not None:
+            self.refresh_history_action(action)
+            self.statusBar.showMessage(f"Redo: {action.name}")
     
     def zoom_in(self):
         if hasattr(self, 'pixmap'):
@@ -336,160 +1117,610 @@ class IlastikUI(QMainWindow):
     
     def update_zoom(self):
         if hasattr(self, 'pixmap'):
-            scaled_pixmap = self.pixmap.scaled(
-                int(self.pixmap.width() * self.scale_factor),
-                int(self.pixmap.height() * self.scale_factor),
-                Qt.KeepAspectRatio, Qt.SmoothTransformation
-            )
-            self.image_frame.setPixmap(scaled_pixmap)
+            self.scale_factor = self.image_frame.set_zoom(self.scale_factor)
+    
+    def canvas_zoomed(self, zoom):
+        # Wheel zoom happens in the canvas, around the cursor
+        self.scale_factor = zoom
+        self.statusBar.showMessage(f"Zoom: {int(self.scale_factor * 100)}%")
    
     def apply_processing(self):
         if self.image_path:
             method = self.processing_combo.currentText()
            
             # Reset to original before applying effect
-            self.pixmap = self.original_pixmap.copy()
+            result = self.original_pixmap.copy()
            
-            if method == "Simulated Threshold":
-                self.apply_simulated_threshold()
-            elif method == "Simulated Segmentation":
-                self.apply_simulated_segmentation()
+            if method == "Threshold" and self.whole_volume():
+                self.run_volume_threshold()
+                return
+            if method == "Threshold":
+                if self.threshold_preview is None:
+                    self.preview_timer.stop()
+                    self.preview_threshold()
+                result = self.threshold_preview.copy()
+            elif method == "K-means Segmentation":
+                # Runs in the background; the result is committed when it arrives
+                self.run_segmentation()
+                return
             elif method == "Drawing Mode":
                 # Just display the original image for drawing
                 pass
                
-            self.image_frame.setPixmap(self.pixmap)
-            
-            # Add to history
-            self.add_to_history(self.pixmap)
+            self.replace_pixmap(method, result)
    
-    def apply_simulated_threshold(self):
-        # This is a simplified simulation of thresholding without OpenCV
-        painter = QPainter(self.pixmap)
-        threshold = self.threshold_slider.value()
-       
-        # Get darker for higher thresholds (simple effect)
-        opacity = threshold / 100.0
-        painter.setOpacity(opacity)
-       
-        # Fill with semi-transparent black
-        painter.fillRect(self.pixmap.rect(), QColor(0, 0, 0, 128))
+    def run_segmentation(self):
+        from processing import remove_result
+        clusters = self.cluster_spinbox.value()
+        if self.whole_volume():
+            self.statusBar.showMessage(f"Segmenting all slices into {clusters} clusters...")
+            self.scheduler.submit(
+                "volume segmentation", volume_segmentation_job, self.dataset, clusters,
+                self.segmentation_model, self.preview_size(), self.result_dir,
+                version=lambda: (self.dataset_generation, self.cluster_spinbox.value()),
+                on_result=lambda results: self.volume_complete("segmentation_complete", results),
+                on_discard=self.discard_volume_results, reports_progress=True
+            )
+            return
+        self.statusBar.showMessage(f"Segmenting into {clusters} clusters...")
+        self.scheduler.submit(
+            "segmentation", segmentation_job, self.pyramid, clusters, self.segmentation_model,
+            self.display_level, self.result_dir,
+            version=self.segmentation_version, on_result=self.segmentation_complete,
+            on_discard=lambda result: remove_result(result[1]), reports_progress=True
+        )
+   
+    def segmentation_version(self):
+        return (self.image_generation, self.cluster_spinbox.value())
+   
+    def segmentation_complete(self, result):
+        from image_pyramid import array_to_qimage
+        from processing import remove_result
+        model, labels, preview = result
+        self.segmentation_model = model
+        if self.segmentation_labels is not None:
+            remove_result(self.segmentation_labels)
+        self.segmentation_labels = labels
+        
+        # Blend the segment colors over the original image
+        result = self.original_pixmap.copy()
+        painter = QPainter(result)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.setOpacity(SEGMENT_OPACITY)
+        painter.drawImage(result.rect(), array_to_qimage(preview))
         painter.end()
+        self.replace_pixmap("K-means Segmentation", result)
+        self.statusBar.showMessage(f"Segmented into {model.n_clusters} clusters "
+                                   f"({model.n_iter} mini-batch iterations)")
    
-    def apply_simulated_segmentation(self):
-        # Simulate segmentation with colored regions
-        painter = QPainter(self.pixmap)
-        clusters = self.cluster_spinbox.value()
-       
-        # Create random-like segments based on cluster count
-        height = self.pixmap.height()
-        width = self.pixmap.width()
-       
-        # Simulate segments with rectangles
-        for i in range(clusters):
-            # Different colors for different segments
-            color = QColor(
-                (73 * i) % 256,
-                (169 * i) % 256,
-                (253 * i) % 256,
-                100  # Semi-transparent
+    def run_analysis(self):
+        from processing import remove_result
+        if self.image_path and self.whole_volume():
+            self.statusBar.showMessage("Training pixel classifier on the annotations "
+                                       "of all slices...")
+            self.feature_cache.reset_stats()
+            slice_labels = {}
+            if self.project is not None:
+                slice_labels = dict.fromkeys(self.project.label_slices())
+            slice_labels.update((index, state["labels"])
+                                for index, state in self.slice_states.items()
+                                if state.get("labels") is not None)
+            slice_labels[self.slice_index] = self.labels
+            self.scheduler.submit(
+                "volume classification", volume_classification_job, self.dataset, slice_labels,
+                self.project, self.preview_size(), self.result_dir, self.feature_cache,
+                version=lambda: (self.dataset_generation, self.labels_version),
+                on_result=lambda results: self.volume_complete("analysis_complete", results),
+                on_error=self.analysis_failed, on_discard=self.discard_volume_results,
+                reports_progress=True
             )
-           
-            painter.fillRect(
-                QRect(
-                    width * (i % 2) // 2,
-                    height * (i // 2) // (clusters // 2 + 1),
-                    width // 2,
-                    height // (clusters // 2 + 1)
-                ),
-                color
+        elif self.image_path:
+            self.statusBar.showMessage("Training pixel classifier on the annotations...")
+            self.feature_cache.reset_stats()
+            self.scheduler.submit(
+                "classification", classification_job, self.pyramid, self.labels,
+                self.display_level, self.result_dir, self.feature_cache,
+                version=self.classification_version, on_result=self.analysis_complete,
+                on_error=self.analysis_failed,
+                on_discard=lambda result: remove_result(result[1]), reports_progress=True
             )
-       
+    
+    def classification_version(self):
+        # Strokes made while training invalidate the result
+        return (self.image_generation, self.labels_version)
+    
+    def analysis_failed(self, message):
+        self.statusBar.showMessage(message)
+    
+    def analysis_complete(self, result):
+        from image_pyramid import array_to_qimage
+        from processing import remove_result
+        classifier, probabilities, preview = result
+        if classifier is not self.classifier:
+            self.model_version += 1
+        self.classifier = classifier
+        if self.probabilities is not None:
+            remove_result(self.probabilities)
+        self.probabilities = probabilities
+        
+        # Every tile is now predicted by this model, so live update has
+        # nothing left to do until the next stroke
+        self.cancel_live_jobs()
+        self.clear_live_overlay()
+        self.live_tiles = {tile[:2]: self.model_version
+                           for tile in self.pyramid.iter_tiles(0)}
+        
+        # Display the prediction over the image
+        result = self.original_pixmap.copy()
+        painter = QPainter(result)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.setOpacity(PREDICTION_OPACITY)
+        painter.drawImage(result.rect(), array_to_qimage(preview))
         painter.end()
+        self.replace_pixmap("Pixel Classification", result)
+        stats = self.feature_cache.stats()
+        self.statusBar.showMessage(f"Pixel classification complete "
+                                   f"({len(classifier.forest.trees)} trees, "
+                                   f"{len(classifier.specs)} filters, "
+                                   f"feature cache {stats['hit_rate']:.0%} hits)")
    
-    def run_simulated_analysis(self):
-        if self.image_path:
-            self.statusBar.showMessage("Running simulated analysis...")
-            self.progress_bar.setVisible(True)
-            
-            # Start at 0%
-            self.progress_bar.setValue(0)
-            
-            # Simulate progress with a QThread
-            class AnalysisThread(QThread):
-                progress = pyqtSignal(int)
-                finished = pyqtSignal(QPixmap)
-                
-                def __init__(self, pixmap):
-                    super().__init__()
-                    self.pixmap = pixmap
-                
-                def run(self):
-                    # Simulate processing steps
-                    for i in range(0, 101, 5):
-                        self.progress.emit(i)
-                        self.msleep(100)  # Simulate processing delay
-                    
-                    # Create a copy to work with
-                    analysis_pixmap = self.pixmap.copy()
-                    painter = QPainter(analysis_pixmap)
-                    
-                    # Draw colored overlay simulating analysis results
-                    painter.setOpacity(0.5)
-                    
-                    # Draw some simulated detected regions
-                    painter.setPen(QPen(Qt.green, 2))
-                    painter.drawEllipse(analysis_pixmap.width() // 4, analysis_pixmap.height() // 4,
-                                        analysis_pixmap.width() // 2, analysis_pixmap.height() // 2)
-                    
-                    painter.setPen(QPen(Qt.blue, 2))
-                    painter.drawRect(analysis_pixmap.width() // 3, analysis_pixmap.height() // 3,
-                                    analysis_pixmap.width() // 3, analysis_pixmap.height() // 3)
-                    
-                    # Add some text showing it's a result
-                    painter.setOpacity(1.0)
-                    painter.setPen(QPen(Qt.white, 2))
-                    painter.drawText(10, 30, "Analysis Complete: 3 objects found")
-                    
-                    painter.end()
-                    
-                    self.finished.emit(analysis_pixmap)
-            
-            # Create and start the analysis thread
-            self.analysis_thread = AnalysisThread(self.pixmap)
-            self.analysis_thread.progress.connect(self.progress_bar.setValue)
-            self.analysis_thread.finished.connect(self.analysis_complete)
-            self.analysis_thread.start()
-    
-    def analysis_complete(self, result_pixmap):
-        # Display the result
-        self.pixmap = result_pixmap
-        self.image_frame.setPixmap(self.pixmap)
-        self.progress_bar.setVisible(False)
-        self.statusBar.showMessage("Analysis simulation complete")
+    def labels_edited(self):
+        # Live predictions are redone for the new labels; without live
+        # update they would be stale, so they are dropped
+        if self.live_checkbox.isChecked():
+            self.live_timer.start()
+        else:
+            self.clear_live_overlay()
+    
+    def set_live_update(self, enabled):
+        if enabled:
+            # Predictions of the current model are picked up right away
+            self.schedule_live_tiles()
+            self.live_timer.start()
+        else:
+            self.live_timer.stop()
+            self.scheduler.cancel("live training")
+            self.cancel_live_jobs()
+    
+    def cancel_live_jobs(self):
+        self.live_queue = []
+        for key in list(self.scheduler.jobs):
+            if key.startswith("live tile "):
+                self.scheduler.cancel(key)
+    
+    def clear_live_overlay(self):
+        if self.live_overlay is not None:
+            self.live_overlay = None
+            self.live_tiles = {}
+            self.image_frame.set_overlay(None)
+    
+    def run_live_training(self):
+        if not self.image_path or not self.live_checkbox.isChecked():
+            return
+        self.feature_cache.reset_stats()
+        tiles = list(self.labels.labeled_tiles(self.pyramid.tile_size))
+        self.scheduler.submit(
+            "live training", live_training_job, self.pyramid, tiles, self.feature_cache,
+            priority=INTERACTIVE, version=self.classification_version,
+            on_result=self.live_trained, on_error=self.live_failed
+        )
+    
+    def live_trained(self, classifier):
+        self.classifier = classifier
+        self.model_version += 1
+        self.cancel_live_jobs()
+        self.schedule_live_tiles()
+    
+    def live_failed(self, message):
+        self.statusBar.showMessage(f"Live update: {message}")
+    
+    def schedule_live_tiles(self):
+        # Queue every tile the current model has not predicted yet
+        if (not self.live_checkbox.isChecked() or self.classifier is None
+                or self.pyramid is None):
+            return
+        self.live_queue = [tile for tile in self.pyramid.iter_tiles(0)
+                           if self.live_tiles.get(tile[:2]) != self.model_version]
+        self.order_live_tiles()
+    
+    def order_live_tiles(self):
+        # Nearest to the viewport first; called again whenever the view settles
+        if not self.live_queue:
+            return
+        self.live_queue.sort(key=self.live_distance())
+        self.fill_live_queue()
+    
+    def live_distance(self):
+        # Returns distance(tile): tiles between it and the viewport, 0 for
+        # visible tiles
+        size = self.pyramid.tile_size
+        x, y, width, height = self.image_frame.visible_image_rect()
+        row0, col0 = y // size, x // size
+        row1, col1 = (y + max(height, 1) - 1) // size, (x + max(width, 1) - 1) // size
+        return lambda tile: max(row0 - tile[0], tile[0] - row1, col0 - tile[1], tile[1] - col1, 0)
+    
+    def fill_live_queue(self):
+        # Visible tiles first among the background jobs, then nearby ones,
+        # then the rest
+        queued = sum(1 for key in self.scheduler.jobs if key.startswith("live tile "))
+        distance_to = self.live_distance()
+        while self.live_queue and queued < LIVE_QUEUE:
+            tile = self.live_queue.pop(0)
+            priority = BACKGROUND + min(distance_to(tile), LIVE_NEARBY + 1)
+            self.scheduler.submit(
+                f"live tile {tile[0]},{tile[1]}", live_tile_job, self.classifier, self.pyramid,
+                tile, priority=priority,
+                version=lambda: (self.image_generation, self.model_version),
+                on_result=self.live_tile_done, on_error=self.live_failed
+            )
+            queued += 1
+    
+    def live_tile_done(self, result):
+        from classifier import N_LABELS
+        from image_pyramid import array_to_qimage
+        from processing import allocate_result
+        tile, probabilities, colors = result
+        row, col, x, y, w, h = tile
+        if self.probabilities is None:
+            self.probabilities = allocate_result(
+                (self.pyramid.height, self.pyramid.width, N_LABELS), self.result_dir)
+        self.probabilities[y:y + h, x:x + w] = probabilities
+        self.live_tiles[(row, col)] = self.model_version
+        
+        # Blend the tile over the original into the canvas overlay; live
+        # results stay out of the pixmap and its undo history
+        if self.live_overlay is None:
+            self.live_overlay = QImage(self.original_pixmap.size(),
+                                       QImage.Format_ARGB32_Premultiplied)
+            self.live_overlay.fill(Qt.transparent)
+            self.image_frame.set_overlay(self.live_overlay)
+        scale = self.live_overlay.width() / self.pyramid.width
+        target = QRectF(x * scale, y * scale, w * scale, h * scale)
+        painter = QPainter(self.live_overlay)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawPixmap(target, self.original_pixmap, target)
+        painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        painter.setOpacity(PREDICTION_OPACITY)
+        painter.drawImage(target, array_to_qimage(colors))
+        painter.end()
+        self.image_frame.refresh_overlay(x, y, w, h)
+        
+        rows, cols = self.pyramid.tile_grid(0)
+        done = sum(1 for version in self.live_tiles.values() if version == self.model_version)
+        self.statusBar.showMessage(f"Live update: {done}/{rows * cols} tiles predicted")
+        self.fill_live_queue()
+    
+    def object_mask_source(self):
+        # Returns mask_tile(x, y, w, h) for the selected source, or None if
+        # that result has not been computed yet
+        index = self.object_source_combo.currentIndex()
+        if index == 0:
+            mask = self.threshold_mask
+            if mask is None:
+                return None
+            return lambda x, y, w, h: mask[y:y + h, x:x + w] > 0
+        probabilities = self.probabilities
+        if probabilities is None:
+            return None
+        return lambda x, y, w, h: probabilities[y:y + h, x:x + w].argmax(axis=-1) == index - 1
+    
+    def run_object_detection(self):
+        from processing import remove_result
+        if not self.image_path:
+            return
+        mask_tile = self.object_mask_source()
+        if mask_tile is None:
+            self.statusBar.showMessage("Run a threshold or classification first")
+            return
+        self.statusBar.showMessage("Detecting objects...")
+        self.scheduler.submit(
+            "objects", objects_job, self.pyramid, mask_tile, self.display_level,
+            self.result_dir,
+            version=self.objects_version, on_result=self.objects_complete,
+            on_error=self.analysis_failed,
+            on_discard=lambda result: remove_result(result[1]), reports_progress=True
+        )
+    
+    def objects_version(self):
+        # A new threshold or prediction replaces the arrays being read
+        return (self.image_generation, self.object_source_combo.currentIndex(),
+                id(self.threshold_mask), id(self.probabilities))
+    
+    def objects_complete(self, result):
+        from image_pyramid import array_to_qimage
+        from processing import remove_result
+        table, objects, preview = result
+        if self.object_labels is not None:
+            remove_result(self.object_labels)
+        self.object_labels = objects
         
-        # Add to history
-        self.add_to_history(self.pixmap)
+        result = self.original_pixmap.copy()
+        painter = QPainter(result)
+        painter.setOpacity(OBJECT_OPACITY)
+        painter.drawImage(result.rect(), array_to_qimage(preview))
+        painter.end()
+        self.replace_pixmap("Object Detection", result)
+        self.build_object_panel().set_table(table)
+        self.object_dock.show()
+        self.statusBar.showMessage(f"Detected {len(table)} objects")
    
+    def whole_volume(self):
+        return self.volume_checkbox.isVisible() and self.volume_checkbox.isChecked()
+    
+    def preview_size(self):
+        return self.original_pixmap.width(), self.original_pixmap.height()
+    
+    def run_volume_threshold(self):
+        mode = self.threshold_mode_combo.currentText()
+        self.statusBar.showMessage(f"Thresholding all slices ({mode})...")
+        self.scheduler.submit(
+            "volume threshold", volume_threshold_job, self.dataset, mode,
+            self.threshold_slider.value(), self.per_channel_checkbox.isChecked(),
+            self.preview_size(), self.result_dir,
+            version=lambda: (self.dataset_generation,) + self.threshold_version()[1:],
+            on_result=lambda results: self.volume_complete("threshold_applied", results),
+            on_discard=self.discard_volume_results, reports_progress=True
+        )
+    
+    def threshold_applied(self, result):
+        self.threshold_refined(result)
+        self.replace_pixmap("Threshold", self.threshold_preview.copy())
+    
+    def volume_complete(self, handler, results):
+        # The shown slice takes its result now, the others when shown
+        from processing import remove_result
+        for index, result in results.items():
+            if index == self.slice_index:
+                getattr(self, handler)(result)
+                remove_result(result[-1])
+                continue
+            pending = self.slice_states.setdefault(index, {}).setdefault("pending", {})
+            if handler in pending:
+                remove_slice_result(pending[handler])
+            pending[handler] = result
+        self.statusBar.showMessage(f"{self.statusBar.currentMessage()} "
+                                   f"({len(results)} slices)")
+    
+    def discard_volume_results(self, results):
+        for result in results.values():
+            remove_slice_result(result)
+    
     def reset_image(self):
         if self.image_path:
-            self.pixmap = self.original_pixmap.copy()
-            self.image_frame.setPixmap(self.pixmap)
+            self.replace_pixmap("Reset", self.original_pixmap)
             self.statusBar.showMessage("Image reset")
-            
-            # Add to history
-            self.add_to_history(self.pixmap)
    
+    def export_outputs(self):
+        # Full-resolution outputs as (name, shape, dtype, read_chunk, rgb,
+        # attributes); None where the result has not been computed yet
+        from classifier import N_LABELS
+        pyramid, labels = self.pyramid, self.labels
+        size = (pyramid.height, pyramid.width)
+        outputs = {
+            "original": ("original", size + (4,), "uint8",
+                         lambda x, y, w, h: pyramid.read_region(0, x, y, w, h), True, None),
+            "labels": ("labels", size, "uint8", labels.read_region, False,
+                       {"labels": ["Unlabeled"] + LABEL_NAMES}),
+            "segmentation": None,
+            "probabilities": None,
+            "objects": None,
+        }
+        if self.segmentation_labels is not None:
+            segmentation = self.segmentation_labels
+            outputs["segmentation"] = (
+                "segmentation", size, "uint8",
+                lambda x, y, w, h: segmentation[y:y + h, x:x + w], False,
+                {"clusters": self.segmentation_model.n_clusters})
+        if self.probabilities is not None:
+            probabilities = self.probabilities
+            outputs["probabilities"] = (
+                "probabilities", probabilities.shape, "uint8",
+                lambda x, y, w, h: probabilities[y:y + h, x:x + w], False,
+                {"classes": LABEL_NAMES[:N_LABELS]})
+        if self.object_labels is not None:
+            objects = self.object_labels
+            outputs["objects"] = ("objects", size, "uint32",
+                                  lambda x, y, w, h: objects[y:y + h, x:x + w], False, None)
+        return outputs
+    
     def save_image(self):
-        if self.image_path:
+        # Export runs in the background and streams one chunk at a time
+        from export_dialog import ExportDialog
+        if not self.image_path:
+            return
+        outputs = self.export_outputs()
+        dialog = ExportDialog({name: output is not None for name, output in outputs.items()},
+                              os.path.dirname(self.image_path),
+                              self.dataset.slice_stem(self.slice_index), self)
+        if not dialog.exec_():
+            return
+        settings = dialog.settings()
+        self.statusBar.showMessage(f"Exporting {', '.join(settings['outputs'])}...")
+        self.scheduler.submit(
+            "export", export_job, [outputs[name] for name in settings["outputs"]], settings,
+            on_result=self.export_complete, on_error=self.export_failed, reports_progress=True
+        )
+    
+    def export_complete(self, paths):
+        self.statusBar.showMessage(f"Exported {len(paths)} outputs to "
+                                   f"{os.path.dirname(paths[0])}")
+    
+    def export_failed(self, message):
+        self.statusBar.showMessage(f"Export failed: {message}")
+    
+    def export_pipeline(self):
+        # Current threshold and segmentation settings, plus the classifier
+        # once one is trained; run it with `python batch.py`
+        from batch import save_pipeline
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "Save Pipeline", "", "Pipeline (*.json)"
+        )
+        if file_path:
+            save_pipeline(file_path, self.pipeline_config(), self.classifier)
+            self.statusBar.showMessage(f"Pipeline saved to {file_path}")
+    
+    def pipeline_config(self):
+        return {
+            "threshold": {
+                "mode": self.threshold_mode_combo.currentText(),
+                "value": self.threshold_slider.value(),
+                "per_channel": self.per_channel_checkbox.isChecked(),
+            },
+            "segmentation": {"clusters": self.cluster_spinbox.value()},
+        }
+    
+    def open_project(self):
+        from project import PROJECT_EXTENSION, Project
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, "Open Project", "", f"Project (*{PROJECT_EXTENSION})"
+        )
+        if not file_path:
+            return
+        if self.scheduler.is_pending(close_project_key(file_path)):
+            self.statusBar.showMessage("The project is still being saved; open it again shortly")
+            return
+        try:
+            project = Project.open(file_path)
+        except (OSError, ValueError) as e:
+            self.statusBar.showMessage(f"Failed to open project: {e}")
+            return
+        self.statusBar.showMessage(f"Opening project: {os.path.basename(file_path)}...")
+        dataset = project.dataset()
+        self.opening_project = (project, dataset)
+        self.load_slice(dataset, min(project.manifest.get("slice_index", 0), len(dataset) - 1))
+    
+    def restore_project(self, project):
+        # Called once the project's first slice is loaded; labels are read
+        # per slice as they are shown
+        self.project = project
+        config = project.manifest.get("pipeline", {})
+        threshold = config.get("threshold", {})
+        self.threshold_mode_combo.setCurrentText(threshold.get("mode", "Manual"))
+        self.threshold_slider.setValue(threshold.get("value", 50))
+        self.per_channel_checkbox.setChecked(threshold.get("per_channel", False))
+        self.cluster_spinbox.setValue(config.get("segmentation", {}).get("clusters", 3))
+        try:
+            self.classifier = project.load_classifier(self.feature_cache)
+        except (OSError, ValueError) as e:
+            self.statusBar.showMessage(f"Could not load the project classifier: {e}")
+        self.model_version += 1
+        self.saved_classifier = self.classifier
+        self.saved_fields = self.project_fields()
+        self.autosave_timer.start()
+    
+    def save_project(self):
+        # The first save writes every annotated chunk; after that only the
+        # changes are appended
+        from project import PROJECT_EXTENSION, Project
+        if not self.image_path:
+            return
+        if self.project is None:
             file_path, _ = QFileDialog.getSaveFileName(
-                self, "Save Image", "", "Images (*.png *.jpg *.bmp)"
+                self, "Save Project", "", f"Project (*{PROJECT_EXTENSION})"
             )
-            if file_path:
-                self.pixmap.save(file_path)
-                self.statusBar.showMessage(f"Image saved to {file_path}")
-
-app = QApplication(sys.argv)
-window = IlastikUI()
-window.show()
-sys.exit(app.exec_())
\ No newline at end of file
+            if not file_path:
+                return
+            if not file_path.endswith(PROJECT_EXTENSION):
+                file_path += PROJECT_EXTENSION
+            try:
+                project = Project.create(file_path, self.dataset)
+            except OSError as e:
+                self.statusBar.showMessage(f"Failed to save project: {e}")
+                return
+            self.project = project
+            self.saved_classifier = self.saved_fields = None
+            self.autosave(everything=True)
+            self.autosave_timer.start()
+        else:
+            self.autosave()
+    
+    def project_fields(self):
+        return {"slice_index": self.slice_index, "pipeline": self.pipeline_config()}
+    
+    def label_layers(self):
+        layers = {index: state["labels"] for index, state in self.slice_states.items()
+                  if state.get("labels") is not None}
+        if self.labels is not None:
+            layers[self.slice_index] = self.labels
+        return layers
+    
+    def project_changes(self, everything=False):
+        # Copies of what changed since the last save, taken on the GUI thread
+        # so strokes can continue while they are written
+        layers = {index: layer.dirty_chunks(everything)
+                  for index, layer in self.label_layers().items()}
+        chunks = [(index, row, col, data) for index, layer_chunks in layers.items()
+                  for row, col, _, data in layer_chunks]
+        fields = self.project_fields()
+        classifier = self.classifier if self.classifier is not self.saved_classifier else None
+        return layers, chunks, fields, classifier
+    
+    def autosave(self, everything=False):
+        # Skipped while the previous save is still being written
+        if self.project is None or self.scheduler.is_pending("autosave"):
+            return
+        layers, chunks, fields, classifier = self.project_changes(everything)
+        if not chunks and classifier is None and fields == self.saved_fields:
+            return
+        self.scheduler.submit(
+            "autosave", autosave_job, self.project, chunks, fields, classifier,
+            on_result=lambda _: self.project_saved(layers, fields, classifier),
+            on_error=self.project_save_failed
+        )
+    
+    def project_saved(self, layers, fields, classifier):
+        all_layers = self.label_layers()
+        for index, chunks in layers.items():
+            if index in all_layers:
+                all_layers[index].mark_saved(chunks)
+        self.saved_fields = fields
+        if classifier is not None:
+            self.saved_classifier = classifier
+        self.statusBar.showMessage(f"Project saved to {self.project.path}")
+    
+    def project_save_failed(self, message):
+        self.statusBar.showMessage(f"Failed to save project: {message}")
+    
+    def close_project(self):
+        # Writes the remaining changes before the image goes away. The write
+        # runs as a job that cancel_all leaves alone, so the GUI thread never
+        # waits for it; the scheduler only finishes it at shutdown
+        layers, chunks, fields, classifier = self.project_changes()
+        path = self.project.path
+        self.scheduler.submit(
+            close_project_key(path), autosave_job, self.project, chunks, fields, classifier,
+            on_result=lambda _: self.statusBar.showMessage(f"Project saved to {path}"),
+            on_error=self.project_save_failed, cancellable=False
+        )
+        self.autosave_timer.stop()
+        self.project = None
+        self.saved_classifier = self.saved_fields = None
+    
+    def closeEvent(self, event):
+        if self.project is not None:
+            self.close_project()
+        # Let background jobs stop before their scratch files go away
+        self.scheduler.shutdown()
+        if self.folder_panel is not None:
+            self.folder_panel.shutdown()
+        if self._feature_cache is not None:
+            self._feature_cache.close()
+        shutil.rmtree(self.result_dir, ignore_errors=True)
+        super().closeEvent(event)
+
+def warm_up(modules=WARM_UP_MODULES):
+    for name in modules:
+        importlib.import_module(name)
+
+def main(argv=None):
+    app = QApplication(sys.argv if argv is None else argv)
+    window = IlastikUI()
+    window.show()
+    # A module the user needs first is imported by whichever thread gets
+    # there first; the other waits for it
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    return app.exec_()
+
+if __name__ == "__main__":
+    sys.exit(main())
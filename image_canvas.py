@@ -0,0 +1,475 @@
+import math
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QPoint, QRect, QRectF, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QImage, QPainter
+from PyQt5.QtWidgets import QWidget
+
+from tracing import traced
+
+BACKGROUND_COLOR = QColor("#f0f0f0")
+
+# The view is rendered in square tiles of this many screen pixels
+VIEW_TILE = 256
+TILE_CACHE_BYTES = 96 * 1024 * 1024
+
+# Zoom and pan show nearest-neighbor tiles at once; smooth ones replace
+# them after this quiet period
+REFINE_DELAY_MS = 80
+
+MIN_ZOOM = 0.1
+MAX_ZOOM = 32.0
+WHEEL_ZOOM_STEP = 1.2
+
+
+class TileCache:
+    # LRU of rendered QImage tiles with a byte budget
+    def __init__(self, budget=TILE_CACHE_BYTES):
+        self.budget = budget
+        self.nbytes = 0
+        self.tiles = OrderedDict()
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile):
+        if key in self.tiles:
+            self.nbytes -= self.tiles.pop(key).sizeInBytes()
+        self.tiles[key] = tile
+        self.nbytes += tile.sizeInBytes()
+        while self.nbytes > self.budget and len(self.tiles) > 1:
+            _, old = self.tiles.popitem(last=False)
+            self.nbytes -= old.sizeInBytes()
+
+    def discard(self, match):
+        for key in [key for key in self.tiles if match(key)]:
+            self.nbytes -= self.tiles.pop(key).sizeInBytes()
+
+    def clear(self):
+        self.tiles.clear()
+        self.nbytes = 0
+
+
+class ImageCanvas(QWidget):
+    # Shows the display image with the label layer on top. Only the tiles
+    # in the viewport are rendered, first from the nearest mipmap of the
+    # display image; once the view settles, zoomed-in tiles are refined from
+    # the full-resolution pyramid if the display image shows its content.
+    # An optional overlay at display resolution goes between the image and
+    # the labels. Label changes repaint only the affected part of the view
+    zoom_changed = pyqtSignal(float)
+    view_settled = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pixmap = None
+        self.source = None
+        self.overlay = None
+        self.labels = None
+        self.image_width = 0
+        self.image_height = 0
+        self.zoom = 1.0
+        self.center = (0.0, 0.0)
+        self.mipmaps = []
+        self.generation = 0
+        self.tiles = TileCache()
+        self.lut = None
+        self.pan_anchor = None
+        self.refine_pending = False
+        self.refine_timer = QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(REFINE_DELAY_MS)
+        self.refine_timer.timeout.connect(self.refine)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+
+    def set_image(self, pixmap, labels, keep_view=False, source=None):
+        # keep_view holds zoom and position, e.g. when stepping through the
+        # slices of a stack, as long as the image size does not change
+        if not (keep_view and (labels.width, labels.height) == (self.image_width,
+                                                                 self.image_height)):
+            self.zoom = 1.0
+            self.center = (labels.width / 2, labels.height / 2)
+        if self.lut is None:
+            from annotation_layer import label_lut
+            self.lut = label_lut()
+        self.labels = labels
+        self.image_width = labels.width
+        self.image_height = labels.height
+        self.tiles.clear()
+        self.set_pixmap(pixmap, source)
+        self._clamp_center()
+
+    def set_pixmap(self, pixmap, source=None):
+        # New display content: drop its mipmaps and rendered image tiles,
+        # label tiles stay valid. `source` is a pyramid holding the same
+        # content at full resolution, or None if the pixmap differs from it
+        self.pixmap = pixmap
+        self.source = source
+        self.mipmaps = [pixmap.toImage().convertToFormat(QImage.Format_ARGB32_Premultiplied)]
+        self.generation += 1
+        self.tiles.discard(lambda key: key[0] == "image")
+        self.update()
+
+    def set_overlay(self, overlay):
+        # Display-resolution QImage drawn over the image, transparent where
+        # it does not apply; None removes it
+        self.overlay = overlay
+        self.tiles.discard(lambda key: key[0] == "overlay")
+        self.update()
+
+    def refresh_overlay(self, x, y, width, height):
+        # The overlay changed under an image-space rect
+        if self.pixmap is None:
+            return
+        rect = self.image_to_view_rect(x, y, width, height)
+        if rect.isEmpty():
+            return
+        col0, col1 = rect.left() // VIEW_TILE, rect.right() // VIEW_TILE
+        row0, row1 = rect.top() // VIEW_TILE, rect.bottom() // VIEW_TILE
+        self.tiles.discard(lambda key: key[0] == "overlay" and key[1] == self.zoom
+                           and col0 <= key[2] <= col1 and row0 <= key[3] <= row1)
+        self._discard_other_zooms("overlay", x, y, width, height)
+        self.update(rect.translated(self.image_origin()))
+
+    def _discard_other_zooms(self, kind, x, y, width, height):
+        # Cached tiles of `kind` at other zoom levels that overlap an
+        # image-space rect
+        def overlaps(key):
+            if key[0] != kind or key[1] == self.zoom:
+                return False
+            scale = key[1] * self.pixmap.width() / self.image_width
+            tile_x, tile_y = key[2] * VIEW_TILE / scale, key[3] * VIEW_TILE / scale
+            size = VIEW_TILE / scale
+            return (tile_x < x + width and x < tile_x + size
+                    and tile_y < y + height and y < tile_y + size)
+        self.tiles.discard(overlaps)
+
+    def set_zoom(self, zoom, anchor=None):
+        # Zoom relative to the display image, keeping the image point under
+        # `anchor` (widget coordinates, default the center) in place
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        if self.pixmap is None or zoom == self.zoom:
+            self.zoom = zoom
+            return self.zoom
+        if anchor is None:
+            anchor = self.rect().center()
+        ax, ay = self.widget_to_image(anchor)
+        self.zoom = zoom
+        scale = self.view_scale
+        self.center = (ax - (anchor.x() - self.width() / 2) / scale,
+                       ay - (anchor.y() - self.height() / 2) / scale)
+        self._clamp_center()
+        self.schedule_refine()
+        self.update()
+        return self.zoom
+
+    @property
+    def view_scale(self):
+        # View pixels per image pixel
+        if self.pixmap is None or not self.image_width:
+            return 1.0
+        return self.zoom * self.pixmap.width() / self.image_width
+
+    def view_size(self):
+        return (int(round(self.pixmap.width() * self.zoom)),
+                int(round(self.pixmap.height() * self.zoom)))
+
+    def _clamp_center(self):
+        # Images smaller than the widget stay centered; larger ones cannot be
+        # panned past their edges
+        scale = self.view_scale
+        center = list(self.center)
+        for axis, (extent, size) in enumerate(((self.image_width, self.width()),
+                                               (self.image_height, self.height()))):
+            half = size / 2 / scale
+            if extent * scale <= size:
+                center[axis] = extent / 2
+            else:
+                center[axis] = min(max(center[axis], half), extent - half)
+        self.center = tuple(center)
+
+    def image_origin(self):
+        # Widget position of the image's top-left corner
+        scale = self.view_scale
+        return QPoint(int(round(self.width() / 2 - self.center[0] * scale)),
+                      int(round(self.height() / 2 - self.center[1] * scale)))
+
+    def widget_to_image(self, pos):
+        origin = self.image_origin()
+        scale = self.view_scale
+        return ((pos.x() - origin.x()) / scale, (pos.y() - origin.y()) / scale)
+
+    def visible_image_rect(self):
+        # (x, y, width, height) of the image under the widget
+        x0, y0 = self.widget_to_image(QPoint(0, 0))
+        x1, y1 = self.widget_to_image(QPoint(self.width(), self.height()))
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        x1 = min(self.image_width, int(math.ceil(x1)))
+        y1 = min(self.image_height, int(math.ceil(y1)))
+        return (x0, y0, max(0, x1 - x0), max(0, y1 - y0))
+
+    def image_to_view_rect(self, x, y, width, height):
+        scale = self.view_scale
+        x0, y0 = int(math.floor(x * scale)), int(math.floor(y * scale))
+        x1 = int(math.ceil((x + width) * scale))
+        y1 = int(math.ceil((y + height) * scale))
+        return QRect(x0, y0, x1 - x0, y1 - y0).intersected(QRect(0, 0, *self.view_size()))
+
+    def begin_pan(self, pos):
+        self.pan_anchor = pos
+        self.setCursor(Qt.ClosedHandCursor)
+
+    def drag_pan(self, pos):
+        if self.pan_anchor is None:
+            return
+        scale = self.view_scale
+        delta = pos - self.pan_anchor
+        self.pan_anchor = pos
+        self.center = (self.center[0] - delta.x() / scale, self.center[1] - delta.y() / scale)
+        self._clamp_center()
+        self.schedule_refine()
+        self.update()
+
+    def end_pan(self):
+        self.pan_anchor = None
+        self.unsetCursor()
+
+    @property
+    def panning(self):
+        return self.pan_anchor is not None
+
+    def wheelEvent(self, event):
+        if self.pixmap is None:
+            return
+        steps = event.angleDelta().y() / 120
+        if steps:
+            self.set_zoom(self.zoom * WHEEL_ZOOM_STEP ** steps, event.pos())
+            self.zoom_changed.emit(self.zoom)
+        event.accept()
+
+    def resizeEvent(self, event):
+        if self.pixmap is not None:
+            self._clamp_center()
+        super().resizeEvent(event)
+
+    def _mipmap(self, level):
+        # Halved copies of the display image, built on first use
+        while len(self.mipmaps) <= level:
+            previous = self.mipmaps[-1]
+            self.mipmaps.append(previous.scaled(
+                max(1, (previous.width() + 1) // 2), max(1, (previous.height() + 1) // 2),
+                Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+            ))
+        return self.mipmaps[level]
+
+    def _mipmap_level(self):
+        # Smallest mipmap that still has at least one texel per view pixel
+        if self.zoom >= 1.0:
+            return 0
+        limit = max(self.pixmap.width(), self.pixmap.height()).bit_length() - 1
+        return min(int(math.floor(-math.log2(self.zoom))), limit)
+
+    def _exact(self):
+        return self.zoom == 1.0
+
+    def _detailed(self):
+        # Zoomed in past the display image, which is a reduced level
+        return (self.source is not None and self.zoom > 1.0
+                and self.pixmap.width() < self.image_width)
+
+    def _visible_tiles(self, rect):
+        # (col, row) of every view tile under a widget rect
+        origin = self.image_origin()
+        width, height = self.view_size()
+        view = rect.translated(-origin).intersected(QRect(0, 0, width, height))
+        if view.isEmpty():
+            return []
+        return [(col, row)
+                for row in range(view.top() // VIEW_TILE, view.bottom() // VIEW_TILE + 1)
+                for col in range(view.left() // VIEW_TILE, view.right() // VIEW_TILE + 1)]
+
+    @traced("render image tile", "render")
+    def _render_image_tile(self, col, row, smooth):
+        if smooth and self._detailed():
+            return self._render_source_tile(col, row)
+        level = self._mipmap_level()
+        source = self._mipmap(level)
+        width, height = self.view_size()
+        tile = QImage(min(VIEW_TILE, width - col * VIEW_TILE),
+                      min(VIEW_TILE, height - row * VIEW_TILE),
+                      QImage.Format_ARGB32_Premultiplied)
+        fx, fy = source.width() / width, source.height() / height
+        painter = QPainter(tile)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, smooth)
+        painter.drawImage(QRectF(0, 0, tile.width(), tile.height()), source,
+                          QRectF(col * VIEW_TILE * fx, row * VIEW_TILE * fy,
+                                 tile.width() * fx, tile.height() * fy))
+        painter.end()
+        return tile
+
+    @traced("render source tile", "render")
+    def _render_source_tile(self, col, row):
+        # Read the view tile from the coarsest pyramid level that still has
+        # a pixel per view pixel, plus a pixel of margin for the filter
+        from image_pyramid import array_to_qimage
+        width, height = self.view_size()
+        tile = QImage(min(VIEW_TILE, width - col * VIEW_TILE),
+                      min(VIEW_TILE, height - row * VIEW_TILE),
+                      QImage.Format_ARGB32_Premultiplied)
+        scale = self.view_scale
+        level = self.source.level_for_scale(scale)
+        factor = scale * self.source.level_scale(level)
+        x0, y0 = col * VIEW_TILE / factor, row * VIEW_TILE / factor
+        x1, y1 = x0 + tile.width() / factor, y0 + tile.height() / factor
+        left, top = max(0, int(math.floor(x0)) - 1), max(0, int(math.floor(y0)) - 1)
+        region = self.source.read_region(level, left, top,
+                                         int(math.ceil(x1)) + 1 - left,
+                                         int(math.ceil(y1)) + 1 - top)
+        painter = QPainter(tile)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+        painter.drawImage(QRectF(0, 0, tile.width(), tile.height()), array_to_qimage(region),
+                          QRectF(x0 - left, y0 - top, x1 - x0, y1 - y0))
+        painter.end()
+        return tile
+
+    def _image_tile(self, col, row):
+        # Smooth tile if one is cached, else a cached or freshly rendered
+        # nearest-neighbor one that refine() replaces later
+        smooth = self.tiles.get(("image", self.generation, self.zoom, col, row, True))
+        if smooth is not None:
+            return smooth
+        if self._exact():
+            tile = self._render_image_tile(col, row, False)
+            self.tiles.put(("image", self.generation, self.zoom, col, row, True), tile)
+            return tile
+        key = ("image", self.generation, self.zoom, col, row, False)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self._render_image_tile(col, row, False)
+            self.tiles.put(key, tile)
+        self.refine_pending = True
+        return tile
+
+    def _overlay_tile(self, col, row):
+        key = ("overlay", self.zoom, col, row)
+        tile = self.tiles.get(key)
+        if tile is None:
+            width, height = self.view_size()
+            tile = QImage(min(VIEW_TILE, width - col * VIEW_TILE),
+                          min(VIEW_TILE, height - row * VIEW_TILE),
+                          QImage.Format_ARGB32_Premultiplied)
+            fx, fy = self.overlay.width() / width, self.overlay.height() / height
+            painter = QPainter(tile)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.drawImage(QRectF(0, 0, tile.width(), tile.height()), self.overlay,
+                              QRectF(col * VIEW_TILE * fx, row * VIEW_TILE * fy,
+                                     tile.width() * fx, tile.height() * fy))
+            painter.end()
+            self.tiles.put(key, tile)
+        return tile
+
+    @traced("render label tile", "render")
+    def _render_label_tile(self, col, row, tile, rect=None):
+        # Render the labels under a view rect (default the whole tile) into it
+        x0, y0 = col * VIEW_TILE, row * VIEW_TILE
+        if rect is None:
+            rect = QRect(x0, y0, tile.width(), tile.height())
+        from annotation_layer import render_labels
+        from image_pyramid import qimage_to_array
+        view = qimage_to_array(tile, writable=True)
+        view[rect.top() - y0:rect.bottom() + 1 - y0, rect.left() - x0:rect.right() + 1 - x0] = \
+            render_labels(self.labels, self.view_scale, rect.x(), rect.y(),
+                          rect.width(), rect.height(), self.lut)
+
+    def _label_tile(self, col, row):
+        key = ("labels", self.zoom, col, row)
+        tile = self.tiles.get(key)
+        if tile is None:
+            width, height = self.view_size()
+            tile = QImage(min(VIEW_TILE, width - col * VIEW_TILE),
+                          min(VIEW_TILE, height - row * VIEW_TILE),
+                          QImage.Format_RGBA8888_Premultiplied)
+            self._render_label_tile(col, row, tile)
+            self.tiles.put(key, tile)
+        return tile
+
+    def schedule_refine(self):
+        # Restarted by every zoom and pan step, so smoothing waits until the
+        # view settles
+        self.refine_timer.start()
+
+    @traced("refine", "render")
+    def refine(self):
+        if self.pixmap is None or self.pan_anchor is not None:
+            return
+        self.refine_pending = False
+        self.view_settled.emit()
+        if self._exact():
+            return
+        for col, row in self._visible_tiles(self.rect()):
+            key = ("image", self.generation, self.zoom, col, row, True)
+            if self.tiles.get(key) is None:
+                self.tiles.put(key, self._render_image_tile(col, row, True))
+        self.update()
+
+    def refresh_labels(self, x, y, width, height):
+        # Re-render the cached label tiles under an image-space rect and
+        # repaint just that part of the widget; the tiles of other zoom
+        # levels under it are dropped
+        if self.pixmap is None:
+            return
+        rect = self.image_to_view_rect(x, y, width, height)
+        if rect.isEmpty():
+            return
+        self._discard_other_zooms("labels", x, y, width, height)
+        for row in range(rect.top() // VIEW_TILE, rect.bottom() // VIEW_TILE + 1):
+            for col in range(rect.left() // VIEW_TILE, rect.right() // VIEW_TILE + 1):
+                tile = self.tiles.get(("labels", self.zoom, col, row))
+                if tile is not None:
+                    bounds = QRect(col * VIEW_TILE, row * VIEW_TILE, tile.width(), tile.height())
+                    self._render_label_tile(col, row, tile, rect.intersected(bounds))
+        self.update(rect.translated(self.image_origin()))
+
+    def composite(self):
+        # Display-resolution image with the overlay and labels drawn on top
+        from annotation_layer import render_labels
+        from image_pyramid import qimage_to_array
+        result = self.pixmap.copy()
+        if self.overlay is not None:
+            painter = QPainter(result)
+            painter.drawImage(result.rect(), self.overlay)
+            painter.end()
+        overlay = QImage(result.size(), QImage.Format_RGBA8888_Premultiplied)
+        scale = result.width() / self.image_width
+        qimage_to_array(overlay, writable=True)[:] = render_labels(
+            self.labels, scale, 0, 0, result.width(), result.height(), self.lut
+        )
+        painter = QPainter(result)
+        painter.drawImage(0, 0, overlay)
+        painter.end()
+        return result
+
+    @traced("paint", "render")
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        target = event.rect()
+        painter.fillRect(target, BACKGROUND_COLOR)
+        if self.pixmap is not None:
+            origin = self.image_origin()
+            for col, row in self._visible_tiles(target):
+                position = origin + QPoint(col * VIEW_TILE, row * VIEW_TILE)
+                painter.drawImage(position, self._image_tile(col, row))
+                if self.overlay is not None:
+                    painter.drawImage(position, self._overlay_tile(col, row))
+                if self.labels is not None:
+                    painter.drawImage(position, self._label_tile(col, row))
+            if self.refine_pending and not self.refine_timer.isActive():
+                self.schedule_refine()
+        painter.setPen(Qt.black)
+        painter.drawRect(self.rect().adjusted(0, 0, -1, -1))
+        painter.end()
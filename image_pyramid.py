@@ -0,0 +1,313 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QImage, QImageReader, QImageIOHandler
+
+from tracing import traced
+
+TILE_SIZE = 512
+PYRAMID_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ilastik_ui_pyramids")
+
+# Share of the progress range spent decoding; the rest goes to downsampling
+DECODE_PROGRESS = 70
+
+
+def qimage_to_array(image, writable=False):
+    # RGBA view onto the buffer of a 32-bit RGBA QImage; the caller must keep
+    # the image alive for as long as the view is used
+    if image.format() not in (QImage.Format_RGBA8888, QImage.Format_RGBA8888_Premultiplied):
+        raise ValueError("Expected an RGBA8888 image")
+    height, width = image.height(), image.width()
+    ptr = image.bits() if writable else image.constBits()
+    ptr.setsize(image.bytesPerLine() * height)
+    array = np.frombuffer(ptr, np.uint8).reshape(height, image.bytesPerLine())
+    return array[:, :width * 4].reshape(height, width, 4)
+
+
+def array_to_qimage(array):
+    # Copy an (h, w, 4) RGBA or (h, w) grayscale array into a new QImage
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    if array.ndim == 2:
+        image = QImage(array.data, width, height, width, QImage.Format_Grayscale8)
+    else:
+        image = QImage(array.data, width, height, width * 4, QImage.Format_RGBA8888)
+    return image.copy()
+
+
+def downsample(block):
+    # 2x2 box filter; odd edges are replicated so every level covers the image
+    if block.shape[0] % 2:
+        block = np.concatenate([block, block[-1:]], axis=0)
+    if block.shape[1] % 2:
+        block = np.concatenate([block, block[:, -1:]], axis=1)
+    h, w = block.shape[0] // 2, block.shape[1] // 2
+    summed = block.reshape(h, 2, w, 2, -1).sum(axis=(1, 3), dtype=np.uint16)
+    return ((summed + 2) >> 2).astype(np.uint8)
+
+
+class ImagePyramid:
+    def __init__(self, directory, tile_size, level_shapes):
+        self.directory = directory
+        self.tile_size = tile_size
+        self.level_shapes = [tuple(shape) for shape in level_shapes]
+        self.levels = [
+            np.load(self._level_path(directory, level), mmap_mode="r+")
+            for level in range(len(self.level_shapes))
+        ]
+
+    def __reduce__(self):
+        # Pickle by reference to the on-disk levels so worker processes
+        # reopen the memory maps instead of copying pixel data
+        return (ImagePyramid, (self.directory, self.tile_size, self.level_shapes))
+
+    @property
+    def width(self):
+        return self.level_shapes[0][1]
+
+    @property
+    def height(self):
+        return self.level_shapes[0][0]
+
+    @property
+    def level_count(self):
+        return len(self.level_shapes)
+
+    @property
+    def source_key(self):
+        # Identifies the pixels for caches without reading them: the cache
+        # directory is named by cache_key (path, mtime, size) for decoded
+        # files and is unique for generated pyramids
+        return os.path.basename(os.path.normpath(self.directory))
+
+    @staticmethod
+    def _level_path(directory, level):
+        return os.path.join(directory, f"level{level}.npy")
+
+    @staticmethod
+    def cache_key(image_path, tile_size=TILE_SIZE, page=0):
+        stat = os.stat(image_path)
+        key = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{tile_size}"
+        if page:
+            key += f"|{page}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def cached(cls, image_path, cache_dir=PYRAMID_CACHE_DIR, tile_size=TILE_SIZE, page=0):
+        directory = os.path.join(cache_dir, cls.cache_key(image_path, tile_size, page))
+        return os.path.exists(os.path.join(directory, "pyramid.json"))
+
+    @classmethod
+    def open(cls, image_path, cache_dir=PYRAMID_CACHE_DIR, tile_size=TILE_SIZE,
+             progress=None, cancelled=None, page=0):
+        # Reuse a previously decoded pyramid if the file has not changed.
+        # `page` selects an image of a multi-page file
+        directory = os.path.join(cache_dir, cls.cache_key(image_path, tile_size, page))
+        manifest = os.path.join(directory, "pyramid.json")
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                meta = json.load(f)
+            if progress:
+                progress(100)
+            return cls(directory, meta["tile_size"], meta["level_shapes"])
+        return cls.build(image_path, directory, tile_size, progress, cancelled, page)
+
+    @classmethod
+    def build(cls, image_path, directory=None, tile_size=TILE_SIZE,
+              progress=None, cancelled=None, page=0):
+        reader = QImageReader(image_path)
+        if page:
+            reader.jumpToImage(page)
+        size = reader.size()
+        if not size.isValid():
+            raise IOError(f"Cannot read {image_path}: {reader.errorString()}")
+        pyramid = cls.allocate(size.width(), size.height(), directory, tile_size)
+
+        try:
+            pyramid._decode(image_path, progress, cancelled, page)
+            pyramid._build_levels(progress, cancelled)
+        except BaseException:
+            pyramid.close(remove=True)
+            raise
+
+        pyramid.flush()
+        with open(os.path.join(pyramid.directory, "pyramid.json"), "w") as f:
+            json.dump({"tile_size": tile_size, "level_shapes": pyramid.level_shapes}, f)
+        return pyramid
+
+    @classmethod
+    def from_tiles(cls, read_tile, width, height, directory=None, tile_size=TILE_SIZE,
+                   progress=None, cancelled=None):
+        # Pyramid of an image that is produced tile by tile as
+        # read_tile(x, y, w, h) -> (h, w, 4) RGBA, e.g. a synthetic one
+        pyramid = cls.allocate(width, height, directory, tile_size)
+        try:
+            for row, col, x, y, w, h in pyramid.iter_tiles(0):
+                if cancelled and cancelled():
+                    raise InterruptedError("Pyramid build cancelled")
+                pyramid.levels[0][row, col, :h, :w] = read_tile(x, y, w, h)
+            pyramid._build_levels(progress, cancelled)
+        except BaseException:
+            pyramid.close(remove=True)
+            raise
+        pyramid.flush()
+        return pyramid
+
+    @classmethod
+    def allocate(cls, width, height, directory=None, tile_size=TILE_SIZE):
+        # Empty level files for an image of the given size
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="ilastik_pyramid_")
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+        level_shapes = [(height, width)]
+        while max(level_shapes[-1]) > tile_size:
+            h, w = level_shapes[-1]
+            level_shapes.append(((h + 1) // 2, (w + 1) // 2))
+        for level, (h, w) in enumerate(level_shapes):
+            rows, cols = math.ceil(h / tile_size), math.ceil(w / tile_size)
+            np.lib.format.open_memmap(
+                cls._level_path(directory, level), mode="w+", dtype=np.uint8,
+                shape=(rows, cols, tile_size, tile_size, 4)
+            )
+        return cls(directory, tile_size, level_shapes)
+
+    @traced("decode", "load")
+    def _decode(self, image_path, progress, cancelled, page=0):
+        # Decode one tile row at a time when the format supports clipped reads,
+        # otherwise decode once and scatter the rows into tiles. Pages past
+        # the first are always decoded whole
+        height, width = self.level_shapes[0]
+        rows = math.ceil(height / self.tile_size)
+        clipped = not page and QImageReader(image_path).supportsOption(QImageIOHandler.ClipRect)
+        full_image = None
+        if not clipped:
+            reader = QImageReader(image_path)
+            if page:
+                reader.jumpToImage(page)
+            full_image = reader.read()
+            if full_image.isNull():
+                raise IOError(f"Cannot decode {image_path}")
+
+        for row in range(rows):
+            if cancelled and cancelled():
+                raise InterruptedError("Pyramid build cancelled")
+            y = row * self.tile_size
+            strip_height = min(self.tile_size, height - y)
+            if clipped:
+                reader = QImageReader(image_path)
+                reader.setClipRect(QRect(0, y, width, strip_height))
+                strip = reader.read()
+                if strip.isNull():
+                    raise IOError(f"Cannot decode {image_path}: {reader.errorString()}")
+            else:
+                strip = full_image.copy(0, y, width, strip_height)
+            strip = strip.convertToFormat(QImage.Format_RGBA8888)
+            pixels = qimage_to_array(strip)
+            for col in range(self.levels[0].shape[1]):
+                x = col * self.tile_size
+                tile_width = min(self.tile_size, width - x)
+                self.levels[0][row, col, :strip_height, :tile_width] = \
+                    pixels[:, x:x + tile_width]
+            if progress:
+                progress(int(DECODE_PROGRESS * (row + 1) / rows))
+
+    @traced("build levels", "load")
+    def _build_levels(self, progress, cancelled):
+        total = sum(h * w for h, w in self.level_shapes[1:]) or 1
+        done = 0
+        for level in range(1, self.level_count):
+            for row, col, x, y, w, h in self.iter_tiles(level):
+                if cancelled and cancelled():
+                    raise InterruptedError("Pyramid build cancelled")
+                source = self.read_region(level - 1, 2 * x, 2 * y, 2 * w, 2 * h)
+                self.levels[level][row, col, :h, :w] = downsample(source)[:h, :w]
+                done += w * h
+            if progress:
+                progress(DECODE_PROGRESS + int((100 - DECODE_PROGRESS) * done / total))
+
+    def flush(self):
+        for level in self.levels:
+            level.flush()
+
+    def close(self, remove=False):
+        self.levels = []
+        if remove:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def level_shape(self, level):
+        return self.level_shapes[level]
+
+    def level_scale(self, level):
+        # Size of one level pixel relative to one full-resolution pixel
+        return 2 ** level
+
+    def level_for_scale(self, scale):
+        # Coarsest level that still has at least `scale` screen pixels per image pixel
+        if scale <= 0:
+            return self.level_count - 1
+        level = int(math.floor(math.log2(1.0 / scale))) if scale < 1 else 0
+        return max(0, min(level, self.level_count - 1))
+
+    def level_for_size(self, width, height):
+        scale = min(width / self.width, height / self.height)
+        return self.level_for_scale(scale)
+
+    def tile_grid(self, level):
+        return self.levels[level].shape[:2]
+
+    def iter_tiles(self, level):
+        height, width = self.level_shapes[level]
+        rows, cols = self.tile_grid(level)
+        for row in range(rows):
+            for col in range(cols):
+                x, y = col * self.tile_size, row * self.tile_size
+                yield (row, col, x, y,
+                       min(self.tile_size, width - x), min(self.tile_size, height - y))
+
+    def read_tile(self, level, row, col):
+        height, width = self.level_shapes[level]
+        h = min(self.tile_size, height - row * self.tile_size)
+        w = min(self.tile_size, width - col * self.tile_size)
+        return self.levels[level][row, col, :h, :w]
+
+    def read_region(self, level, x, y, width, height):
+        # Assemble a region from the tiles it overlaps; the result is clipped
+        # to the level bounds
+        level_height, level_width = self.level_shapes[level]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(level_width, x + width), min(level_height, y + height)
+        out = np.zeros((max(0, y1 - y0), max(0, x1 - x0), 4), np.uint8)
+        if out.size == 0:
+            return out
+        size = self.tile_size
+        for row in range(y0 // size, (y1 - 1) // size + 1):
+            for col in range(x0 // size, (x1 - 1) // size + 1):
+                tx0, ty0 = col * size, row * size
+                sx0, sy0 = max(x0, tx0), max(y0, ty0)
+                sx1, sy1 = min(x1, tx0 + size), min(y1, ty0 + size)
+                out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = \
+                    self.levels[level][row, col, sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0]
+        return out
+
+    def write_region(self, level, x, y, data):
+        size = self.tile_size
+        height, width = data.shape[:2]
+        for row in range(y // size, (y + height - 1) // size + 1):
+            for col in range(x // size, (x + width - 1) // size + 1):
+                tx0, ty0 = col * size, row * size
+                sx0, sy0 = max(x, tx0), max(y, ty0)
+                sx1, sy1 = min(x + width, tx0 + size), min(y + height, ty0 + size)
+                self.levels[level][row, col, sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0] = \
+                    data[sy0 - y:sy1 - y, sx0 - x:sx1 - x]
+
+    def read_level(self, level):
+        height, width = self.level_shapes[level]
+        return self.read_region(level, 0, 0, width, height)
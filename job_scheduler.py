@@ -0,0 +1,216 @@
+import heapq
+import itertools
+import threading
+import time
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+from tracing import span
+
+# Lower runs first. Interactive work (loading, anything the user waits on
+# in the viewport) always has a free thread; background full-resolution
+# work never takes the last one
+INTERACTIVE = 0
+BACKGROUND = 10
+
+JOB_THREADS = 3
+
+
+class Job:
+    # One unit of work. The function is called as function(job, *args) and
+    # should poll job.cancelled(); jobs submitted with reports_progress
+    # report job.set_progress(0-100)
+    def __init__(self, scheduler, key, function, args, priority, version, on_result,
+                 on_error, on_discard, reports_progress, cancellable):
+        self.scheduler = scheduler
+        self.key = key
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.version_function = version
+        self.version = version() if version is not None else None
+        self.on_result = on_result
+        self.on_error = on_error
+        self.on_discard = on_discard
+        self.reports_progress = reports_progress
+        self.cancellable = cancellable
+        self.progress = 0
+        self.submitted = time.perf_counter()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def set_progress(self, value):
+        # Called on the worker thread; the aggregate is recomputed on the
+        # GUI thread
+        self.progress = value
+        self.scheduler._progress_reported.emit()
+
+    def is_current(self):
+        # Delivered only while it is the newest job for its key and its
+        # inputs still match the state it was started from
+        if self.cancelled() or self.scheduler.jobs.get(self.key) is not self:
+            return False
+        return self.version_function is None or self.version_function() == self.version
+
+
+class JobScheduler(QObject):
+    # Runs jobs on a small pool of threads in priority order. Submitting a
+    # job under a key that is already queued or running supersedes the old
+    # job; results are handed back on the GUI thread, and only if current.
+    # progress and active_changed only cover jobs that report progress, so
+    # silent background work does not show up in a progress bar. Jobs
+    # submitted with cancellable=False survive cancel_all, and shutdown waits
+    # for them
+    progress = pyqtSignal(int)
+    active_changed = pyqtSignal(bool)
+    stale = pyqtSignal(str)
+    _finished = pyqtSignal(object, object, object)
+    _progress_reported = pyqtSignal()
+
+    def __init__(self, threads=JOB_THREADS, parent=None):
+        super().__init__(parent)
+        self.jobs = {}
+        self._queue = []
+        self._order = itertools.count()
+        self._running = set()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._last_progress = None
+        self._active = False
+        self._finished.connect(self._deliver)
+        self._progress_reported.connect(self._progress_changed, Qt.QueuedConnection)
+        self._threads = [threading.Thread(target=self._work, name=f"job-{i}", daemon=True)
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, function, *args, priority=BACKGROUND, version=None,
+               on_result=None, on_error=None, on_discard=None, reports_progress=False,
+               cancellable=True):
+        job = Job(self, key, function, args, priority, version, on_result, on_error, on_discard,
+                  reports_progress, cancellable)
+        with self._condition:
+            previous = self.jobs.get(key)
+            if previous is not None:
+                previous.cancel()
+            self.jobs[key] = job
+            heapq.heappush(self._queue, (priority, next(self._order), job))
+            self._condition.notify_all()
+        self._update_active()
+        self._progress_changed()
+        return job
+
+    def cancel(self, key):
+        with self._condition:
+            job = self.jobs.pop(key, None)
+        if job is not None:
+            job.cancel()
+            self._update_active()
+
+    def cancel_all(self):
+        with self._condition:
+            jobs = [job for job in self.jobs.values() if job.cancellable]
+            self.jobs = {key: job for key, job in self.jobs.items() if not job.cancellable}
+        for job in jobs:
+            job.cancel()
+        self._update_active()
+
+    def is_pending(self, key):
+        return key in self.jobs
+
+    @property
+    def busy(self):
+        return bool(self.jobs)
+
+    def shutdown(self):
+        # Cancel everything that can be and wait for running jobs to notice;
+        # the others are still run to the end
+        self.cancel_all()
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _next_job(self):
+        # Called with the lock held. Background jobs leave one thread free
+        while self._queue:
+            priority, _, job = self._queue[0]
+            if job.cancelled():
+                heapq.heappop(self._queue)
+                continue
+            background = sum(1 for running in self._running if running.priority >= BACKGROUND)
+            if priority >= BACKGROUND and background >= len(self._threads) - 1:
+                return None
+            heapq.heappop(self._queue)
+            return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None and not self._shutdown:
+                    self._condition.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+                self._running.add(job)
+            result = error = None
+            try:
+                if not job.cancelled():
+                    queued = (time.perf_counter() - job.submitted) * 1000
+                    with span(f"job {job.key}", "job", priority=job.priority,
+                              queued_ms=round(queued, 2)):
+                        result = job.function(job, *job.args)
+            except InterruptedError:
+                job.cancel()
+            except Exception as e:
+                error = e
+            with self._condition:
+                self._running.discard(job)
+                self._condition.notify_all()
+            self._finished.emit(job, result, error)
+
+    def _deliver(self, job, result, error):
+        # GUI thread: hand the result over, or let the job clean it up
+        current = job.is_current()
+        if job.key in self.jobs and self.jobs[job.key] is job:
+            del self.jobs[job.key]
+        if current and error is not None:
+            if job.on_error:
+                job.on_error(str(error))
+        elif current:
+            if job.on_result:
+                job.on_result(result)
+        else:
+            if result is not None and job.on_discard:
+                job.on_discard(result)
+            if not job.cancelled() and error is None:
+                self.stale.emit(job.key)
+        self._update_active()
+        self._progress_changed()
+
+    def _progress_changed(self):
+        # GUI thread: mean progress of the queued and running jobs that
+        # report progress
+        jobs = [job for job in list(self.jobs.values()) if job.reports_progress]
+        if not jobs:
+            return
+        value = int(sum(job.progress for job in jobs) / len(jobs))
+        if value != self._last_progress:
+            self._last_progress = value
+            self.progress.emit(value)
+
+    def _update_active(self):
+        active = any(job.reports_progress for job in list(self.jobs.values()))
+        if active != self._active:
+            self._active = active
+            if not active:
+                self._last_progress = None
+            self.active_changed.emit(active)
@@ -0,0 +1,100 @@
+import numpy as np
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt, pyqtSignal
+from PyQt5.QtWidgets import (QFileDialog, QHBoxLayout, QLabel, QPushButton, QTableView,
+                             QVBoxLayout, QWidget)
+
+from objects import OBJECT_DTYPE, export_objects
+
+
+class ObjectTableModel(QAbstractTableModel):
+    # Read-only view over a structured measurement array; the view only asks
+    # for visible rows, and sorting is one argsort of the column
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.table = np.zeros(0, OBJECT_DTYPE)
+
+    def set_table(self, table):
+        self.beginResetModel()
+        self.table = table
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.table)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(OBJECT_DTYPE.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        if role != Qt.DisplayRole:
+            return None
+        value = self.table[index.row()][index.column()]
+        if isinstance(value, np.floating):
+            return f"{value:.2f}"
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return OBJECT_DTYPE.names[section].replace("_", " ")
+        return str(section + 1)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if not len(self.table):
+            return
+        self.layoutAboutToBeChanged.emit()
+        order_index = np.argsort(self.table[OBJECT_DTYPE.names[column]], kind="stable")
+        if order == Qt.DescendingOrder:
+            order_index = order_index[::-1]
+        self.table = self.table[order_index]
+        self.layoutChanged.emit()
+
+
+class ObjectPanel(QWidget):
+    # Sortable measurement table with CSV/Parquet export
+    message = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout(self)
+        self.model = ObjectTableModel(self)
+        self.view = QTableView()
+        self.view.setModel(self.model)
+        self.view.setSortingEnabled(True)
+        self.view.verticalHeader().setVisible(False)
+        layout.addWidget(self.view)
+
+        footer = QHBoxLayout()
+        self.count_label = QLabel("No objects")
+        footer.addWidget(self.count_label)
+        footer.addStretch()
+        self.export_button = QPushButton("Export...")
+        self.export_button.clicked.connect(self.export)
+        self.export_button.setEnabled(False)
+        footer.addWidget(self.export_button)
+        layout.addLayout(footer)
+
+    def set_table(self, table):
+        self.model.set_table(table)
+        self.view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.count_label.setText(f"{len(table)} objects")
+        self.export_button.setEnabled(len(table) > 0)
+
+    def export(self):
+        file_path, selected = QFileDialog.getSaveFileName(
+            self, "Export Objects", "", "CSV (*.csv);;Parquet (*.parquet)"
+        )
+        if not file_path:
+            return
+        if not file_path.lower().endswith((".csv", ".parquet")):
+            file_path += ".parquet" if "parquet" in selected.lower() else ".csv"
+        try:
+            export_objects(self.model.table, file_path)
+        except (OSError, RuntimeError) as e:
+            self.message.emit(f"Export failed: {e}")
+            return
+        self.message.emit(f"Exported {len(self.model.table)} objects to {file_path}")
@@ -0,0 +1,273 @@
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_pyramid import downsample
+from processing import WORKERS, intensity
+from tracing import count_tiles, traced
+
+OBJECT_DTYPE = np.dtype([
+    ("id", np.int64),
+    ("area", np.int64),
+    ("centroid_x", np.float64),
+    ("centroid_y", np.float64),
+    ("bbox_x", np.int64),
+    ("bbox_y", np.int64),
+    ("bbox_width", np.int64),
+    ("bbox_height", np.int64),
+    ("mean_intensity", np.float64),
+])
+
+# Share of the progress range spent labeling tiles; the rest relabels them
+LABEL_PROGRESS = 70
+
+
+def object_palette():
+    # Background is transparent; object ids cycle through 255 colors
+    palette = np.zeros((256, 4), np.uint8)
+    for i in range(1, 256):
+        palette[i] = ((97 * i) % 256, (193 * i + 64) % 256, (59 * i + 128) % 256, 255)
+    return palette
+
+
+def mask_runs(mask):
+    # Horizontal foreground runs in row-major order as (row, start, end),
+    # end exclusive
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+
+def connect_runs(rows, starts, ends, width):
+    # Pairs of 8-connected runs in adjacent rows. Runs are sorted by
+    # (row, start) and never overlap within a row, so the partners of each
+    # run in the next row form one contiguous block
+    stride = width + 2
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    lo = np.searchsorted(end_keys, (rows + 1) * stride + starts, side="left")
+    hi = np.searchsorted(start_keys, (rows + 1) * stride + ends, side="right")
+    counts = np.maximum(hi - lo, 0)
+    a = np.repeat(np.arange(len(rows)), counts)
+    first = np.cumsum(counts) - counts
+    b = np.arange(counts.sum()) - np.repeat(first, counts) + np.repeat(lo, counts)
+    return a, b
+
+
+def union_find(n, a, b):
+    # Smallest member of the connected set of every node, by hooking roots
+    # onto the lower one and pointer jumping until all edges agree
+    parent = np.arange(n)
+    while len(a):
+        pa, pb = parent[a], parent[b]
+        if np.array_equal(pa, pb):
+            break
+        low = np.minimum(pa, pb)
+        np.minimum.at(parent, pa, low)
+        np.minimum.at(parent, pb, low)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+
+def component_stats(run_label, count, rows, starts, ends, values):
+    # Per-component sums and extents from the runs, in tile coordinates
+    lengths = ends - starts
+    cumulative = np.zeros((values.shape[0], values.shape[1] + 1), np.int64)
+    np.cumsum(values, axis=1, out=cumulative[:, 1:])
+    stats = {
+        "area": np.bincount(run_label, lengths, count),
+        "sum_x": np.bincount(run_label, lengths * (starts + ends - 1) / 2.0, count),
+        "sum_y": np.bincount(run_label, rows * lengths, count),
+        "sum_intensity": np.bincount(
+            run_label, cumulative[rows, ends] - cumulative[rows, starts], count),
+        "min_x": np.full(count, np.iinfo(np.int64).max),
+        "max_x": np.full(count, -1),
+        "min_y": np.full(count, np.iinfo(np.int64).max),
+        "max_y": np.full(count, -1),
+    }
+    np.minimum.at(stats["min_x"], run_label, starts)
+    np.maximum.at(stats["max_x"], run_label, ends - 1)
+    np.minimum.at(stats["min_y"], run_label, rows)
+    np.maximum.at(stats["max_y"], run_label, rows)
+    return stats
+
+
+def label_tile(mask, values):
+    # Connected components of one tile: local labels 1..count plus stats
+    rows, starts, ends = mask_runs(mask)
+    a, b = connect_runs(rows, starts, ends, mask.shape[1])
+    _, run_label = np.unique(union_find(len(rows), a, b), return_inverse=True)
+    run_label = run_label.ravel()
+    count = int(run_label.max()) + 1 if len(run_label) else 0
+    labels = np.zeros(mask.shape, np.uint32)
+    labels[mask] = np.repeat(run_label + 1, ends - starts)
+    return labels, count, component_stats(run_label, count, rows, starts, ends, values)
+
+
+def seam_pairs(first, second, diagonal=True):
+    # Label pairs that touch across a seam; the borders are the facing
+    # pixel lines of two neighboring tiles, in global provisional ids
+    offsets = (-1, 0, 1) if diagonal else (0,)
+    pairs = []
+    n = len(first)
+    for d in offsets:
+        a = first[max(0, -d):n - max(0, d)]
+        b = second[max(0, d):n - max(0, -d)]
+        keep = (a > 0) & (b > 0)
+        pairs.append((a[keep], b[keep]))
+    return pairs
+
+
+@traced("detect objects", "processing")
+def detect_objects(pyramid, mask_tile, out, preview_level=0, workers=WORKERS,
+                   progress=None, cancelled=None):
+    # Label the connected foreground components of a full-resolution mask
+    # tile by tile, merge them across tile seams and measure them. `out`
+    # receives the object ids (uint32); returns the measurement table and
+    # the colored objects at `preview_level`
+    tiles = list(pyramid.iter_tiles(0))
+    rows, cols = pyramid.tile_grid(0)
+    count_tiles(len(tiles))
+    done = [0]
+
+    def tick(share, offset):
+        done[0] += 1
+        if progress:
+            progress(offset + int(share * done[0] / len(tiles)))
+
+    def first_pass(tile):
+        if cancelled and cancelled():
+            return None
+        row, col, x, y, w, h = tile
+        mask = mask_tile(x, y, w, h)
+        values = intensity(pyramid.read_tile(0, row, col)[:h, :w])
+        labels, count, stats = label_tile(mask, values)
+        out[y:y + h, x:x + w] = labels
+        borders = (labels[:, 0], labels[:, -1], labels[0, :], labels[-1, :])
+        tick(LABEL_PROGRESS, 0)
+        return count, stats, borders
+
+    with ThreadPoolExecutor(workers) as pool:
+        results = list(pool.map(first_pass, tiles))
+    if cancelled and cancelled():
+        raise InterruptedError("Object detection cancelled")
+
+    # Provisional ids are tile offset + local label - 1; borders keep them 1-based
+    counts = np.array([result[0] for result in results], np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    total = int(offsets[-1])
+    borders = {}
+    for index, (row, col, *_) in enumerate(tiles):
+        borders[row, col] = [np.where(border > 0, border.astype(np.int64) + offsets[index], 0)
+                             for border in results[index][2]]
+
+    pairs = []
+    for row in range(rows):
+        for col in range(cols):
+            left, right, top, bottom = borders[row, col]
+            if col + 1 < cols:
+                pairs += seam_pairs(right, borders[row, col + 1][0])
+            if row + 1 < rows:
+                pairs += seam_pairs(bottom, borders[row + 1, col][2])
+                if col + 1 < cols:
+                    pairs += seam_pairs(bottom[-1:], borders[row + 1, col + 1][2][:1], False)
+                if col > 0:
+                    pairs += seam_pairs(bottom[:1], borders[row + 1, col - 1][2][-1:], False)
+    a = np.concatenate([p[0] for p in pairs] or [np.zeros(0, np.int64)]) - 1
+    b = np.concatenate([p[1] for p in pairs] or [np.zeros(0, np.int64)]) - 1
+    _, final = np.unique(union_find(total, a, b), return_inverse=True)
+    final = final.ravel()
+    n_objects = int(final.max()) + 1 if total else 0
+
+    # Merge the per-tile measurements into per-object ones
+    merged = {}
+    for name in ("area", "sum_x", "sum_y", "sum_intensity"):
+        merged[name] = np.zeros(n_objects)
+    for name in ("min_x", "min_y"):
+        merged[name] = np.full(n_objects, np.iinfo(np.int64).max)
+    for name in ("max_x", "max_y"):
+        merged[name] = np.full(n_objects, -1)
+    for index, (row, col, x, y, w, h) in enumerate(tiles):
+        count, stats, _ = results[index]
+        if not count:
+            continue
+        ids = final[offsets[index]:offsets[index] + count]
+        area = stats["area"]
+        merged["area"] += np.bincount(ids, area, n_objects)
+        merged["sum_x"] += np.bincount(ids, stats["sum_x"] + area * x, n_objects)
+        merged["sum_y"] += np.bincount(ids, stats["sum_y"] + area * y, n_objects)
+        merged["sum_intensity"] += np.bincount(ids, stats["sum_intensity"], n_objects)
+        np.minimum.at(merged["min_x"], ids, stats["min_x"] + x)
+        np.maximum.at(merged["max_x"], ids, stats["max_x"] + x)
+        np.minimum.at(merged["min_y"], ids, stats["min_y"] + y)
+        np.maximum.at(merged["max_y"], ids, stats["max_y"] + y)
+
+    table = np.zeros(n_objects, OBJECT_DTYPE)
+    area = merged["area"]
+    table["id"] = np.arange(1, n_objects + 1)
+    table["area"] = area
+    if n_objects:
+        table["centroid_x"] = merged["sum_x"] / area
+        table["centroid_y"] = merged["sum_y"] / area
+        table["mean_intensity"] = merged["sum_intensity"] / area
+    table["bbox_x"] = merged["min_x"]
+    table["bbox_y"] = merged["min_y"]
+    table["bbox_width"] = merged["max_x"] - merged["min_x"] + 1
+    table["bbox_height"] = merged["max_y"] - merged["min_y"] + 1
+
+    # Second pass: provisional labels to final object ids, plus the preview
+    preview_height, preview_width = pyramid.level_shape(preview_level)
+    preview = np.zeros((preview_height, preview_width, 4), np.uint8)
+    palette = object_palette()
+    factor = 2 ** preview_level
+    done[0] = 0
+
+    def second_pass(item):
+        index, (row, col, x, y, w, h) = item
+        if cancelled and cancelled():
+            return
+        count = results[index][0]
+        lut = np.zeros(count + 1, np.uint32)
+        lut[1:] = final[offsets[index]:offsets[index] + count] + 1
+        ids = lut[out[y:y + h, x:x + w]]
+        out[y:y + h, x:x + w] = ids
+        colors = np.where(ids > 0, (ids - 1) % 255 + 1, 0).astype(np.uint8)
+        rendered = palette[colors]
+        for _ in range(preview_level):
+            rendered = downsample(rendered)
+        px, py = x // factor, y // factor
+        preview[py:py + rendered.shape[0], px:px + rendered.shape[1]] = rendered
+        tick(100 - LABEL_PROGRESS, LABEL_PROGRESS)
+
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(second_pass, enumerate(tiles)))
+    if cancelled and cancelled():
+        raise InterruptedError("Object detection cancelled")
+    return table, preview
+
+
+def export_objects(table, path):
+    # CSV, or Parquet when the path ends in .parquet (needs pyarrow)
+    if os.path.splitext(path)[1].lower() == ".parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet export needs the pyarrow package") from None
+        columns = {name: table[name] for name in table.dtype.names}
+        pyarrow.parquet.write_table(pyarrow.table(columns), path)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())
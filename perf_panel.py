@@ -0,0 +1,116 @@
+from PyQt5.QtCore import QTimer, pyqtSignal
+from PyQt5.QtWidgets import (QCheckBox, QFileDialog, QHBoxLayout, QHeaderView, QLabel,
+                             QPushButton, QTableWidget, QTableWidgetItem, QVBoxLayout, QWidget)
+
+import tracing
+
+REFRESH_MS = 1000
+COLUMNS = ("Span", "Category", "Count", "Total ms", "Mean ms", "Max ms", "Tiles", "File MB",
+           "Peak MB", "Threads")
+HEADER_TIPS = {
+    "File MB": "Memory-mapped results and project data written",
+    "Peak MB": "Largest traced Python/numpy memory above the span's start, outermost "
+               "spans only; ~ marks peaks shared with spans on other threads",
+}
+
+
+class PerfPanel(QWidget):
+    # Per-span totals of the recorded trace, refreshed while visible, with
+    # export to Chrome trace JSON
+    message = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout(self)
+
+        header = QHBoxLayout()
+        self.record_check = QCheckBox("Record")
+        self.record_check.setChecked(tracing.enabled())
+        self.record_check.toggled.connect(self.set_recording)
+        header.addWidget(self.record_check)
+        header.addStretch()
+        self.stall_label = QLabel()
+        header.addWidget(self.stall_label)
+        layout.addLayout(header)
+
+        self.table = QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        for column, name in enumerate(COLUMNS):
+            if name in HEADER_TIPS:
+                self.table.horizontalHeaderItem(column).setToolTip(HEADER_TIPS[name])
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        layout.addWidget(self.table)
+
+        footer = QHBoxLayout()
+        footer.addStretch()
+        clear_button = QPushButton("Clear")
+        clear_button.clicked.connect(self.clear)
+        footer.addWidget(clear_button)
+        export_button = QPushButton("Export Trace...")
+        export_button.clicked.connect(self.export)
+        footer.addWidget(export_button)
+        layout.addLayout(footer)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_MS)
+        self.timer.timeout.connect(self.refresh)
+        self.refresh()
+
+    def set_recording(self, recording):
+        tracing.set_enabled(recording)
+        self.message.emit("Recording performance trace" if recording
+                          else "Performance trace paused")
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+        self.timer.start()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.timer.stop()
+
+    def refresh(self):
+        recorded = tracing.events()
+        rows = tracing.summarize(recorded)
+        self.table.setRowCount(len(rows))
+        for row, entry in enumerate(rows):
+            values = (entry["name"], entry["category"], str(entry["count"]),
+                      f"{entry['total_ms']:.1f}", f"{entry['mean_ms']:.2f}",
+                      f"{entry['max_ms']:.1f}", str(entry["tiles"] or ""),
+                      f"{entry['bytes'] / 2**20:.1f}" if entry["bytes"] else "",
+                      peak_text(entry),
+                      ", ".join(sorted(entry["threads"])))
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+        stalls = tracing.gui_stalls(recorded)
+        if stalls:
+            worst = max(stalls, key=lambda event: event[3])
+            self.stall_label.setText(f"GUI stalls over {tracing.STALL_MS} ms: {len(stalls)} "
+                                     f"(worst {worst[0]}, {worst[3] / 1e6:.0f} ms)")
+        else:
+            self.stall_label.setText(f"{len(recorded)} spans, no GUI stalls")
+
+    def clear(self):
+        tracing.clear()
+        self.refresh()
+
+    def export(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "trace.json",
+                                                   "Chrome trace (*.json)")
+        if not file_path:
+            return
+        try:
+            tracing.export_chrome_trace(file_path)
+        except OSError as e:
+            self.message.emit(f"Export failed: {e}")
+            return
+        self.message.emit(f"Trace saved to {file_path}")
+
+
+def peak_text(entry):
+    if not entry["peak_bytes"]:
+        return ""
+    return f"{'~' if entry['shared_peak'] else ''}{entry['peak_bytes'] / 2**20:.1f}"
@@ -0,0 +1,189 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from image_pyramid import downsample
+from tracing import count_bytes, count_tiles, traced
+
+WORKERS = os.cpu_count() or 1
+
+# Integer Rec. 601 luma weights, scaled by 256
+LUMA_WEIGHTS = (77, 150, 29)
+
+# Mask values are 0/1 for intensity thresholds and an R|G<<1|B<<2 bit set
+# for per-channel thresholds
+INTENSITY_MASK_LUT = np.array([[0, 0, 0, 255], [255, 255, 255, 255]], np.uint8)
+CHANNEL_MASK_LUT = np.array(
+    [[255 * (v & 1), 255 * (v >> 1 & 1), 255 * (v >> 2 & 1), 255] for v in range(8)], np.uint8
+)
+
+
+def intensity(rgba):
+    r, g, b = (rgba[..., c].astype(np.uint16) for c in range(3))
+    return ((r * LUMA_WEIGHTS[0] + g * LUMA_WEIGHTS[1] + b * LUMA_WEIGHTS[2]) >> 8).astype(np.uint8)
+
+
+def histogram(rgba, per_channel):
+    # 256-bin histogram of the intensity, or one per RGB channel
+    if per_channel:
+        return np.stack([np.bincount(rgba[..., c].ravel(), minlength=256) for c in range(3)])
+    return np.bincount(intensity(rgba).ravel(), minlength=256)[None]
+
+
+def otsu_threshold(hist):
+    # Level that maximizes the between-class variance
+    hist = hist.astype(np.float64)
+    total = hist.sum()
+    if total == 0:
+        return 127
+    weight = np.cumsum(hist) / total
+    mean = np.cumsum(hist * np.arange(256)) / total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = (mean[-1] * weight - mean) ** 2 / (weight * (1.0 - weight))
+    return int(np.nanargmax(variance[:-1]))
+
+
+def iterative_threshold(hist, tolerance=0.5):
+    # Ridler-Calvard isodata: midpoint of the two class means until stable
+    hist = hist.astype(np.float64)
+    values = np.arange(256)
+    if hist.sum() == 0:
+        return 127
+    level = (hist * values).sum() / hist.sum()
+    while True:
+        below, above = hist[:int(level) + 1], hist[int(level) + 1:]
+        low = (below * values[:int(level) + 1]).sum() / max(below.sum(), 1)
+        high = (above * values[int(level) + 1:]).sum() / max(above.sum(), 1)
+        new_level = (low + high) / 2
+        if abs(new_level - level) < tolerance:
+            return int(new_level)
+        level = new_level
+
+
+def threshold_levels(hist, mode, manual_value):
+    # One level per histogram row; `manual_value` is the 0-100 slider position
+    if mode == "Otsu":
+        return np.array([otsu_threshold(h) for h in hist], np.uint8)
+    if mode == "Iterative (auto)":
+        return np.array([iterative_threshold(h) for h in hist], np.uint8)
+    return np.full(len(hist), round(manual_value * 255 / 100), np.uint8)
+
+
+def threshold_mask(rgba, levels, per_channel, out=None):
+    # Pixels brighter than the level are foreground
+    if per_channel:
+        mask = (rgba[..., 0] > levels[0]).view(np.uint8)
+        mask |= (rgba[..., 1] > levels[1]).view(np.uint8) << 1
+        mask |= (rgba[..., 2] > levels[2]).view(np.uint8) << 2
+    else:
+        mask = (intensity(rgba) > levels[0]).view(np.uint8)
+    if out is None:
+        return mask
+    out[...] = mask
+    return out
+
+
+def render_mask(mask, per_channel, out=None):
+    lut = CHANNEL_MASK_LUT if per_channel else INTENSITY_MASK_LUT
+    return np.take(lut, mask, axis=0, out=out, mode="clip")
+
+
+def allocate_result(shape, directory=None, dtype=np.uint8):
+    # Full-resolution results live in memory-mapped scratch files
+    fd, path = tempfile.mkstemp(suffix=".npy", dir=directory)
+    os.close(fd)
+    count_bytes(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def remove_result(array):
+    filename = getattr(array, "filename", None)
+    if filename and os.path.exists(filename):
+        os.remove(filename)
+
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def process_pool(workers=WORKERS):
+    # Worker processes shared by every call for the life of the process.
+    # They start from a forkserver: forking the multithreaded Qt process
+    # from a job thread can deadlock the child. Large inputs are passed as
+    # memory-mapped files rather than pickled into each task
+    with _process_pools_lock:
+        # Keyed by pid so a forked child never reuses its parent's pool
+        key = (os.getpid(), workers)
+        pool = _process_pools.get(key)
+        # A pool whose worker died cannot take new work
+        if pool is None or getattr(pool, "_broken", False):
+            if multiprocessing.parent_process() is not None:
+                # Already inside a worker process (e.g. a batch job), which is
+                # one of a pool that fills the CPUs; nesting another pool of
+                # processes here would oversubscribe them and can hang
+                pool = ThreadPoolExecutor(workers)
+            else:
+                pool = ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context("forkserver"))
+            _process_pools[key] = pool
+        return pool
+
+
+@traced("histogram", "processing")
+def pyramid_histogram(pyramid, per_channel, level=0, workers=WORKERS, cancelled=None):
+    tiles = list(pyramid.iter_tiles(level))
+
+    def tile_histogram(tile):
+        if cancelled and cancelled():
+            return 0
+        row, col = tile[:2]
+        return histogram(pyramid.read_tile(level, row, col), per_channel)
+
+    with ThreadPoolExecutor(workers) as pool:
+        return sum(pool.map(tile_histogram, tiles))
+
+
+def pyramid_threshold_levels(pyramid, mode, manual_value, per_channel, workers=WORKERS,
+                             cancelled=None):
+    # Auto modes pick their levels from the full-resolution histogram
+    if mode == "Manual":
+        hist = np.zeros((3 if per_channel else 1, 256), np.int64)
+    else:
+        hist = pyramid_histogram(pyramid, per_channel, workers=workers, cancelled=cancelled)
+    return threshold_levels(hist, mode, manual_value)
+
+
+@traced("threshold", "processing")
+def threshold_pyramid(pyramid, levels, per_channel, out, preview_level=0,
+                      workers=WORKERS, progress=None, cancelled=None):
+    # Threshold the full-resolution image tile by tile in parallel; returns
+    # the rendered result downsampled to `preview_level`
+    tiles = list(pyramid.iter_tiles(0))
+    count_tiles(len(tiles))
+    preview_height, preview_width = pyramid.level_shape(preview_level)
+    preview = np.zeros((preview_height, preview_width, 4), np.uint8)
+    factor = 2 ** preview_level
+
+    def process_tile(tile):
+        if cancelled and cancelled():
+            return
+        row, col, x, y, w, h = tile
+        mask = threshold_mask(pyramid.read_tile(0, row, col), levels, per_channel)
+        out[y:y + h, x:x + w] = mask
+        rendered = render_mask(mask, per_channel)
+        for _ in range(preview_level):
+            rendered = downsample(rendered)
+        px, py = x // factor, y // factor
+        preview[py:py + rendered.shape[0], px:px + rendered.shape[1]] = rendered
+
+    with ThreadPoolExecutor(workers) as pool:
+        for done, _ in enumerate(pool.map(process_tile, tiles), start=1):
+            if progress:
+                progress(int(100 * done / len(tiles)))
+    if cancelled and cancelled():
+        raise InterruptedError("Threshold cancelled")
+    return preview
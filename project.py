@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from annotation_layer import LabelLayer
+from classifier import PixelClassifier
+from dataset import Dataset
+from image_pyramid import PYRAMID_CACHE_DIR, TILE_SIZE
+from tracing import count_bytes, count_tiles, traced
+
+PROJECT_VERSION = 1
+PROJECT_EXTENSION = ".ilproj"
+
+# One index record per saved label chunk. Chunks are only ever appended to
+# the label file, and the newest record of a chunk wins; an offset of -1
+# marks a chunk that was erased
+CHUNK_RECORD = np.dtype([("slice", "<u4"), ("row", "<u4"), ("col", "<u4"),
+                         ("height", "<u4"), ("width", "<u4"), ("offset", "<i8")])
+
+# The label file is rewritten without superseded chunks once it is this
+# many times larger than the chunks still in use. The copy gets a new name
+# and the manifest switches to it, so a crash leaves one complete version
+COMPACT_RATIO = 4
+COMPACT_MIN_BYTES = 64 * 2**20
+
+
+def write_json(path, data):
+    partial = path + ".partial"
+    with open(partial, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(partial, path)
+
+
+def read_index(path):
+    # {(slice, row, col): (height, width, offset)} of the newest records; a
+    # record torn by a crash mid-append is ignored
+    chunks = {}
+    if not os.path.exists(path):
+        return chunks
+    with open(path, "rb") as f:
+        data = f.read()
+    usable = len(data) - len(data) % CHUNK_RECORD.itemsize
+    for record in np.frombuffer(data[:usable], CHUNK_RECORD):
+        chunks[(int(record["slice"]), int(record["row"]), int(record["col"]))] = (
+            int(record["height"]), int(record["width"]), int(record["offset"]))
+    return chunks
+
+
+class Project:
+    # The image reference, pipeline settings, trained classifier and brush
+    # labels of a session. `path` is the JSON manifest; label chunks and the
+    # classifier are stored next to it
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.chunks = read_index(self.index_path)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, dataset):
+        directory = os.path.dirname(os.path.abspath(path))
+        manifest = {
+            "version": PROJECT_VERSION,
+            "slices": [[os.path.relpath(os.path.abspath(slice_path), directory), page]
+                       for slice_path, page in dataset.slices],
+            "chunk_size": TILE_SIZE,
+            "labels": os.path.basename(os.path.splitext(path)[0]) + ".labels",
+        }
+        # Saving over an existing project starts its labels afresh
+        labels_path = os.path.join(directory, manifest["labels"])
+        for stale in (labels_path, labels_path + ".idx"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        write_json(path, manifest)
+        return cls(path, manifest)
+
+    @classmethod
+    def open(cls, path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != PROJECT_VERSION:
+            raise ValueError(f"Unsupported project version: {manifest.get('version')}")
+        return cls(path, manifest)
+
+    @property
+    def labels_path(self):
+        return os.path.join(os.path.dirname(os.path.abspath(self.path)), self.manifest["labels"])
+
+    @property
+    def index_path(self):
+        return self.labels_path + ".idx"
+
+    @property
+    def classifier_path(self):
+        return os.path.splitext(self.path)[0] + ".classifier.npz"
+
+    @property
+    def chunk_size(self):
+        return self.manifest["chunk_size"]
+
+    def dataset(self, cache_dir=PYRAMID_CACHE_DIR):
+        # Image paths are relative to the manifest
+        directory = os.path.dirname(os.path.abspath(self.path))
+        return Dataset([(os.path.normpath(os.path.join(directory, path)), page)
+                        for path, page in self.manifest["slices"]], cache_dir)
+
+    def load_classifier(self, cache=None):
+        if not self.manifest.get("classifier") or not os.path.exists(self.classifier_path):
+            return None
+        return PixelClassifier.load(self.classifier_path, cache)
+
+    def label_slices(self):
+        # Indices of the slices that have saved labels
+        with self._lock:
+            return {key[0] for key, chunk in self.chunks.items() if chunk[2] >= 0}
+
+    @traced("read labels", "project")
+    def read_labels(self, index, width, height):
+        # The saved chunks of the slice stay views of a memory map of the
+        # label file until they are painted on
+        labels = LabelLayer(width, height, self.chunk_size)
+        with self._lock:
+            chunks = [(key, chunk) for key, chunk in self.chunks.items()
+                      if key[0] == index and chunk[2] >= 0]
+            if not chunks:
+                return labels
+            data = np.memmap(self.labels_path, np.uint8, "r")
+            for (_, row, col), (chunk_height, chunk_width, offset) in chunks:
+                chunk = data[offset:offset + chunk_height * chunk_width]
+                labels.load_chunk(row, col, chunk.reshape(chunk_height, chunk_width))
+            del data
+        count_tiles(len(chunks))
+        return labels
+
+    @traced("save project", "project")
+    def save(self, chunks, fields, classifier=None):
+        # Appends `chunks` as (slice, row, col, labels or None), then
+        # replaces the manifest with `fields` merged in
+        with self._lock:
+            if chunks:
+                records = np.zeros(len(chunks), CHUNK_RECORD)
+                with open(self.labels_path, "ab") as f:
+                    start = f.tell()
+                    for record, (index, row, col, data) in zip(records, chunks):
+                        record["slice"], record["row"], record["col"] = index, row, col
+                        if data is None:
+                            record["offset"] = -1
+                            continue
+                        record["height"], record["width"] = data.shape
+                        record["offset"] = f.tell()
+                        f.write(np.ascontiguousarray(data).tobytes())
+                    count_bytes(f.tell() - start)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # The index only ever points at chunks that are on disk
+                with open(self.index_path, "ab") as f:
+                    f.write(records.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                for record in records:
+                    key = (int(record["slice"]), int(record["row"]), int(record["col"]))
+                    self.chunks[key] = (int(record["height"]), int(record["width"]),
+                                        int(record["offset"]))
+                count_tiles(len(chunks))
+            if classifier is not None:
+                partial = self.classifier_path + ".partial"
+                classifier.save(partial)
+                os.replace(partial, self.classifier_path)
+                fields = dict(fields, classifier=os.path.basename(self.classifier_path))
+            self.manifest.update(fields)
+            write_json(self.path, self.manifest)
+            self._compact()
+
+    def _compact(self):
+        # Called with the lock held
+        live = {key: chunk for key, chunk in self.chunks.items() if chunk[2] >= 0}
+        used = sum(height * width for height, width, _ in live.values())
+        size = os.path.getsize(self.labels_path) if os.path.exists(self.labels_path) else 0
+        if size < COMPACT_MIN_BYTES or size < COMPACT_RATIO * used:
+            return
+        old_labels, old_index = self.labels_path, self.index_path
+        generation = self.manifest.get("labels_generation", 0) + 1
+        name = f"{os.path.basename(os.path.splitext(self.path)[0])}.{generation}.labels"
+        labels_path = os.path.join(os.path.dirname(old_labels), name)
+        records = np.zeros(len(live), CHUNK_RECORD)
+        chunks = {}
+        data = np.memmap(old_labels, np.uint8, "r")
+        with open(labels_path, "wb") as f:
+            for record, (key, (height, width, offset)) in zip(records, sorted(live.items())):
+                record["slice"], record["row"], record["col"] = key
+                record["height"], record["width"], record["offset"] = height, width, f.tell()
+                chunks[key] = (height, width, int(record["offset"]))
+                f.write(data[offset:offset + height * width].tobytes())
+            os.fsync(f.fileno())
+        del data
+        with open(labels_path + ".idx", "wb") as f:
+            f.write(records.tobytes())
+            os.fsync(f.fileno())
+        self.manifest.update(labels=name, labels_generation=generation)
+        write_json(self.path, self.manifest)
+        self.chunks = chunks
+        os.remove(old_labels)
+        os.remove(old_index)
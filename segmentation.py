@@ -0,0 +1,179 @@
+import os
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from image_pyramid import downsample
+from processing import LUMA_WEIGHTS, process_pool
+from tracing import count_tiles, traced
+
+SAMPLE_SIZE = 65536
+BATCH_SIZE = 4096
+MAX_ITERATIONS = 200
+TOLERANCE = 0.01
+WORKERS = os.cpu_count() or 1
+
+# Tiles per process-pool task; keeps per-task overhead low without hurting balance
+TILES_PER_TASK = 4
+
+
+def segment_palette(n_clusters):
+    palette = np.zeros((256, 4), np.uint8)
+    for i in range(n_clusters):
+        palette[i] = ((73 * (i + 1)) % 256, (169 * (i + 1)) % 256, (253 * (i + 1)) % 256, 255)
+    return palette
+
+
+def pixel_features(rgba):
+    return rgba[..., :3].reshape(-1, 3).astype(np.float32)
+
+
+def nearest_centroid(features, centroids):
+    # Squared distances via |x|^2 - 2x.c + |c|^2; the |x|^2 term does not change the argmin
+    centroids = centroids.astype(np.float32)
+    distances = (centroids * centroids).sum(axis=1) - 2.0 * features @ centroids.T
+    return distances.argmin(axis=1)
+
+
+def sample_pixels(pyramid, count=SAMPLE_SIZE, seed=0):
+    # Uniform random full-resolution pixels; only the pages holding them are read
+    rng = np.random.default_rng(seed)
+    count = min(count, pyramid.width * pyramid.height)
+    xs = rng.integers(0, pyramid.width, count)
+    ys = rng.integers(0, pyramid.height, count)
+    order = np.lexsort((xs, ys))
+    xs, ys = xs[order], ys[order]
+    size = pyramid.tile_size
+    pixels = pyramid.levels[0][ys // size, xs // size, ys % size, xs % size]
+    return pixel_features(pixels)
+
+
+def kmeans_plusplus(samples, n_clusters, rng, centroids=None):
+    # Seed (or extend) the centroids with probability proportional to D^2
+    if centroids is None or len(centroids) == 0:
+        centroids = samples[rng.integers(len(samples))][None]
+    centroids = np.asarray(centroids, np.float32)
+    closest = ((samples[:, None, :] - centroids[None]) ** 2).sum(axis=2).min(axis=1)
+    while len(centroids) < n_clusters:
+        total = closest.sum()
+        if total > 0:
+            index = rng.choice(len(samples), p=closest / total)
+        else:
+            index = rng.integers(len(samples))
+        centroids = np.vstack([centroids, samples[index]])
+        closest = np.minimum(closest, ((samples - samples[index]) ** 2).sum(axis=1))
+    return centroids
+
+
+def adapt_centroids(centroids, counts, n_clusters, samples, rng):
+    # Warm start from a previous fit with a different cluster count: merge the
+    # closest pairs to shrink, add k-means++ seeds to grow
+    centroids = np.array(centroids, np.float64)
+    weights = np.asarray(counts, np.float64) + 1.0
+    while len(centroids) > n_clusters:
+        distances = ((centroids[:, None] - centroids[None]) ** 2).sum(axis=2)
+        np.fill_diagonal(distances, np.inf)
+        i, j = np.unravel_index(distances.argmin(), distances.shape)
+        merged = (centroids[i] * weights[i] + centroids[j] * weights[j]) / (weights[i] + weights[j])
+        keep = [k for k in range(len(centroids)) if k not in (i, j)]
+        centroids = np.vstack([centroids[keep], merged])
+        weights = np.append(weights[keep], weights[i] + weights[j])
+    return kmeans_plusplus(samples, n_clusters, rng, centroids.astype(np.float32))
+
+
+class MiniBatchKMeans:
+    def __init__(self, n_clusters, batch_size=BATCH_SIZE, max_iter=MAX_ITERATIONS,
+                 tol=TOLERANCE, seed=0):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.tol = tol
+        self.seed = seed
+        self.centroids = None
+        self.counts = None
+        self.n_iter = 0
+
+    @traced("k-means fit", "processing")
+    def fit(self, samples, init=None, init_counts=None):
+        rng = np.random.default_rng(self.seed)
+        if init is None:
+            centroids = kmeans_plusplus(samples, self.n_clusters, rng)
+        elif len(init) == self.n_clusters:
+            centroids = np.array(init, np.float32)
+        else:
+            counts = init_counts if init_counts is not None else np.ones(len(init))
+            centroids = adapt_centroids(init, counts, self.n_clusters, samples, rng)
+        centroids = centroids.astype(np.float64)
+
+        # Sculley's mini-batch update with per-center learning rate 1/count
+        counts = np.zeros(self.n_clusters)
+        for self.n_iter in range(1, self.max_iter + 1):
+            batch = samples[rng.integers(0, len(samples), self.batch_size)]
+            labels = nearest_centroid(batch, centroids)
+            batch_counts = np.bincount(labels, minlength=self.n_clusters)
+            sums = np.stack([np.bincount(labels, weights=batch[:, d], minlength=self.n_clusters)
+                             for d in range(samples.shape[1])], axis=1)
+            counts += batch_counts
+            moved = batch_counts > 0
+            step = (sums[moved] - batch_counts[moved, None] * centroids[moved]) / counts[moved, None]
+            centroids[moved] += step
+            if np.abs(step).max(initial=0.0) < self.tol:
+                break
+
+        # Order clusters by brightness so colors stay stable between runs
+        order = np.argsort(centroids @ np.array(LUMA_WEIGHTS, np.float64))
+        self.centroids = centroids[order].astype(np.float32)
+        self.counts = np.bincount(nearest_centroid(samples, self.centroids),
+                                  minlength=self.n_clusters)
+        return self
+
+    def predict(self, rgba):
+        labels = nearest_centroid(pixel_features(rgba), self.centroids)
+        return labels.astype(np.uint8).reshape(rgba.shape[:2])
+
+
+def _assign_tiles(pyramid, tiles, centroids, out_path, preview_level, palette):
+    # Runs in a worker process: label a batch of tiles straight into the
+    # shared memory-mapped output and return their downsampled previews
+    out = np.load(out_path, mmap_mode="r+")
+    factor = 2 ** preview_level
+    previews = []
+    for row, col, x, y, w, h in tiles:
+        rgba = pyramid.read_tile(0, row, col)
+        labels = nearest_centroid(pixel_features(rgba), centroids).astype(np.uint8)
+        labels = labels.reshape(h, w)
+        out[y:y + h, x:x + w] = labels
+        rendered = palette[labels]
+        for _ in range(preview_level):
+            rendered = downsample(rendered)
+        previews.append((x // factor, y // factor, rendered))
+    out.flush()
+    return previews
+
+
+@traced("segment", "processing")
+def segment_pyramid(pyramid, centroids, out, preview_level=0, workers=WORKERS,
+                    progress=None, cancelled=None):
+    # Assign every full-resolution pixel to its nearest centroid across a
+    # process pool; returns the colored segmentation at `preview_level`
+    tiles = list(pyramid.iter_tiles(0))
+    count_tiles(len(tiles))
+    tasks = [tiles[i:i + TILES_PER_TASK] for i in range(0, len(tiles), TILES_PER_TASK)]
+    preview_height, preview_width = pyramid.level_shape(preview_level)
+    preview = np.zeros((preview_height, preview_width, 4), np.uint8)
+    palette = segment_palette(len(centroids))
+    out.flush()
+
+    pool = process_pool(workers)
+    futures = [pool.submit(_assign_tiles, pyramid, task, centroids, out.filename,
+                           preview_level, palette) for task in tasks]
+    for done, future in enumerate(as_completed(futures), start=1):
+        if cancelled and cancelled():
+            for pending in futures:
+                pending.cancel()
+            raise InterruptedError("Segmentation cancelled")
+        for x, y, rendered in future.result():
+            preview[y:y + rendered.shape[0], x:x + rendered.shape[1]] = rendered
+        if progress:
+            progress(int(100 * done / len(futures)))
+    return preview
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, QImageReader
+
+from image_pyramid import PYRAMID_CACHE_DIR, ImagePyramid, array_to_qimage
+from tracing import traced
+
+THUMBNAIL_SIZE = 128
+THUMBNAIL_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ilastik_ui_thumbnails")
+
+
+class ThumbnailCache:
+    # Small previews on disk, keyed by path, modification time and size so a
+    # changed file gets a new one. Images that already have a decoded pyramid
+    # are previewed from its smallest useful level
+    def __init__(self, directory=THUMBNAIL_CACHE_DIR, size=THUMBNAIL_SIZE,
+                 pyramid_dir=PYRAMID_CACHE_DIR):
+        self.directory = directory
+        self.size = size
+        self.pyramid_dir = pyramid_dir
+
+    def cache_path(self, image_path, mtime_ns, file_size):
+        key = f"{os.path.abspath(image_path)}|{mtime_ns}|{file_size}|{self.size}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        # Two levels so no directory grows past a few thousand files
+        return os.path.join(self.directory, digest[:2], digest + ".png")
+
+    @traced("thumbnail", "load")
+    def get(self, image_path, mtime_ns, file_size):
+        path = self.cache_path(image_path, mtime_ns, file_size)
+        image = QImage(path)
+        if not image.isNull():
+            return image
+        image = self.make(image_path)
+        if image.isNull():
+            return image
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + f".{os.getpid()}.partial"
+        if image.save(partial, "PNG"):
+            os.replace(partial, path)
+        return image
+
+    def make(self, image_path):
+        image = self._from_pyramid(image_path)
+        if image is not None:
+            return image
+        # Formats like JPEG decode straight to the reduced size
+        reader = QImageReader(image_path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid():
+            reader.setScaledSize(size.scaled(self.size, self.size, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return image
+        return image.scaled(self.size, self.size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    def _from_pyramid(self, image_path):
+        try:
+            directory = os.path.join(self.pyramid_dir, ImagePyramid.cache_key(image_path))
+            with open(os.path.join(directory, "pyramid.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        pyramid = ImagePyramid(directory, meta["tile_size"], meta["level_shapes"])
+        level = pyramid.level_for_size(self.size, self.size)
+        image = array_to_qimage(np.asarray(pyramid.read_level(level)))
+        return image.scaled(self.size, self.size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
@@ -0,0 +1,204 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# Completed spans kept for the panel and the trace export; the oldest are
+# dropped first
+MAX_EVENTS = 200000
+
+# Outermost spans on the GUI thread longer than this are reported as stalls
+STALL_MS = 50
+
+_enabled = False
+_started_tracemalloc = False
+_events = deque(maxlen=MAX_EVENTS)
+_local = threading.local()
+_origin = time.perf_counter_ns()
+# Outermost spans open on any thread; tracemalloc's peak is process-wide, so
+# it is only reset when none of them is running
+_open_outer = set()
+_open_outer_lock = threading.Lock()
+
+
+class Span:
+    # One timed region. Its bytes are the memory-mapped and file bytes added
+    # through count_bytes, and tile counts are added through count_tiles.
+    # Outermost spans also record peak_bytes, the highest Python and numpy
+    # memory traced above their starting point. tracemalloc cannot tell
+    # threads apart, so a span that overlapped another outermost span is
+    # marked shared_peak: its peak includes the other threads' allocations
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def add(self, tiles=0, nbytes=0):
+        if tiles:
+            self.args["tiles"] = self.args.get("tiles", 0) + tiles
+        if nbytes:
+            self.args["bytes"] = self.args.get("bytes", 0) + nbytes
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.depth = len(stack)
+        stack.append(self)
+        self.memory = None
+        if self.depth == 0 and tracemalloc.is_tracing():
+            with _open_outer_lock:
+                if _open_outer:
+                    for other in _open_outer:
+                        other.args["shared_peak"] = True
+                    self.args["shared_peak"] = True
+                else:
+                    tracemalloc.reset_peak()
+                _open_outer.add(self)
+                self.memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        _local.stack.pop()
+        if self.memory is not None:
+            with _open_outer_lock:
+                _open_outer.discard(self)
+                if tracemalloc.is_tracing():
+                    peak = tracemalloc.get_traced_memory()[1]
+                    self.args["peak_bytes"] = max(0, peak - self.memory)
+        thread = threading.current_thread()
+        _events.append((self.name, self.category, self.start - _origin, end - self.start,
+                        threading.get_native_id(), thread.name,
+                        thread is threading.main_thread(), self.depth, self.args))
+        return False
+
+
+class NullSpan:
+    # Stands in for a span while tracing is off
+    def add(self, tiles=0, nbytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(value):
+    # Allocations are only traced while recording, since tracemalloc slows
+    # every allocation down
+    global _enabled, _started_tracemalloc
+    _enabled = bool(value)
+    if _enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    elif not _enabled and _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+
+def span(name, category="app", **args):
+    if not _enabled:
+        return NULL_SPAN
+    return Span(name, category, args)
+
+
+def traced(name=None, category="app"):
+    # Decorator form of span(); costs one flag check while tracing is off
+    def decorate(function):
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(label, category, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def current():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if _enabled and stack else NULL_SPAN
+
+
+def count_tiles(tiles):
+    current().add(tiles=tiles)
+
+
+def count_bytes(nbytes):
+    current().add(nbytes=nbytes)
+
+
+def events():
+    # (name, category, start_ns, duration_ns, thread_id, thread_name,
+    # on_gui_thread, depth, args), oldest first
+    return list(_events)
+
+
+def clear():
+    _events.clear()
+
+
+def summarize(recorded=None):
+    # Totals per span name, slowest total first
+    recorded = events() if recorded is None else recorded
+    totals = {}
+    for name, category, _, duration, _, thread_name, _, _, args in recorded:
+        entry = totals.get((name, category))
+        if entry is None:
+            entry = totals[(name, category)] = {
+                "name": name, "category": category, "count": 0, "total_ms": 0.0,
+                "max_ms": 0.0, "tiles": 0, "bytes": 0, "peak_bytes": 0,
+                "shared_peak": False, "threads": set(),
+            }
+        ms = duration / 1e6
+        entry["count"] += 1
+        entry["total_ms"] += ms
+        entry["max_ms"] = max(entry["max_ms"], ms)
+        entry["tiles"] += args.get("tiles", 0)
+        entry["bytes"] += args.get("bytes", 0)
+        entry["peak_bytes"] = max(entry["peak_bytes"], args.get("peak_bytes", 0))
+        entry["shared_peak"] = entry["shared_peak"] or args.get("shared_peak", False)
+        entry["threads"].add(thread_name)
+    for entry in totals.values():
+        entry["mean_ms"] = entry["total_ms"] / entry["count"]
+    return sorted(totals.values(), key=lambda entry: entry["total_ms"], reverse=True)
+
+
+def gui_stalls(recorded=None, threshold_ms=STALL_MS):
+    # Outermost GUI-thread spans that blocked the event loop for too long
+    recorded = events() if recorded is None else recorded
+    return [event for event in recorded
+            if event[6] and event[7] == 0 and event[3] / 1e6 >= threshold_ms]
+
+
+def export_chrome_trace(path, recorded=None):
+    # Trace-event JSON for chrome://tracing and Perfetto
+    recorded = events() if recorded is None else recorded
+    pid = os.getpid()
+    trace = []
+    threads = {}
+    for name, category, start, duration, tid, thread_name, _, _, args in recorded:
+        threads[tid] = thread_name
+        trace.append({"name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                      "ts": start / 1000, "dur": duration / 1000, "args": args})
+    for tid, thread_name in threads.items():
+        trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                      "args": {"name": thread_name}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
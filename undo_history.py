@@ -0,0 +1,207 @@
+import zlib
+
+import numpy as np
+from PyQt5.QtGui import QImage, QPainter
+
+from image_pyramid import array_to_qimage, qimage_to_array
+from tracing import traced
+
+TILE_SIZE = 64
+MEMORY_BUDGET = 64 * 1024 * 1024
+
+# The most recent actions stay uncompressed so undoing them is a plain copy
+RAW_ACTIONS = 4
+COMPRESSION_LEVEL = 1
+
+
+class PixmapSurface:
+    # Adapter that lets the history read and restore regions of a QPixmap in place
+    def __init__(self, pixmap):
+        self.pixmap = pixmap
+
+    @property
+    def width(self):
+        return self.pixmap.width()
+
+    @property
+    def height(self):
+        return self.pixmap.height()
+
+    def read_region(self, x, y, width, height):
+        image = self.pixmap.copy(x, y, width, height).toImage()
+        image = image.convertToFormat(QImage.Format_RGBA8888)
+        return qimage_to_array(image).copy()
+
+    def write_region(self, x, y, data):
+        painter = QPainter(self.pixmap)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        painter.drawImage(x, y, array_to_qimage(data))
+        painter.end()
+
+
+class TileDelta:
+    __slots__ = ("x", "y", "shape", "dtype", "before", "after", "compressed")
+
+    def __init__(self, x, y, before, after):
+        self.x = x
+        self.y = y
+        self.shape = before.shape
+        self.dtype = before.dtype
+        self.before = before
+        self.after = after
+        self.compressed = False
+
+    @property
+    def nbytes(self):
+        if self.compressed:
+            return len(self.before) + len(self.after)
+        return self.before.nbytes + self.after.nbytes
+
+    def compress(self):
+        if not self.compressed:
+            self.before = zlib.compress(self.before.tobytes(), COMPRESSION_LEVEL)
+            self.after = zlib.compress(self.after.tobytes(), COMPRESSION_LEVEL)
+            self.compressed = True
+
+    def data(self, state):
+        data = self.before if state == "before" else self.after
+        if self.compressed:
+            data = np.frombuffer(zlib.decompress(data), self.dtype).reshape(self.shape)
+        return data
+
+
+class HistoryAction:
+    def __init__(self, name, surface):
+        self.name = name
+        self.surface = surface
+        self.deltas = []
+        self.compressed = False
+
+    @property
+    def nbytes(self):
+        return sum(delta.nbytes for delta in self.deltas)
+
+    def compress(self):
+        for delta in self.deltas:
+            delta.compress()
+        self.compressed = True
+
+    def bounds(self):
+        # Union of the changed tiles as (x, y, width, height)
+        x0 = min(delta.x for delta in self.deltas)
+        y0 = min(delta.y for delta in self.deltas)
+        x1 = max(delta.x + delta.shape[1] for delta in self.deltas)
+        y1 = max(delta.y + delta.shape[0] for delta in self.deltas)
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def apply(self, state):
+        for delta in self.deltas:
+            self.surface.write_region(delta.x, delta.y, delta.data(state))
+
+
+class HistoryEngine:
+    def __init__(self, tile_size=TILE_SIZE, memory_budget=MEMORY_BUDGET, raw_actions=RAW_ACTIONS):
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget
+        self.raw_actions = raw_actions
+        self.undo_stack = []
+        self.redo_stack = []
+        self.current = None
+        self._before = {}
+
+    @property
+    def nbytes(self):
+        return sum(action.nbytes for action in self.undo_stack + self.redo_stack)
+
+    def can_undo(self):
+        return bool(self.undo_stack) or self.current is not None
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.current = None
+        self._before = {}
+
+    def begin_action(self, name, surface):
+        if self.current is not None:
+            self.end_action()
+        self.current = HistoryAction(name, surface)
+        self._before = {}
+
+    def touch(self, x, y, width, height):
+        # Snapshot every tile of the rect the first time the action touches it
+        if self.current is None:
+            return
+        surface = self.current.surface
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1 = min(surface.width, int(x + width))
+        y1 = min(surface.height, int(y + height))
+        if x1 <= x0 or y1 <= y0:
+            return
+        size = self.tile_size
+        for row in range(y0 // size, (y1 - 1) // size + 1):
+            for col in range(x0 // size, (x1 - 1) // size + 1):
+                if (row, col) not in self._before:
+                    self._before[(row, col)] = surface.read_region(*self._tile_rect(row, col))
+
+    def touch_all(self):
+        if self.current is not None:
+            self.touch(0, 0, self.current.surface.width, self.current.surface.height)
+
+    @traced("history commit", "history")
+    def end_action(self):
+        action, self.current = self.current, None
+        before_tiles, self._before = self._before, {}
+        if action is None:
+            return None
+        for (row, col), before in before_tiles.items():
+            x, y, width, height = self._tile_rect(row, col, action.surface)
+            after = action.surface.read_region(x, y, width, height)
+            if not np.array_equal(before, after):
+                action.deltas.append(TileDelta(x, y, before, after))
+        if not action.deltas:
+            return None
+        self.redo_stack = []
+        self.undo_stack.append(action)
+        self._enforce_budget()
+        return action
+
+    @traced("undo", "history")
+    def undo(self):
+        if self.current is not None:
+            self.end_action()
+        if not self.undo_stack:
+            return None
+        action = self.undo_stack.pop()
+        action.apply("before")
+        self.redo_stack.append(action)
+        return action
+
+    @traced("redo", "history")
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        action = self.redo_stack.pop()
+        action.apply("after")
+        self.undo_stack.append(action)
+        self._enforce_budget()
+        return action
+
+    def _tile_rect(self, row, col, surface=None):
+        surface = surface or self.current.surface
+        x, y = col * self.tile_size, row * self.tile_size
+        return (x, y, min(self.tile_size, surface.width - x),
+                min(self.tile_size, surface.height - y))
+
+    def _enforce_budget(self):
+        # Compress everything but the newest actions, then drop the oldest
+        # actions until the history fits the budget
+        for action in self.undo_stack[:max(0, len(self.undo_stack) - self.raw_actions)]:
+            if not action.compressed:
+                action.compress()
+        total = self.nbytes
+        while total > self.memory_budget and len(self.undo_stack) > 1:
+            total -= self.undo_stack.pop(0).nbytes